@@ -0,0 +1,136 @@
+"""
+Run time of HOP against agreement with the default groups.
+
+HOP is run on clustered random particles, first with the default
+parameters and then with each of a set of alternatives.  For each, the
+run time, the number of groups, and the fraction of particles whose
+groups agree with the default groups are reported.  A particle agrees
+if neither run puts it in a group, or if it is in the group holding
+most of the members of its default group.
+
+Usage: python hop_parameters.py [--particles N] [--nthreads N]
+
+"""
+
+import argparse
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+from yt_astro_analysis.halo_analysis.halo_finding.hop.EnzoHop import RunHOP
+
+# alternatives to the defaults of ndens=64, nhop=ndens, nmerge=4, nbucket=16
+_parameters = (
+    {},
+    {"nbucket": 8},
+    {"nbucket": 32},
+    {"nbucket": 64},
+    {"ndens": 48},
+    {"ndens": 32},
+    {"ndens": 16},
+    {"ndens": 32, "nhop": 16},
+    {"ndens": 16, "nmerge": 2},
+)
+
+
+@contextmanager
+def _quiet():
+    # HOP reports its progress on stdout and stderr from C
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(fd) for fd in (1, 2)]
+    with open(os.devnull, "w") as devnull:
+        for fd in (1, 2):
+            os.dup2(devnull.fileno(), fd)
+        try:
+            yield
+        finally:
+            for fd, old in zip((1, 2), saved):
+                os.dup2(old, fd)
+                os.close(old)
+
+
+def clustered_particles(n_particles, n_clusters=40, seed=0):
+    """
+    Particles in the unit box, half in Gaussian clusters of different
+    sizes and half uniformly distributed.
+    """
+
+    rng = np.random.default_rng(seed)
+    n_clustered = n_particles // 2
+    centers = rng.random((n_clusters, 3))
+    widths = rng.uniform(0.005, 0.03, n_clusters)
+    members = rng.integers(0, n_clusters, n_clustered)
+    pos = np.concatenate(
+        [
+            centers[members]
+            + rng.normal(size=(n_clustered, 3)) * widths[members, None],
+            rng.random((n_particles - n_clustered, 3)),
+        ]
+    )
+    return pos % 1, np.ones(n_particles)
+
+
+def group_agreement(tags, reference):
+    """
+    Return the fraction of particles whose groups agree with a reference.
+    """
+
+    grouped = reference >= 0
+    agree = np.count_nonzero((tags < 0) & ~grouped)
+    pairs, counts = np.unique(
+        np.stack([reference[grouped], tags[grouped]]), axis=1, return_counts=True
+    )
+    # the most common group of the members of each reference group
+    for group in np.unique(pairs[0]):
+        mine = pairs[0] == group
+        best = np.argmax(counts[mine])
+        if pairs[1][mine][best] >= 0:
+            agree += counts[mine][best]
+    return agree / tags.size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--particles", type=int, default=500000)
+    parser.add_argument("--nthreads", type=int, default=1)
+    parser.add_argument("--threshold", type=float, default=160.0)
+    args = parser.parse_args()
+
+    pos, mass = clustered_particles(args.particles)
+
+    print(
+        f"{'Parameters':<28s} {'Time (s)':>9s} {'Speedup':>8s} "
+        f"{'Groups':>7s} {'Agreement':>10s}"
+    )
+    reference = None
+    for parameters in _parameters:
+        start = time.perf_counter()
+        with _quiet():
+            _, tags = RunHOP(
+                pos,
+                None,
+                None,
+                mass,
+                args.threshold,
+                nthreads=args.nthreads,
+                **parameters,
+            )
+        run_time = time.perf_counter() - start
+        if reference is None:
+            reference = tags
+            reference_time = run_time
+
+        name = ", ".join(f"{key}={value}" for key, value in parameters.items())
+        print(
+            f"{name or 'defaults':<28s} {run_time:9.3f} "
+            f"{reference_time / run_time:8.2f} {tags.max() + 1:7d} "
+            f"{group_agreement(tags, reference):10.4f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
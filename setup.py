@@ -66,11 +66,15 @@ extensions = [
         ],
         libraries=std_libs,
         define_macros=define_macros,
+        extra_compile_args=omp_args,
+        extra_link_args=omp_args,
     ),
     Extension(
         "yt_astro_analysis.halo_analysis.halo_finding.hop.EnzoHop",
         glob.glob("yt_astro_analysis/halo_analysis/halo_finding/hop/*.c"),
         define_macros=define_macros,
+        extra_compile_args=omp_args,
+        extra_link_args=omp_args,
     ),
 ]
 
@@ -10,8 +10,10 @@ from yt.utilities.operator_registry import OperatorRegistry
 callback_registry = OperatorRegistry()
 
 
-def add_callback(name, function):
-    callback_registry[name] = AnalysisCallback(function)
+def add_callback(name, function, cacheable=False):
+    callback = AnalysisCallback(function)
+    callback.cacheable = cacheable
+    callback_registry[name] = callback
 
 
 class AnalysisCallback:
@@ -19,8 +21,18 @@ class AnalysisCallback:
     An AnalysisCallback is a function that minimally takes in a target object
     and performs some analysis on it. This function may attach attributes
     to the target object, write out data, etc, but does not return anything.
+
+    If vectorized is True, the function also accepts a HaloBatch, whose
+    quantities are arrays over many targets, and operates on all of them
+    at once.  If cacheable is True, its results may be taken from a
+    ResultCache instead of calling it.  This is only correct if all it
+    does is set, change, or remove attributes and quantities of the
+    target, and not, for example, write files or change data containers.
     """
 
+    vectorized = False
+    cacheable = False
+
     def __init__(self, function, *args, **kwargs):
         self.function = function
         self.args = args
@@ -34,15 +46,18 @@ class AnalysisCallback:
 filter_registry = OperatorRegistry()
 
 
-def add_filter(name, function):
-    filter_registry[name] = AnalysisFilter(function)
+def add_filter(name, function, vectorized=False):
+    halo_filter = AnalysisFilter(function)
+    halo_filter.vectorized = vectorized
+    filter_registry[name] = halo_filter
 
 
 class AnalysisFilter(AnalysisCallback):
     r"""
     An AnalysisFilter is a function that minimally takes a target object, performs
     some analysis, and returns either True or False. The return value determines
-    whether analysis is continued.
+    whether analysis is continued.  A vectorized filter returns an array of
+    booleans when given a HaloBatch.
     """
 
     def __call__(self, target):
@@ -52,14 +67,17 @@ class AnalysisFilter(AnalysisCallback):
 quantity_registry = OperatorRegistry()
 
 
-def add_quantity(name, function):
-    quantity_registry[name] = AnalysisQuantity(function)
+def add_quantity(name, function, vectorized=False):
+    quantity = AnalysisQuantity(function)
+    quantity.vectorized = vectorized
+    quantity_registry[name] = quantity
 
 
 class AnalysisQuantity(AnalysisCallback):
     r"""
     An AnalysisQuantity is a function that takes minimally a target object,
-    performs some analysis, and then returns a value.
+    performs some analysis, and then returns a value.  A vectorized quantity
+    returns an array of values when given a HaloBatch.
     """
 
     def __call__(self, target):
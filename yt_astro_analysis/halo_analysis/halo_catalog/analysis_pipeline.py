@@ -7,6 +7,8 @@ AnalysisPipeline class and member functions
 
 import os
 
+import numpy as np
+
 from yt.funcs import ensure_dir
 from yt_astro_analysis.halo_analysis.halo_catalog.analysis_operators import (
     callback_registry,
@@ -24,6 +26,8 @@ class AnalysisPipeline:
         if output_dir is None:
             output_dir = "."
         self.output_dir = output_dir
+        self.profile = None
+        self.result_cache = None
 
     def add_callback(self, callback, *args, **kwargs):
         callback = callback_registry.find(callback, *args, **kwargs)
@@ -53,6 +57,53 @@ class AnalysisPipeline:
         halo_recipe = recipe_registry.find(recipe, *args, **kwargs)
         halo_recipe(self)
 
+    def _start_update(self, stored_fields, field_type):
+        """
+        Change the actions to compute only quantities missing from a
+        catalog holding stored_fields.
+
+        Stored quantities are read from the catalog instead of computed and
+        stored fields not produced by any quantity are carried over.
+        Callbacks are only kept if a missing quantity follows them.
+        Returns the original state to be restored by _end_update.
+        """
+
+        state = (self.actions, list(self.quantities), self.field_quantities)
+        stored_fields = list(stored_fields)
+        stored = set(stored_fields)
+
+        actions = []
+        needed = False
+        for action_type, action in reversed(self.actions):
+            if action_type == "quantity":
+                key, quantity = action
+                if key in stored:
+                    action = (key, (field_type, key))
+                else:
+                    needed = True
+            elif action_type == "callback" and not needed:
+                continue
+            actions.append((action_type, action))
+        actions.reverse()
+
+        extra = [key for key in stored_fields if key not in self.quantities]
+        self.actions = [
+            ("quantity", (key, (field_type, key))) for key in extra
+        ] + actions
+        # keep the same list, which may be shared with a HaloCatalog
+        self.quantities.extend(extra)
+        self.field_quantities = []
+        for action_type, action in self.actions:
+            if action_type == "quantity" and not callable(action[1]):
+                self.field_quantities.append(action[1])
+        return state
+
+    def _end_update(self, state):
+        "Restore the state saved by _start_update."
+
+        self.actions, quantities, self.field_quantities = state
+        self.quantities[:] = quantities
+
     def _preprocess(self):
         "Create callback output directories."
 
@@ -66,22 +117,86 @@ class AnalysisPipeline:
                 )
                 action.kwargs["output_dir"] = new_output_dir
 
-    def _process_target(self, target):
+    def _process_batch(self, batch):
+        """
+        Apply the leading vectorizable actions to a batch of targets.
+
+        Actions are applied in order until the first one that cannot
+        operate on whole arrays.  Targets rejected by a filter are removed
+        from the batch.  Returns the number of actions applied, from which
+        the remaining actions must be carried out on each target.
+        """
+
+        profile = self.profile
+        for i, (action_type, action) in enumerate(self.actions):
+            n_targets = batch.indices.size
+            if n_targets == 0:
+                return len(self.actions)
+
+            if action_type == "filter":
+                vectorized = action.vectorized
+            elif action_type == "quantity":
+                key, quantity = action
+                vectorized = not callable(quantity) or quantity.vectorized
+            else:
+                vectorized = False
+            if not vectorized:
+                return i
+
+            if profile is not None:
+                profile.start()
+
+            n_passed = None
+            if action_type == "filter":
+                batch._apply_mask(np.asarray(action(batch), dtype=bool))
+                n_passed = batch.indices.size
+            elif not callable(quantity):
+                batch._set_field_value(key, quantity)
+            else:
+                batch.quantities[key] = quantity(batch)
+
+            if profile is not None:
+                profile.stop(i, n_calls=n_targets, n_passed=n_passed)
+
+        return len(self.actions)
+
+    def _process_target(self, target, start=0):
+        profile = self.profile
+        cache = self.result_cache
         target_filter = True
-        for action_type, action in self.actions:
+        for i, (action_type, action) in enumerate(self.actions[start:], start=start):
+            if profile is not None:
+                profile.start()
+
             if action_type == "callback":
-                action(target)
+                if cache is None or not action.cacheable:
+                    action(target)
+                else:
+                    cache_key = cache.get_key(self.actions, i, target)
+                    cache.apply_callback(cache_key, target, action)
             elif action_type == "filter":
                 target_filter = action(target)
-                if not target_filter:
-                    break
             elif action_type == "quantity":
                 key, quantity = action
-                if callable(quantity):
+                if not callable(quantity):
+                    target._set_field_value(key, quantity)
+                elif cache is None:
                     target.quantities[key] = quantity(target)
                 else:
-                    target._set_field_value(key, quantity)
+                    cache_key = cache.get_key(self.actions, i, target)
+                    target.quantities[key] = cache.apply_quantity(
+                        cache_key, target, quantity
+                    )
             else:
                 raise RuntimeError("Action must be a callback, filter, or quantity.")
 
+            if profile is not None:
+                if action_type == "filter":
+                    profile.stop(i, n_passed=int(bool(target_filter)))
+                else:
+                    profile.stop(i)
+
+            if not target_filter:
+                break
+
         return target_filter
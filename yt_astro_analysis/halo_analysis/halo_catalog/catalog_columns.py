@@ -0,0 +1,297 @@
+"""
+CatalogColumns class and member functions
+
+
+
+"""
+
+from collections.abc import MutableMapping
+
+import numpy as np
+from unyt import unyt_array, unyt_quantity
+
+
+def _fill_missing(key, column, rows):
+    # only floating point values have NaN to mark them as missing
+    if column.dtype.kind not in "fc":
+        raise RuntimeError(
+            f"Quantity {key} is missing from some halos, but only floating "
+            "point quantities can be missing."
+        )
+    column[rows] = np.nan
+
+
+class CatalogColumns:
+    r"""
+    Columnar storage for the quantities of a halo catalog.
+
+    Each quantity is stored in its own preallocated array that grows as
+    halos are added.  Quantities with units are converted to base units
+    and share the unit registry of the first value added to the column.
+    Quantities missing from a row are filled with NaN.  Other types of
+    quantities, such as integers, have no value to mark them as missing,
+    so an error is raised if they are missing from a row.
+
+    Rows can be retrieved with an integer index as a dictionary of
+    quantities and full columns can be retrieved with a quantity name.
+    Rows can also be filled in place through the view returned by
+    new_row before they are added.
+
+    Parameters
+    ----------
+    capacity : int
+        The initial number of rows to allocate.
+        Default: 1024
+
+    """
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.size = 0
+        self._columns = {}
+        self._units = {}
+        self._conversions = {}
+        self._row_keys = ()
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for i in range(self.size):
+            yield self[i]
+
+    def __contains__(self, key):
+        return key in self._columns
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self._get_column(key)
+
+        if key < 0:
+            key += self.size
+        if key < 0 or key >= self.size:
+            raise IndexError(f"Row {key} out of range for {self.size} halos.")
+        return {column: self._get_column(column)[key] for column in self._columns}
+
+    def keys(self):
+        return self._columns.keys()
+
+    def new_row(self):
+        """
+        Return an empty view of the next row.
+
+        Quantities set in the row are written to the columns, but the row
+        is only added to the catalog by add_row.  Until then, the next
+        call to new_row returns a view of the same row.
+        """
+
+        if self.size >= self.capacity:
+            self._grow(self.size + 1)
+        return CatalogRow(self, self.size, ())
+
+    def add_row(self, row):
+        """
+        Add a row returned by new_row, filling the quantities missing
+        from it.
+        """
+
+        if row._index != self.size:
+            raise RuntimeError("Only the row returned by new_row can be added.")
+
+        keys = row._keys
+        if len(keys) < len(self._columns):
+            for key, column in self._columns.items():
+                if key not in keys:
+                    _fill_missing(key, column, self.size)
+
+        # rows with the same quantities share a single tuple of keys
+        if keys == self._row_keys:
+            row._keys = self._row_keys
+        else:
+            self._row_keys = keys
+        self.size += 1
+
+    def _get_value(self, key, index):
+        value = self._columns[key][index]
+        units = self._units[key]
+        if units is None:
+            return value
+        if np.ndim(value) == 0:
+            return unyt_quantity(value, units, registry=units.registry)
+        return unyt_array(value, units, registry=units.registry)
+
+    def _get_column(self, key):
+        column = self._columns[key][: self.size]
+        units = self._units[key]
+        if units is None:
+            return column
+        return unyt_array(column, units, registry=units.registry)
+
+    def _add_column(self, key, value):
+        if hasattr(value, "units"):
+            units = value.in_base().units
+            value = value.to_value(units)
+        else:
+            units = None
+        value = np.asarray(value)
+        column = np.empty((self.capacity,) + value.shape, dtype=value.dtype)
+        if self.size > 0:
+            _fill_missing(key, column, slice(0, self.size))
+        self._columns[key] = column
+        self._units[key] = units
+        return column
+
+    def _grow(self, size):
+        capacity = max(size, 2 * self.capacity)
+        for key, column in self._columns.items():
+            new_column = np.empty((capacity,) + column.shape[1:], dtype=column.dtype)
+            new_column[: self.size] = column[: self.size]
+            self._columns[key] = new_column
+        self.capacity = capacity
+
+    def _convert(self, key, value):
+        # values in the units of their column as an array
+        units = self._units[key]
+        if units is None:
+            return np.asarray(value)
+
+        # values of a quantity usually have the same units, so the
+        # conversion factor is only found when they change
+        conversion = self._conversions.get(key)
+        if conversion is None or conversion[0] != value.units:
+            factor, offset = value.units.get_conversion_factor(units)
+            if offset is not None:
+                return np.asarray(value.to_value(units))
+            conversion = self._conversions[key] = (value.units, factor)
+        return np.multiply(value.d, conversion[1])
+
+    def _set_value(self, key, index, value):
+        column = self._columns.get(key)
+        if column is None:
+            column = self._add_column(key, value)
+
+        value = self._convert(key, value)
+        if not np.can_cast(value.dtype, column.dtype, casting="same_kind"):
+            column = column.astype(np.result_type(column.dtype, value.dtype))
+            self._columns[key] = column
+        column[index] = value
+
+    def append(self, quantities):
+        """
+        Add a row from a dictionary of quantities.
+        """
+
+        if self.size >= self.capacity:
+            self._grow(self.size + 1)
+
+        for key, value in quantities.items():
+            self._set_value(key, self.size, value)
+
+        for key, column in self._columns.items():
+            if key not in quantities:
+                _fill_missing(key, column, self.size)
+
+        self.size += 1
+
+    def extend(self, data):
+        """
+        Add rows from a dictionary of arrays of equal length.
+        """
+
+        if not data:
+            return
+        n_rows = len(next(iter(data.values())))
+        if n_rows == 0:
+            return
+
+        if self.size + n_rows > self.capacity:
+            self._grow(self.size + n_rows)
+
+        for key, values in data.items():
+            column = self._columns.get(key)
+            if column is None:
+                column = self._add_column(key, values[0])
+
+            values = self._convert(key, values)
+            if not np.can_cast(values.dtype, column.dtype, casting="same_kind"):
+                column = column.astype(np.result_type(column.dtype, values.dtype))
+                self._columns[key] = column
+            column[self.size : self.size + n_rows] = values
+
+        for key, column in self._columns.items():
+            if key not in data:
+                _fill_missing(key, column, slice(self.size, self.size + n_rows))
+
+        self.size += n_rows
+
+    def clear(self):
+        """
+        Remove all rows, keeping the allocated columns and their units.
+        """
+
+        self.size = 0
+
+    def to_dict(self, keys=None):
+        """
+        Return a dictionary of the columns for the given keys, or for all
+        quantities if keys is None.
+        """
+
+        if keys is None:
+            keys = self._columns.keys()
+        return {key: self._get_column(key) for key in keys}
+
+
+class CatalogRow(MutableMapping):
+    r"""
+    A dictionary-like view of one row of a CatalogColumns.
+
+    Quantities are read from the columns only when accessed and are
+    written to the columns when set.  Quantities deleted from the row are
+    filled with NaN as if they were missing from it.
+
+    Parameters
+    ----------
+    catalog : CatalogColumns
+        The columns holding the row.
+    index : int
+        The index of the row.
+    keys : tuple
+        The names of the quantities in the row.
+
+    """
+
+    __slots__ = ("_catalog", "_index", "_keys")
+
+    def __init__(self, catalog, index, keys):
+        self._catalog = catalog
+        self._index = index
+        self._keys = keys
+
+    def __getitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        return self._catalog._get_value(key, self._index)
+
+    def __setitem__(self, key, value):
+        self._catalog._set_value(key, self._index, value)
+        if key not in self._keys:
+            self._keys += (key,)
+
+    def __delitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        _fill_missing(key, self._catalog._columns[key], self._index)
+        self._keys = tuple(k for k in self._keys if k != key)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return repr(dict(self))
@@ -0,0 +1,98 @@
+"""
+CatalogWriter class and member functions
+
+
+
+"""
+
+import numpy as np
+
+from yt.frontends.ytdata.utilities import save_as_dataset
+from yt.utilities.on_demand_imports import _h5py as h5py
+from yt_astro_analysis.utilities.logging import quiet
+
+
+class CatalogWriter:
+    r"""
+    Write halo catalog data to disk in increments.
+
+    The file has the same layout as one written by the HaloCatalog at the
+    end of a run, so it can be loaded by yt after any call to write.  Each
+    field is stored in a resizable dataset that is extended as new halos
+    are written.
+
+    Parameters
+    ----------
+    filename : str
+        The name of the file to be written.
+    ds : dataset
+        The dataset whose attributes are saved with the catalog.
+    mode : str
+        If "w", a new file is created, overwriting any existing file.  If
+        "a", halos are added to those already in the file.
+        Default: "w"
+
+    """
+
+    def __init__(self, filename, ds, mode="w"):
+        if mode not in ("w", "a"):
+            raise ValueError(f"Invalid mode: {mode}.")
+
+        self.filename = filename
+        if mode == "w":
+            extra_attrs = {"data_type": "halo_catalog", "num_halos": 0}
+            with quiet():
+                save_as_dataset(ds, filename, {}, extra_attrs=extra_attrs)
+
+        self.fh = h5py.File(filename, mode="a")
+        self.size = int(self.fh.attrs["num_halos"])
+
+    def write(self, data):
+        """
+        Add halos from a dictionary of field arrays of equal length.
+        """
+
+        if not data:
+            return
+        n_halos = len(next(iter(data.values())))
+        if n_halos == 0:
+            return
+
+        for field, values in data.items():
+            if hasattr(values, "units"):
+                units = str(values.units)
+            else:
+                units = ""
+
+            if field not in self.fh:
+                values = np.asarray(values)
+                dataset = self.fh.create_dataset(
+                    field,
+                    shape=(self.size,) + values.shape[1:],
+                    maxshape=(None,) + values.shape[1:],
+                    dtype=values.dtype,
+                    chunks=True,
+                    fillvalue=0,
+                )
+                dataset.attrs["units"] = units
+            else:
+                dataset = self.fh[field]
+                my_units = dataset.attrs["units"]
+                if units and my_units and units != my_units:
+                    values = values.to(my_units)
+
+            dataset.resize(self.size + n_halos, axis=0)
+            dataset[self.size :] = np.asarray(values)
+
+        self.size += n_halos
+        for field in self.fh:
+            dataset = self.fh[field]
+            if isinstance(dataset, h5py.Dataset) and dataset.shape[0] < self.size:
+                dataset.resize(self.size, axis=0)
+
+        self.fh.attrs["num_halos"] = self.size
+        self.fh.flush()
+
+    def close(self):
+        if self.fh:
+            self.fh.close()
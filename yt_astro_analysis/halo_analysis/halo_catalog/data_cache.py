@@ -0,0 +1,130 @@
+"""
+DataChunkCache class and member functions
+
+
+
+"""
+
+import copy
+from collections import OrderedDict
+
+from yt.funcs import mylog
+from yt.utilities.io_handler import BaseIOHandler
+
+
+class DataChunkCache:
+    r"""
+    A bounded, least-recently-used cache of field data read from a dataset.
+
+    While installed, data read by the dataset's io handler for each grid is
+    kept in memory so that later selections overlapping the same grids,
+    such as spheres around neighboring halos, do not read it again.  When
+    the cache is full, the least recently used data is dropped.
+
+    Only io handlers that read data one grid at a time through io_iter
+    can be cached.  For all others, installing the cache has no effect.
+    Caches may be nested as long as they are uninstalled in the reverse
+    order of installation.
+
+    Parameters
+    ----------
+    ds : dataset
+        The dataset whose reads are to be cached.
+    max_size : int
+        The maximum size of the cached data in bytes.
+
+    """
+
+    def __init__(self, ds, max_size):
+        self.ds = ds
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._io = None
+        self._previous = None
+
+    def install(self):
+        """
+        Start caching reads from the dataset.
+        """
+
+        io = self.ds.index.io
+        if type(io).io_iter is BaseIOHandler.io_iter:
+            mylog.debug("Data from %s cannot be cached.", self.ds)
+            return
+        # another cache may already be installed on the same io handler
+        self._previous = io.__dict__.get("io_iter")
+        self._io_iter = io.io_iter
+        io.io_iter = self.io_iter
+        self._io = io
+
+    def uninstall(self):
+        """
+        Stop caching and release all cached data.
+        """
+
+        if self._io is not None:
+            if self._previous is None:
+                del self._io.io_iter
+            else:
+                self._io.io_iter = self._previous
+            self._io = None
+            mylog.debug(
+                "Data cache for %s: %d hits, %d misses.",
+                self.ds,
+                self.hits,
+                self.misses,
+            )
+        self.clear()
+
+    def clear(self):
+        """
+        Release all cached data.
+        """
+
+        self._data.clear()
+        self.size = 0
+
+    def _add(self, key, data):
+        if key in self._data:
+            return
+        self._data[key] = data
+        if data is not None:
+            self.size += data.nbytes
+        while self.size > self.max_size and self._data:
+            _, old = self._data.popitem(last=False)
+            if old is not None:
+                self.size -= old.nbytes
+
+    def io_iter(self, chunks, fields):
+        for chunk in chunks:
+            data = {}
+            missing = []
+            for obj in chunk.objs:
+                keys = [(obj.id, field) for field in fields]
+                if all(key in self._data for key in keys):
+                    for key in keys:
+                        self._data.move_to_end(key)
+                        data[key] = self._data[key]
+                else:
+                    missing.append(obj)
+            self.hits += len(chunk.objs) - len(missing)
+            self.misses += len(missing)
+
+            if missing:
+                my_chunk = copy.copy(chunk)
+                my_chunk.objs = missing
+                for field, obj, values in self._io_iter([my_chunk], fields):
+                    if values is not None:
+                        values = values.copy()
+                    data[obj.id, field] = values
+                    self._add((obj.id, field), values)
+
+            # yield in the original order, which selections depend on
+            for obj in chunk.objs:
+                for field in fields:
+                    key = (obj.id, field)
+                    if key in data:
+                        yield field, obj, data[key]
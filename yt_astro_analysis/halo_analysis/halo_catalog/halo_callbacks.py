@@ -34,7 +34,14 @@ def _always_iterable(obj):
         return iter((obj,))
 
 
-def halo_sphere(halo, radius_field="virial_radius", factor=1.0, field_parameters=None):
+def halo_sphere(
+    halo,
+    radius_field="virial_radius",
+    factor=1.0,
+    field_parameters=None,
+    cache=False,
+    cache_size=256,
+):
     r"""
     Create a sphere data container to associate with a halo.
 
@@ -53,6 +60,19 @@ def halo_sphere(halo, radius_field="virial_radius", factor=1.0, field_parameters
     field_parameters : dict
         Dictionary of field parameters to be set with the sphere
         created.
+    cache : bool
+        If True, field data read for the sphere is kept in memory and
+        reused by all following callbacks, including those operating on
+        a recentered sphere overlapping the same grids.  The cached data
+        is released when the data_object attribute is removed with the
+        delete_attribute callback, and the cache is removed at the end of
+        the run, or after each halo of a lazily loaded halo list.  This
+        only has an effect for grid-based datasets.
+        Default: False.
+    cache_size : float
+        The maximum size in megabytes of cached data.  When full, the
+        least recently used data is dropped.
+        Default: 256.
 
     """
 
@@ -74,6 +94,8 @@ def halo_sphere(halo, radius_field="virial_radius", factor=1.0, field_parameters
             else:
                 value = par
             sphere.set_field_parameter(field, value)
+    if cache:
+        sphere.data_cache = halo.halo_catalog._get_sphere_cache(cache_size)
     halo.data_object = sphere
 
 
@@ -108,6 +130,8 @@ def sphere_field_max_recenter(halo, field):
     for par, value in old_sphere.field_parameters.items():
         if par not in new_sphere.field_parameters:
             new_sphere.set_field_parameter(par, value)
+    if hasattr(old_sphere, "data_cache"):
+        new_sphere.data_cache = old_sphere.data_cache
     halo.data_object = new_sphere
 
 
@@ -235,11 +259,20 @@ def profile(
         fractional=fractional,
     )
 
+    _store_profile(halo, my_profile, len(bin_fields), storage)
+
+
+add_callback("profile", profile, cacheable=True)
+
+
+def _store_profile(halo, my_profile, n_dims, storage):
+    "Add the data of a profile to the profile dictionaries of a halo."
+
     prof_store = {field: my_profile[field] for field in my_profile.field_data}
     prof_store[my_profile.x_field] = my_profile.x
-    if len(bin_fields) > 1:
+    if n_dims > 1:
         prof_store[my_profile.y_field] = my_profile.y
-    if len(bin_fields) > 2:
+    if n_dims > 2:
         prof_store[my_profile.z_field] = my_profile.z
     if hasattr(halo, storage):
         halo_store = getattr(halo, storage)
@@ -264,11 +297,140 @@ def profile(
         halo_variance_store.update(variance_store)
 
 
-add_callback("profile", profile)
+def multi_profile(
+    halo,
+    bin_fields,
+    profiles,
+    n_bins=32,
+    extrema=None,
+    logs=None,
+    units=None,
+    storage="profiles",
+):
+    r"""
+    Create several 1, 2, or 3D profiles of a halo with the same bins.
+
+    Each profile may have its own fields, weight field, and accumulation.
+    Profiles with the same weight field, accumulation, and fractional
+    settings are made together, with all of their fields binned in a
+    single pass over the data.  If the sphere of a grid-based dataset was
+    created with cache=True, its data is only read once for all profiles.
+    Profile data is stored in the same way as with the profile callback.
+
+    Parameters
+    ----------
+    halo : Halo object
+        The Halo object to be provided by the HaloCatalog.
+    bin_fields : list of strings
+        The binning fields for the profiles.
+    profiles : list of dicts
+        The profiles to be created.  Each is a dictionary with the key
+        "profile_fields", and optionally the keys "weight_field",
+        "accumulation", and "fractional", which have the same meanings and
+        defaults as the keywords of the profile callback.
+    n_bins : int or list of ints
+        The number of bins in each dimension.
+        Default: 32.
+    extrema : dict of min, max tuples
+        Minimum and maximum values of the bin_fields for the profiles.
+        The keys correspond to the field names.  If a units dict is
+        provided, extrema are understood to be in the units specified in
+        the dictionary.  Defaults to the extrema of the bin_fields within
+        the data container.
+    logs : dict of boolean values
+        Whether or not to log the bin_fields for the profiles.
+        The keys correspond to the field names. Defaults to the take_log
+        attribute of the field.
+    units : dict of strings
+        The units of the fields in the profiles, including the bin_fields.
+    storage : string
+        Name of the dictionary to store profiles.
+        Default: "profiles"
+
+    Examples
+    --------
+
+    >>> hc.add_callback(
+    ...     "multi_profile",
+    ...     ["radius"],
+    ...     [
+    ...         {
+    ...             "profile_fields": [("gas", "temperature")],
+    ...             "weight_field": ("gas", "mass"),
+    ...         },
+    ...         {
+    ...             "profile_fields": [("gas", "overdensity")],
+    ...             "weight_field": ("index", "cell_volume"),
+    ...             "accumulation": True,
+    ...         },
+    ...     ],
+    ... )
+
+    """
+
+    mylog.info(
+        "Calculating %d profiles for halo %d.",
+        len(profiles),
+        halo.quantities["particle_identifier"],
+    )
+
+    dds = halo.halo_catalog.data_ds
+
+    if dds is None:
+        raise RuntimeError("Profile callback requires a data ds.")
+
+    if not hasattr(halo, "data_object"):
+        raise RuntimeError("Profile callback requires a data container.")
+
+    if halo.data_object is None:
+        mylog.info(
+            "Skipping halo %d since data_object is None.",
+            halo.quantities["particle_identifier"],
+        )
+        return
+
+    bin_fields = list(_always_iterable(bin_fields))
+
+    # profiles with the same settings are made together, with all of their
+    # fields binned in a single pass over the data
+    settings = []
+    for group in profiles:
+        my_settings = (
+            group.get("weight_field", "cell_mass"),
+            group.get("accumulation", False),
+            group.get("fractional", False),
+        )
+        fields = list(_always_iterable(group["profile_fields"]))
+        for other_settings, other_fields in settings:
+            if other_settings == my_settings:
+                other_fields.extend(f for f in fields if f not in other_fields)
+                break
+        else:
+            settings.append((my_settings, fields))
+
+    for (weight_field, accumulation, fractional), fields in settings:
+        my_profile = create_profile(
+            halo.data_object,
+            bin_fields,
+            fields,
+            n_bins=n_bins,
+            extrema=extrema,
+            logs=logs,
+            units=units,
+            weight_field=weight_field,
+            accumulation=accumulation,
+            fractional=fractional,
+        )
+        _store_profile(halo, my_profile, len(bin_fields), storage)
+
+
+add_callback("multi_profile", multi_profile, cacheable=True)
 
 
 @parallel_root_only
-def save_profiles(halo, storage="profiles", filename=None, output_dir="."):
+def save_profiles(
+    halo, storage="profiles", filename=None, output_dir=".", bundle=False
+):
     r"""
     Save profile data to disk.
 
@@ -288,6 +450,12 @@ def save_profiles(halo, storage="profiles", filename=None, output_dir="."):
         Name of directory where profile data will be written.  The full path will be
         the output_dir of the halo catalog concatenated with this directory.
         Default : "."
+    bundle : bool
+        If True, the profiles of all halos processed by each processor are
+        written to a single file, "<filename>.<rank>.h5", with the profiles
+        of each field stacked into one array.  These are read with
+        load_profiles using bundle=True.
+        Default: False
 
     """
 
@@ -296,6 +464,23 @@ def save_profiles(halo, storage="profiles", filename=None, output_dir="."):
 
     if filename is None:
         filename = storage
+
+    if bundle:
+        halo_id = int(halo.quantities["particle_identifier"])
+        variance_storage = f"{storage}_variance"
+        writer = halo.halo_catalog._get_profile_bundle(
+            _get_bundle_prefix(
+                halo.halo_catalog, storage, filename, output_dir, bundle=True
+            )
+        )
+        mylog.debug("Saving halo %d profile data to %s.", halo_id, writer.filename)
+        writer.write(
+            halo_id,
+            getattr(halo, storage),
+            variance=getattr(halo, variance_storage, None),
+        )
+        return
+
     output_file = os.path.join(
         halo.halo_catalog.output_dir,
         output_dir,
@@ -330,7 +515,24 @@ def save_profiles(halo, storage="profiles", filename=None, output_dir="."):
 add_callback("save_profiles", save_profiles)
 
 
-def load_profiles(halo, storage="profiles", fields=None, filename=None, output_dir="."):
+def _get_bundle_prefix(
+    halo_catalog, storage="profiles", filename=None, output_dir=".", bundle=False
+):
+    """
+    Return the prefix of the bundled profile files written by save_profiles
+    with these arguments, or None if profiles are not bundled.
+    """
+
+    if not bundle:
+        return None
+    if filename is None:
+        filename = storage
+    return os.path.join(halo_catalog.output_dir, output_dir, filename)
+
+
+def load_profiles(
+    halo, storage="profiles", fields=None, filename=None, output_dir=".", bundle=False
+):
     r"""
     Load profile data from disk.
 
@@ -353,11 +555,23 @@ def load_profiles(halo, storage="profiles", fields=None, filename=None, output_d
         Name of directory where profile data will be read.  The full path will be
         the output_dir of the halo catalog concatenated with this directory.
         Default : "."
+    bundle : bool
+        If True, read profiles written by save_profiles using bundle=True.
+        All bundled files are read together the first time this is called,
+        after which each halo's profiles are taken from memory.  For a
+        lazily loaded halo list, each halo's profiles are instead read
+        from its file when the halo is loaded.
+        Default: False
 
     """
 
     if filename is None:
         filename = storage
+
+    if bundle:
+        _load_bundled_profiles(halo, storage, fields, filename, output_dir)
+        return
+
     output_file = os.path.join(
         halo.halo_catalog.output_dir,
         output_dir,
@@ -405,6 +619,23 @@ def load_profiles(halo, storage="profiles", fields=None, filename=None, output_d
 add_callback("load_profiles", load_profiles)
 
 
+def _load_bundled_profiles(halo, storage, fields, filename, output_dir):
+    prefix = os.path.join(halo.halo_catalog.output_dir, output_dir, filename)
+    fields = None if fields is None else list(_always_iterable(fields))
+    halo_id = int(halo.quantities["particle_identifier"])
+    data = halo.halo_catalog._get_halo_profiles(prefix, halo_id, fields=fields)
+
+    for group, attr in (("profiles", storage), ("variance", f"{storage}_variance")):
+        my_profile = data[group]
+        if not my_profile:
+            continue
+        if fields is not None:
+            for field in fields:
+                if field not in my_profile:
+                    raise RuntimeError(f"{field} field not present in {prefix}.*.h5.")
+        setattr(halo, attr, my_profile)
+
+
 def virial_quantities(
     halo,
     fields,
@@ -517,7 +748,7 @@ def virial_quantities(
     halo.quantities.update(vquantities)
 
 
-add_callback("virial_quantities", virial_quantities)
+add_callback("virial_quantities", virial_quantities, cacheable=True)
 
 
 def phase_plot(halo, output_dir=".", phase_args=None, phase_kwargs=None):
@@ -574,6 +805,10 @@ def delete_attribute(halo, attribute):
     """
 
     if hasattr(halo, attribute):
+        # release field data cached for this halo's sphere
+        data_cache = getattr(getattr(halo, attribute), "data_cache", None)
+        if data_cache is not None:
+            data_cache.clear()
         delattr(halo, attribute)
 
 
@@ -587,6 +822,8 @@ def iterative_center_of_mass(
     outer_radius=1.0,
     step_ratio=0.9,
     units="pc",
+    in_memory=False,
+    particle_type="nbody",
 ):
     r"""
     Adjust halo position by iteratively recalculating the center of mass while
@@ -616,6 +853,15 @@ def iterative_center_of_mass(
     units : str
         The units for printing out the distance between the initial and final centers.
         Default : "pc"
+    in_memory : bool
+        If True, the masses and positions of gas and particles within the
+        starting sphere are read once and all smaller spheres are selected
+        from these in memory, accounting for periodic boundaries.  If False,
+        a new sphere is created and read for each step.
+        Default: False
+    particle_type : str
+        The type of the particles included in the center of mass.
+        Default: "nbody"
 
     """
     if inner_ratio <= 0.0 or inner_ratio >= 1.0:
@@ -626,6 +872,15 @@ def iterative_center_of_mass(
         raise RuntimeError(
             "iterative_center_of_mass: step_ratio must be between 0 and 1."
         )
+    field_info = halo.halo_catalog.data_ds.field_info
+    if ("gas", "mass") not in field_info and (
+        particle_type,
+        "particle_mass",
+    ) not in field_info:
+        raise RuntimeError(
+            "iterative_center_of_mass: data_ds has neither gas nor "
+            f"{particle_type} particles with mass."
+        )
 
     center_orig = halo.halo_catalog.data_ds.arr(
         [halo.quantities[f"particle_position_{axis}"] for axis in "xyz"]
@@ -634,9 +889,20 @@ def iterative_center_of_mass(
         center_orig, outer_radius * halo.quantities[radius_field]
     )
 
-    while sphere.radius > inner_ratio * halo.quantities[radius_field]:
-        new_center = sphere.quantities.center_of_mass(use_gas=True, use_particles=True)
-        sphere = sphere.ds.sphere(new_center, step_ratio * sphere.radius)
+    if in_memory:
+        new_center = _shrinking_sphere_center(
+            sphere,
+            inner_ratio * halo.quantities[radius_field],
+            step_ratio,
+            particle_type,
+        )
+    else:
+        while sphere.radius > inner_ratio * halo.quantities[radius_field]:
+            new_center = sphere.quantities.center_of_mass(
+                use_gas=True, use_particles=True, particle_type=particle_type
+            )
+            sphere = sphere.ds.sphere(new_center, step_ratio * sphere.radius)
+        new_center = sphere.center
 
     distance = periodic_distance(
         center_orig.in_units("code_length").to_ndarray(),
@@ -651,11 +917,85 @@ def iterative_center_of_mass(
     )
 
     for i, axis in enumerate("xyz"):
-        halo.quantities[f"particle_position_{axis}"] = sphere.center[i]
+        halo.quantities[f"particle_position_{axis}"] = new_center[i]
     del sphere
 
 
-add_callback("iterative_center_of_mass", iterative_center_of_mass)
+add_callback("iterative_center_of_mass", iterative_center_of_mass, cacheable=True)
+
+
+def _read_mass_positions(sphere, particle_type):
+    "Return the positions and masses of gas and particles in a sphere."
+
+    ds = sphere.ds
+    positions = []
+    masses = []
+    if ("gas", "mass") in ds.field_info:
+        positions.append([sphere["gas", ax].to_value("code_length") for ax in "xyz"])
+        masses.append(sphere["gas", "mass"].to_value("g"))
+    if (particle_type, "particle_mass") in ds.field_info:
+        positions.append(
+            [
+                sphere[particle_type, f"particle_position_{ax}"].to_value("code_length")
+                for ax in "xyz"
+            ]
+        )
+        masses.append(sphere[particle_type, "particle_mass"].to_value("g"))
+    return np.concatenate(positions, axis=1).T, np.concatenate(masses)
+
+
+def _shrinking_sphere_center(sphere, inner_radius, step_ratio, particle_type):
+    """
+    Return the center of mass of gas and particles of particle_type within
+    a sphere shrunk by step_ratio until it reaches inner_radius.
+
+    Data is read once for the starting sphere and each smaller sphere is
+    selected from it in memory.  Data is only read again if a sphere moves
+    outside of the region already read.
+    """
+
+    ds = sphere.ds
+    left_edge = ds.domain_left_edge.to_value("code_length")
+    width = ds.domain_width.to_value("code_length")
+    periodic = np.asarray(ds.periodicity, dtype=bool)
+
+    def _offsets(positions, center):
+        # offsets to the nearest periodic image
+        offsets = positions - center
+        offsets[..., periodic] -= width[periodic] * np.round(
+            offsets[..., periodic] / width[periodic]
+        )
+        return offsets
+
+    center = sphere.center.to_value("code_length")
+    radius = sphere.radius.to_value("code_length")
+    inner_radius = inner_radius.to_value("code_length")
+    positions, masses = _read_mass_positions(sphere, particle_type)
+    read_center = center
+    read_radius = radius
+
+    while radius > inner_radius:
+        if np.sqrt((_offsets(center, read_center) ** 2).sum()) + radius > read_radius:
+            sphere = ds.sphere(
+                ds.arr(center, "code_length"), ds.quan(radius, "code_length")
+            )
+            positions, masses = _read_mass_positions(sphere, particle_type)
+            read_center = center
+            read_radius = radius
+
+        offsets = _offsets(positions, center)
+        inside = (offsets**2).sum(axis=1) <= radius**2
+        total = masses[inside].sum()
+        if total <= 0:
+            break
+        center = center + (offsets[inside] * masses[inside, None]).sum(axis=0) / total
+        center[periodic] = (
+            left_edge[periodic]
+            + (center[periodic] - left_edge[periodic]) % width[periodic]
+        )
+        radius *= step_ratio
+
+    return ds.arr(center, "code_length")
 
 
 def periodic_distance(coord1, coord2):
@@ -5,15 +5,22 @@ HaloCatalog class and member functions
 
 """
 
-import functools
+import glob
+import multiprocessing
 import os
+import pickle
+import time
+import warnings
+from multiprocessing.util import Finalize
 
 import numpy as np
 from unyt import unyt_array
 
+from yt.data_objects.static_output import Dataset
 from yt.data_objects.time_series import DatasetSeries
-from yt.frontends.ytdata.utilities import save_as_dataset
+from yt.frontends.ytdata.utilities import _hdf5_yt_array, save_as_dataset
 from yt.funcs import ensure_dir, mylog
+from yt.utilities.on_demand_imports import _h5py as h5py
 from yt.utilities.parallel_tools.parallel_analysis_interface import (
     ParallelAnalysisInterface,
     parallel_blocking_call,
@@ -22,10 +29,40 @@ from yt.utilities.parallel_tools.parallel_analysis_interface import (
 from yt_astro_analysis.halo_analysis.halo_catalog.analysis_pipeline import (
     AnalysisPipeline,
 )
+from yt_astro_analysis.halo_analysis.halo_catalog.catalog_columns import (
+    CatalogColumns,
+)
+from yt_astro_analysis.halo_analysis.halo_catalog.catalog_writer import CatalogWriter
+from yt_astro_analysis.halo_analysis.halo_catalog.data_cache import DataChunkCache
+from yt_astro_analysis.halo_analysis.halo_catalog.halo_callbacks import (
+    _get_bundle_prefix,
+    save_profiles,
+)
 from yt_astro_analysis.halo_analysis.halo_catalog.halo_finding_methods import (
     finding_method_registry,
 )
-from yt_astro_analysis.halo_analysis.halo_catalog.halo_object import Halo
+from yt_astro_analysis.halo_analysis.halo_catalog.halo_object import (
+    Halo,
+    HaloBatch,
+    LazyHaloList,
+)
+from yt_astro_analysis.halo_analysis.halo_catalog.pipeline_profile import (
+    PipelineProfile,
+)
+from yt_astro_analysis.halo_analysis.halo_catalog.profile_bundle import (
+    ProfileBundle,
+    ProfileBundleReader,
+    read_profile_bundles,
+)
+from yt_astro_analysis.halo_analysis.halo_catalog.result_cache import ResultCache
+from yt_astro_analysis.halo_analysis.halo_catalog.scheduling import (
+    distribute_blocks,
+    lpt_blocks,
+    morton_keys,
+)
+from yt_astro_analysis.halo_analysis.halo_catalog.shared_memory import (
+    SharedFieldData,
+)
 from yt_astro_analysis.utilities.logging import quiet
 
 _default_fields = (
@@ -34,6 +71,11 @@ _default_fields = (
     + ["particle_velocity_" + ax for ax in "xyz"]
 )
 
+_parent_dict_deprecation = (
+    "The parent_dict attribute is deprecated.  Please use halo_parents, "
+    "a tuple of arrays of halo ids and their parents sorted by id, instead."
+)
+
 
 class HaloCatalog(ParallelAnalysisInterface):
     r"""Create a HaloCatalog: an object that allows for the creation and association
@@ -150,6 +192,11 @@ class HaloCatalog(ParallelAnalysisInterface):
             finder_method = finding_method_registry.find(finder_method, **finder_kwargs)
         self.finder_method = finder_method
 
+        self._profile_bundles = {}
+        self._profile_data = {}
+        self._lazy = False
+        self._sphere_cache = None
+
         self._add_default_quantities()
 
     def _add_default_quantities(self):
@@ -197,10 +244,209 @@ class HaloCatalog(ParallelAnalysisInterface):
     def output_dir(self):
         return os.path.join(self.output_basedir, self.output_basename)
 
-    def _yield_halos(self, njobs="auto", dynamic=False):
+    @property
+    def parent_dict(self):
+        """
+        Deprecated, use halo_parents instead.  A dictionary of the parent
+        of each halo id, set by the not_subhalo filter.
+        """
+        ids, parents = self.halo_parents
+        warnings.warn(_parent_dict_deprecation, DeprecationWarning, stacklevel=2)
+        return dict(zip(ids.tolist(), parents.tolist()))
+
+    @parent_dict.setter
+    def parent_dict(self, parent_dict):
+        warnings.warn(_parent_dict_deprecation, DeprecationWarning, stacklevel=2)
+        ids = np.fromiter(parent_dict.keys(), dtype=np.int64, count=len(parent_dict))
+        parents = np.fromiter(
+            parent_dict.values(), dtype=np.int64, count=len(parent_dict)
+        )
+        order = np.argsort(ids)
+        self.halo_parents = (ids[order], parents[order])
+
+    def _get_output_filename(self, rank=None):
+        if rank is None:
+            rank = self.comm.rank
+        return os.path.join(self.output_dir, f"{self.output_basename}.{rank}.h5")
+
+    def _get_profile_bundle(self, filename):
+        "Return the bundled profile file written by this process."
+
+        pid = os.getpid()
+        bundle = self._profile_bundles.get((filename, pid))
+        if bundle is None:
+            if _pool_worker is None:
+                suffix = f"{self.comm.rank}"
+            else:
+                # each worker of the process backend writes its own file
+                suffix = f"{self.comm.rank}.{_pool_worker}"
+            ensure_dir(os.path.dirname(filename))
+            # files left by earlier runs were removed by _prepare_profile_bundles
+            bundle = ProfileBundle(f"{filename}.{suffix}.h5", mode="a")
+            self._profile_bundles[filename, pid] = bundle
+            if _pool_worker is not None:
+                # workers are only shut down after their last halo
+                Finalize(bundle, bundle.close, exitpriority=10)
+        return bundle
+
+    def _get_profile_bundle_prefixes(self):
+        "Return the prefixes of all bundled profile files written by the pipeline."
+
+        prefixes = []
+        for action_type, action in self.pipeline.actions:
+            if action_type != "callback" or action.function is not save_profiles:
+                continue
+            prefix = _get_bundle_prefix(self, *action.args, **action.kwargs)
+            if prefix is not None and prefix not in prefixes:
+                prefixes.append(prefix)
+        return prefixes
+
+    def _prepare_profile_bundles(self, skip_ids=None):
+        """
+        Remove bundled profile files left by an earlier run.
+
+        When restarting from a checkpoint, the profiles of halos already
+        processed are kept and all others removed, since they will be
+        written again.
+        """
+
+        if self.comm.rank == 0:
+            for prefix in self._get_profile_bundle_prefixes():
+                for filename in glob.glob(f"{glob.escape(prefix)}.*.h5"):
+                    if skip_ids is None or skip_ids.size == 0:
+                        os.remove(filename)
+                        continue
+                    bundle = ProfileBundle(filename, mode="a")
+                    bundle.keep(skip_ids)
+                    bundle.close()
+        self.comm.barrier()
+
+    def _flush_profile_bundles(self):
+        "Write all bundled profiles held in memory by this process."
+
+        pid = os.getpid()
+        for (_, my_pid), bundle in self._profile_bundles.items():
+            if my_pid == pid:
+                bundle.flush()
+
+    def _get_halo_profiles(self, filename, halo_id, fields=None):
+        """
+        Return the bundled profiles of one halo, in the form of the data
+        returned by read_profile_bundles.
+
+        All files with a given prefix are read once per run.  For a lazily
+        loaded halo list, only the halo ids are read once and the profiles
+        of each halo are read when it is loaded, so they are only kept in
+        memory along with the halo.
+        """
+
+        if fields is not None:
+            fields = tuple(fields)
+        key = (filename, None if self._lazy else fields)
+        if key not in self._profile_data:
+            filenames = sorted(glob.glob(f"{glob.escape(filename)}.*.h5"))
+            if not filenames:
+                raise RuntimeError(f"Profile files not found: {filename}.*.h5.")
+            if self._lazy:
+                data = ProfileBundleReader(filenames, ds=self.halos_ds)
+            else:
+                data = read_profile_bundles(filenames, fields=fields, ds=self.halos_ds)
+            self._profile_data[key] = data
+
+        if self._lazy:
+            data = self._profile_data[key].read(halo_id, fields=fields)
+        else:
+            index, all_data = self._profile_data[key]
+            row = index.get(halo_id)
+            if row is None:
+                data = None
+            else:
+                data = {
+                    group: {
+                        field: values[row].copy() for field, values in my_data.items()
+                    }
+                    for group, my_data in all_data.items()
+                }
+        if data is None:
+            raise RuntimeError(f"Halo {halo_id} not present in {filename}.*.h5.")
+        return data
+
+    def _get_sphere_cache(self, size):
+        """
+        Return the cache of data read for halo spheres, installing it if
+        needed.  It is uninstalled by _release_sphere_cache at the end of
+        each run and after each halo of a lazily loaded halo list.
+        """
+
+        if self._sphere_cache is None:
+            self._sphere_cache = DataChunkCache(self.data_ds, size * 2**20)
+            self._sphere_cache.install()
+        return self._sphere_cache
+
+    def _close_profile_bundles(self):
+        for bundle in self._profile_bundles.values():
+            bundle.close()
+        self._profile_bundles = {}
+        self._profile_data = {}
+
+    def _get_halo_id(self, halo):
+        return int(halo._get_field_value((self.halo_field_type, self._id_field)))
+
+    def _get_halo_ids(self, target):
+        "Return the ids of a halo or the halos of a batch as a list."
+        ids = target._get_field_value((self.halo_field_type, self._id_field))
+        return np.atleast_1d(ids.d).astype(np.int64).tolist()
+
+    def _yield_halos(
+        self,
+        njobs="auto",
+        dynamic=False,
+        batch=False,
+        skip_ids=None,
+        shared_memory=False,
+        save_halos=False,
+        order=None,
+        nprocs=None,
+        catalog=None,
+    ):
+        """
+        Run the analysis pipeline on halos, yielding each halo and whether
+        it passed all filters.
+
+        If batch is True, the leading column quantities and vectorized
+        filters are applied to each chunk as a whole and only halos that
+        survive them are distributed for further analysis.  Halos whose
+        ids are in skip_ids are not yielded.
+
+        If shared_memory is True, chunk data is broadcast into memory
+        shared by all processes on a node.  The shared memory is released
+        once all halos in the chunk are done, so chunk data is copied to
+        each process first if save_halos is True.
+
+        If order is "spatial", the halos of each chunk are sorted along a
+        Morton curve and each job is given a contiguous range of them.  If
+        order is "cost", halos are handed out in order of decreasing
+        estimated cost, with static jobs given sets of nearly equal total
+        cost.
+
+        If nprocs is set, halos are analyzed by a pool of that many local
+        processes instead of being distributed with parallel_objects.
+
+        If catalog is given, the quantities of each halo are written to
+        the next row of the catalog, which the caller adds with add_row.
+        If the batch applied all actions and save_halos is False, the
+        halos of a chunk given to this process are instead yielded
+        together as a HaloBatch, whose quantities can be added to the
+        catalog at once.
+        """
+
         my_size = self.comm.size
 
-        if njobs == "auto":
+        if nprocs is not None:
+            # the pool hands out halos to free workers like a task queue
+            my_dynamic = True
+            my_njobs = -1
+        elif njobs == "auto":
             # use task queue if odd number of cores more than 2
             my_dynamic = my_size > 2 and my_size % 2
             my_njobs = -1
@@ -208,25 +454,430 @@ class HaloCatalog(ParallelAnalysisInterface):
             my_dynamic = dynamic
             my_njobs = njobs
 
-        for chunk in self.data_source.chunks([], "io"):
-            if self.comm.rank == 0:
-                chunk.get_data(self.pipeline.field_quantities)
+        if shared_memory and my_size > 1:
+            shared = SharedFieldData(self.comm.comm)
+        else:
+            shared = None
+
+        if order == "spatial":
+            order_fields = [
+                (self.halo_field_type, f"particle_position_{axis}") for axis in "xyz"
+            ]
+        elif order == "cost":
+            order_fields = [self._get_cost_field()]
+        elif order is None:
+            order_fields = []
+        else:
+            raise RuntimeError(f"Invalid halo order: {order}.")
 
-            if my_size > 1:
-                fdata = self.comm.comm.bcast(chunk.field_data, root=0)
-                chunk.field_data.update(fdata)
+        n_blocks = my_size if my_njobs <= 0 else my_njobs
+        self._estimated_loads = np.zeros(n_blocks)
+        self._busy_time = {}
 
-            target_indices = range(chunk[self.halo_field_type, self._id_field].size)
-            my_indices = parallel_objects(
-                target_indices, njobs=my_njobs, dynamic=my_dynamic
+        if nprocs is None:
+            pool = None
+        else:
+            # workers are forked before chunks are read and find each
+            # chunk themselves
+            pool = _start_pool(self, nprocs, save_halos)
+
+        try:
+            chunks = self.data_source.chunks([], "io")
+            for chunk_id, chunk in enumerate(chunks):
+                if self.comm.rank == 0:
+                    chunk.get_data(self.pipeline.field_quantities + order_fields)
+
+                if shared is not None:
+                    fdata = shared.bcast(chunk.field_data)
+                    chunk.field_data.update(fdata)
+                elif my_size > 1:
+                    fdata = self.comm.comm.bcast(chunk.field_data, root=0)
+                    chunk.field_data.update(fdata)
+
+                halo_ids = chunk[self.halo_field_type, self._id_field]
+                if skip_ids is None:
+                    halo_indices = np.arange(halo_ids.size)
+                else:
+                    halo_indices = np.flatnonzero(
+                        ~np.isin(halo_ids.d.astype(np.int64), skip_ids)
+                    )
+
+                if batch:
+                    halo_batch = HaloBatch(self, chunk, halo_indices)
+                    start = self.pipeline._process_batch(halo_batch)
+                    target_indices = range(halo_batch.indices.size)
+                    chunk_indices = halo_batch.indices
+                else:
+                    halo_batch = None
+                    start = 0
+                    target_indices = halo_indices
+                    chunk_indices = halo_indices
+
+                if order == "spatial":
+                    positions = np.stack(
+                        [
+                            chunk[field].to_value("code_length")
+                            for field in order_fields
+                        ],
+                        axis=1,
+                    )
+                    keys = morton_keys(
+                        positions[chunk_indices],
+                        self.halos_ds.domain_left_edge.to_value("code_length"),
+                        self.halos_ds.domain_right_edge.to_value("code_length"),
+                    )
+                    target_indices = np.asarray(target_indices)[
+                        np.argsort(keys, kind="stable")
+                    ]
+                    if not my_dynamic:
+                        target_indices = distribute_blocks(
+                            np.array_split(target_indices, n_blocks)
+                        )
+
+                elif order == "cost":
+                    costs = self._get_halo_costs(chunk, order_fields[0])[chunk_indices]
+                    target_indices = np.asarray(target_indices)
+                    if my_dynamic:
+                        target_indices = target_indices[
+                            np.argsort(-costs, kind="stable")
+                        ]
+                    else:
+                        blocks, self._estimated_loads = lpt_blocks(
+                            costs, n_blocks, loads=self._estimated_loads
+                        )
+                        target_indices = distribute_blocks(
+                            [target_indices[block] for block in blocks]
+                        )
+
+                if nprocs is not None:
+                    if order == "spatial":
+                        # give workers runs of neighboring halos
+                        chunksize = max(1, len(target_indices) // (4 * nprocs))
+                    else:
+                        chunksize = 1
+                    yield from self._process_pool(
+                        pool,
+                        chunk_id,
+                        chunk,
+                        halo_batch,
+                        start,
+                        target_indices,
+                        chunksize=chunksize,
+                        save_halos=save_halos,
+                        catalog=catalog,
+                    )
+                    continue
+
+                my_indices = parallel_objects(
+                    target_indices, njobs=my_njobs, dynamic=my_dynamic
+                )
+
+                if (
+                    catalog is not None
+                    and halo_batch is not None
+                    and not save_halos
+                    and start == len(self.pipeline.actions)
+                ):
+                    # nothing is left to do for each halo
+                    my_indices = [index for index in my_indices if index is not None]
+                    if my_indices:
+                        yield halo_batch._take(
+                            np.array(my_indices, dtype=np.int64)
+                        ), True
+                    my_indices = []
+
+                for my_index in my_indices:
+                    if my_index is None:
+                        continue
+                    my_halo = self._get_halo(chunk, halo_batch, my_index, catalog)
+                    start_time = time.perf_counter()
+                    rval = self.pipeline._process_target(my_halo, start=start)
+                    self._busy_time[self.comm.rank] = (
+                        self._busy_time.get(self.comm.rank, 0.0)
+                        + time.perf_counter()
+                        - start_time
+                    )
+                    yield my_halo, rval
+
+                if shared is not None:
+                    if save_halos:
+                        for field, values in chunk.field_data.items():
+                            chunk.field_data[field] = values.copy()
+                    shared.free()
+
+        except Exception:
+            if pool is not None:
+                pool.terminate()
+            raise
+
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            if shared is not None:
+                shared.close()
+
+    def _get_halo(self, chunk, halo_batch, index, catalog=None):
+        """
+        Return the halo at an index of a chunk or, if halo_batch is not
+        None, of the halos remaining in the batch.  If catalog is not
+        None, the quantities of the halo are the next row of the catalog.
+        """
+
+        if halo_batch is None:
+            my_halo = Halo(self, chunk, index)
+        else:
+            my_halo = Halo(self, chunk, halo_batch.indices[index])
+        if catalog is not None:
+            my_halo.quantities = catalog.new_row()
+        if halo_batch is not None:
+            my_halo.quantities.update(
+                {key: value[index] for key, value in halo_batch.quantities.items()}
             )
+        return my_halo
 
-            for my_index in my_indices:
-                my_halo = Halo(self, chunk, my_index)
-                yield my_halo
+    def _process_pool(
+        self,
+        pool,
+        chunk_id,
+        chunk,
+        halo_batch,
+        start,
+        target_indices,
+        chunksize=1,
+        save_halos=False,
+        catalog=None,
+    ):
+        """
+        Run the analysis pipeline on halos of a chunk with a pool of local
+        processes, yielding each halo and whether it passed all filters in
+        the order given.
+
+        Each halo is sent to the workers with the number of its chunk and
+        any quantities computed for it in batch.  Halo quantities and, if
+        save_halos is True, all other attributes that can be pickled are
+        returned to this process.
+        """
+
+        targets = [index for index in target_indices if index is not None]
+        tasks = []
+        for index in targets:
+            if halo_batch is None:
+                tasks.append((chunk_id, index, start, None))
+                continue
+            quantities = {
+                key: value[index] for key, value in halo_batch.quantities.items()
+            }
+            tasks.append(
+                (
+                    chunk_id,
+                    halo_batch.indices[index],
+                    start,
+                    _pack_quantities(self, quantities),
+                )
+            )
+
+        results = pool.imap(_process_pool_target, tasks, chunksize=chunksize)
+        for my_index, result in zip(targets, results):
+            rval, state, pid, busy_time, stats = result
+            my_halo = self._get_halo(chunk, halo_batch, my_index, catalog)
+            if state is not None:
+                state = pickle.loads(state)
+                my_halo.quantities.update(_unpack_quantities(self, state["quantities"]))
+                if "extra" in state:
+                    my_halo.extra.update(state["extra"])
+            self._busy_time[pid] = self._busy_time.get(pid, 0.0) + busy_time
+            if stats is not None:
+                self.pipeline.profile._add_stats(stats)
+            yield my_halo, rval
+
+    def _get_cost_field(self):
+        "Return the field used to estimate the cost of analyzing each halo."
+
+        for fname in ("particle_mass", "virial_radius"):
+            field = (self.halo_field_type, fname)
+            if field in self.halos_ds.derived_field_list:
+                return field
+        raise RuntimeError(
+            "Ordering halos by cost requires a particle_mass or virial_radius field."
+        )
+
+    def _get_halo_costs(self, chunk, field):
+        """
+        Estimate the relative cost of analyzing each halo in a chunk.
+
+        The cost is taken to scale with the amount of data within a halo,
+        which is proportional to its mass or its volume.
+        """
+
+        values = chunk[field].d.astype(np.float64)
+        if field[1] == "virial_radius":
+            values = values**3
+        return values
+
+    def _report_balance(self):
+        "Log the estimated and measured balance of work between processors."
+
+        loads = self._estimated_loads
+        if loads.size > 1 and loads.sum() > 0:
+            mylog.info(
+                "Estimated load balance (max / mean cost per job): %.3f.",
+                loads.max() / loads.mean(),
+            )
+
+        times = np.array(
+            self.comm.par_combine_object(
+                list(self._busy_time.values()), datatype="list", op="cat"
+            )
+        )
+        # processors serving a task queue do no analysis
+        times = times[times > 0]
+        if times.size > 1:
+            mylog.info(
+                "Measured load balance (max / mean analysis time): %.3f "
+                "(min: %.2f s, max: %.2f s).",
+                times.max() / times.mean(),
+                times.min(),
+                times.max(),
+            )
+
+    def _start_checkpoint(self):
+        """
+        Set up checkpointing of the catalog for this process.
+
+        If catalog files containing checkpoint data from a previous run
+        exist, the ids of all halos already processed are returned so they
+        can be skipped.  Halos saved by this process are reloaded into the
+        catalog.  Halos saved by processes that no longer exist are taken
+        over by the root process.
+        """
+
+        prefix = os.path.join(self.output_dir, self.output_basename)
+        my_filename = self._get_output_filename()
+
+        processed_ids = [np.empty(0, dtype=np.int64)]
+        resume = False
+        orphans = []
+        for filename in glob.glob(f"{prefix}.*.h5"):
+            rank = filename[len(prefix) + 1 : -3]
+            if not rank.isdigit():
+                continue
+
+            with h5py.File(filename, mode="r") as fh:
+                if "checkpoint" not in fh:
+                    continue
+                processed_ids.append(fh["checkpoint/processed_ids"][()])
+
+            if filename == my_filename:
+                resume = True
+            elif self.comm.rank == 0 and int(rank) >= self.comm.size:
+                orphans.append(filename)
+
+        processed_ids = np.concatenate(processed_ids)
+        if processed_ids.size > 0:
+            mylog.info(
+                "Resuming from checkpoint with %d halos already processed.",
+                processed_ids.size,
+            )
+
+        if resume:
+            self._read_checkpoint(my_filename)
+        self._checkpoint_written = len(self.catalog)
+        self._checkpoint_ids = []
+
+        # wait for all processes to read checkpoints before writing any
+        self.comm.barrier()
+
+        ensure_dir(self.output_dir)
+        mode = "a" if resume else "w"
+        writer = CatalogWriter(my_filename, self.source_ds, mode=mode)
+        if "checkpoint" not in writer.fh:
+            writer.fh.create_dataset(
+                "checkpoint/processed_ids",
+                shape=(0,),
+                maxshape=(None,),
+                dtype=np.int64,
+                chunks=True,
+            )
+        self._checkpoint_writer = writer
+
+        if orphans:
+            for filename in orphans:
+                self._checkpoint_ids.extend(self._read_checkpoint(filename))
+            self._write_checkpoint()
+            for filename in orphans:
+                os.remove(filename)
+
+        return processed_ids
+
+    def _read_checkpoint(self, filename):
+        "Add halos from a checkpoint file to the catalog and return processed ids."
+
+        data = {}
+        with h5py.File(filename, mode="r") as fh:
+            for field in fh:
+                if not isinstance(fh[field], h5py.Dataset):
+                    continue
+                # fields saved without units were not unyt arrays
+                if fh[field].attrs.get("units", "") == "":
+                    data[field] = fh[field][()]
+                else:
+                    data[field] = _hdf5_yt_array(fh, field, ds=self.halos_ds)
+            processed_ids = fh["checkpoint/processed_ids"][()].tolist()
+
+        self.catalog.extend(data)
+        return processed_ids
+
+    def _write_checkpoint(self):
+        "Write halos processed since the last checkpoint."
+
+        writer = self._checkpoint_writer
+        data = self.catalog.to_dict(
+            [key for key in self.quantities if key in self.catalog]
+        )
+        writer.write(
+            {key: value[self._checkpoint_written :] for key, value in data.items()}
+        )
+        self._checkpoint_written = len(self.catalog)
+
+        dataset = writer.fh["checkpoint/processed_ids"]
+        n_ids = dataset.size
+        dataset.resize(n_ids + len(self._checkpoint_ids), axis=0)
+        dataset[n_ids:] = self._checkpoint_ids
+        self._checkpoint_ids = []
+        writer.fh.flush()
+        # profiles of the halos in the checkpoint must also be on disk
+        self._flush_profile_bundles()
+
+        mylog.info("Checkpoint: %d halos written to %s.", writer.size, writer.filename)
+
+    def _finish_checkpoint(self):
+        "Write remaining halos and remove checkpoint data, leaving the final catalog."
+
+        self._write_checkpoint()
+        writer = self._checkpoint_writer
+        del writer.fh["checkpoint"]
+        writer.close()
+        del self._checkpoint_writer
+        mylog.info("Saving %d halos: %s.", writer.size, writer.filename)
 
     @parallel_blocking_call
-    def _run(self, save_halos, save_catalog, njobs="auto", dynamic=False):
+    def _run(
+        self,
+        save_halos,
+        save_catalog,
+        njobs="auto",
+        dynamic=False,
+        batch=False,
+        checkpoint=None,
+        shared_memory=False,
+        order=None,
+        data_cache_size=256,
+        profile=False,
+        backend="mpi",
+        nprocs=None,
+        merge_output=False,
+    ):
         """
         Run analysis pipeline on all halos.
 
@@ -238,28 +889,333 @@ class HaloCatalog(ParallelAnalysisInterface):
             self.finder_method(self)
             return
 
+        nprocs = self._get_nprocs(backend, nprocs)
         self.pipeline._preprocess()
+        self._lazy = False
+        if profile:
+            self.pipeline.profile = PipelineProfile(self.pipeline.actions)
 
-        self.catalog = []
+        self.catalog = CatalogColumns()
         if save_halos:
             self.halo_list = []
 
-        for my_halo in self._yield_halos(njobs=njobs, dynamic=dynamic):
-            rval = self.pipeline._process_target(my_halo)
+        if checkpoint is None:
+            skip_ids = None
+        else:
+            if not save_catalog:
+                raise RuntimeError("Checkpointing requires the catalog to be saved.")
+            skip_ids = self._start_checkpoint()
+
+        self._prepare_profile_bundles(skip_ids)
+
+        data_cache = self._install_data_cache(order, data_cache_size)
+
+        try:
+            for my_halo, rval in self._yield_halos(
+                njobs=njobs,
+                dynamic=dynamic,
+                batch=batch,
+                skip_ids=skip_ids,
+                shared_memory=shared_memory,
+                save_halos=save_halos,
+                order=order,
+                nprocs=nprocs,
+                catalog=self.catalog,
+            ):
+                if isinstance(my_halo, HaloBatch):
+                    self.catalog.extend(my_halo.quantities)
+                elif rval:
+                    self.catalog.add_row(my_halo.quantities)
+
+                if checkpoint is not None:
+                    self._checkpoint_ids.extend(self._get_halo_ids(my_halo))
+                    if len(self._checkpoint_ids) >= checkpoint:
+                        self._write_checkpoint()
+
+                if save_halos and rval:
+                    self.halo_list.append(my_halo)
+                else:
+                    del my_halo
+
+        finally:
+            self._release_caches(data_cache)
+
+        if order == "cost":
+            self._report_balance()
+
+        merge = merge_output and self.comm.size > 1
+        if checkpoint is not None:
+            self._finish_checkpoint()
+            if merge:
+                self._save_merged()
+        elif save_catalog:
+            if merge:
+                self._save_merged()
+            else:
+                self._save()
 
-            if rval:
-                for quantity in my_halo.quantities.values():
-                    if hasattr(quantity, "units"):
-                        quantity.convert_to_base()
-                self.catalog.append(my_halo.quantities)
+        if profile:
+            self._report_profile()
 
-            if save_halos and rval:
-                self.halo_list.append(my_halo)
-            else:
-                del my_halo
+    def _get_nprocs(self, backend, nprocs):
+        "Check the backend and return the number of worker processes."
+
+        if backend == "mpi":
+            return None
+        if backend == "process":
+            if self.comm.size > 1:
+                raise RuntimeError(
+                    "The process backend cannot be used when running with MPI."
+                )
+            if nprocs is None:
+                nprocs = os.cpu_count()
+            return nprocs
+        raise RuntimeError(f"Invalid backend: {backend}.")
+
+    def _install_data_cache(self, order, data_cache_size):
+        "Start caching data read from data_ds if halos are spatially ordered."
+
+        if order != "spatial" or not isinstance(self.data_ds, Dataset):
+            return None
+        data_cache = DataChunkCache(self.data_ds, data_cache_size * 2**20)
+        data_cache.install()
+        return data_cache
+
+    def _release_sphere_cache(self):
+        if self._sphere_cache is not None:
+            self._sphere_cache.uninstall()
+            self._sphere_cache = None
+
+    def _release_caches(self, data_cache):
+        "Uninstall all data caches and close bundled profile files."
+
+        # uninstall in the reverse order of installation
+        self._release_sphere_cache()
+        if data_cache is not None:
+            data_cache.uninstall()
+        self._close_profile_bundles()
+
+        result_cache = self.pipeline.result_cache
+        if result_cache is not None:
+            mylog.info(
+                "Result cache: %d hits, %d misses.",
+                result_cache.hits,
+                result_cache.misses,
+            )
+
+    def iterate(
+        self,
+        quantities_only=False,
+        save_output=False,
+        flush_size=1000,
+        njobs="auto",
+        dynamic=False,
+        batch=False,
+        order=None,
+        data_cache_size=256,
+        backend="mpi",
+        nprocs=None,
+    ):
+        r"""
+        Run the analysis pipeline, yielding each halo passing all filters as
+        soon as its analysis is finished.
+
+        Unlike create, neither the halos nor the catalog are kept in memory,
+        so halos can be streamed through callbacks in bounded memory.  If
+        the loop is stopped early, the halos finished so far are still
+        saved.  With MPI, each process yields the halos it analyzes.
+
+        Parameters
+        ----------
+        quantities_only : bool
+            If True, yield the dictionary of quantities of each halo instead
+            of the Halo object.
+            Default: False
+        save_output : bool
+            If True, the quantities of all halos are also written to the
+            catalog file in the output directory in batches of flush_size
+            halos.
+            Default: False
+        flush_size : int
+            The number of halos kept in memory before writing them to the
+            catalog file when save_output is True.
+            Default: 1000
+        njobs, dynamic, batch, order, data_cache_size, backend, nprocs
+            How halos are divided and analyzed.  See create for details.
+
+        Yields
+        ------
+        halo : Halo or dict
+            Each halo, or its quantities if quantities_only is True.
+
+        See Also
+        --------
+        create
+
+        Examples
+        --------
+
+        >>> hc = HaloCatalog(data_ds=data_ds, halos_ds=halos_ds)
+        >>> hc.add_filter("quantity_value", "particle_mass", ">", 1e14, "Msun")
+        >>> hc.add_callback("sphere")
+        >>> for halo in hc.iterate(save_output=True, flush_size=100):
+        ...     make_image(halo.data_object)
+
+        """
+
+        if self.halos_ds is None:
+            raise RuntimeError("Iterating over halos requires a halos_ds.")
+
+        nprocs = self._get_nprocs(backend, nprocs)
+        self.pipeline._preprocess()
+        self._lazy = False
+        self._prepare_profile_bundles()
+        data_cache = self._install_data_cache(order, data_cache_size)
+
+        if save_output:
+            ensure_dir(self.output_dir)
+            writer = CatalogWriter(self._get_output_filename(), self.source_ds)
+            buffer = CatalogColumns(capacity=flush_size)
+        else:
+            writer = None
+
+        try:
+            for my_halo, rval in self._yield_halos(
+                njobs=njobs,
+                dynamic=dynamic,
+                batch=batch,
+                save_halos=not quantities_only,
+                order=order,
+                nprocs=nprocs,
+            ):
+                if not rval:
+                    continue
+
+                if writer is not None:
+                    buffer.append(my_halo.quantities)
+                    if len(buffer) >= flush_size:
+                        self._flush(writer, buffer)
+
+                if quantities_only:
+                    yield my_halo.quantities
+                else:
+                    yield my_halo
+
+        finally:
+            if writer is not None:
+                self._flush(writer, buffer)
+                writer.close()
+                mylog.info("Saving %d halos: %s.", writer.size, writer.filename)
+            self._release_caches(data_cache)
+
+    def _flush(self, writer, buffer):
+        "Write buffered halos to a catalog file and empty the buffer."
+
+        if len(buffer) == 0:
+            return
+        writer.write(buffer.to_dict([key for key in self.quantities if key in buffer]))
+        buffer.clear()
+
+    def _report_profile(self):
+        "Combine pipeline statistics from all processors and report them."
+
+        profile = self.pipeline.profile
+        self.pipeline.profile = None
+        profile.combine(self.comm)
+        self.pipeline_profile = profile
 
-        if save_catalog:
-            self._save()
+        if self.comm.rank == 0:
+            filename = os.path.join(
+                ensure_dir(self.output_dir), "pipeline_profile.json"
+            )
+            profile.save(filename)
+            mylog.info("Analysis pipeline profile:\n%s", profile)
+            mylog.info("Saving pipeline profile: %s.", filename)
+
+    def _save_merged(self):
+        """
+        Save the halos of all processors to a single catalog file.
+
+        If h5py was built with parallel HDF5, all processors write their
+        halos to the file collectively.  Otherwise, the sizes and layout
+        of all catalogs are gathered first and the root process then
+        receives and writes the halos of each processor in turn.
+        """
+
+        ensure_dir(self.output_dir)
+        filename = self._get_output_filename(rank=0)
+
+        if len(self.catalog) > 0:
+            data = self.catalog.to_dict(self.quantities)
+        else:
+            data = {}
+        layout = {
+            key: (values.dtype.str, values.shape[1:], str(getattr(values, "units", "")))
+            for key, values in data.items()
+        }
+        all_layouts = self.comm.comm.allgather((len(self.catalog), layout))
+
+        if h5py.get_config().mpi:
+            self._write_collective(filename, data, all_layouts)
+        else:
+            self._write_gathered(filename, data)
+
+        # remove files from individual processors, such as checkpoints
+        my_filename = self._get_output_filename()
+        if self.comm.rank > 0 and os.path.exists(my_filename):
+            os.remove(my_filename)
+        self.comm.barrier()
+
+        n_halos = sum(n for n, _ in all_layouts)
+        mylog.info("Saving %d halos: %s.", n_halos, filename)
+
+    def _write_collective(self, filename, data, all_layouts):
+        "Write the halos of all processors to one file with parallel HDF5."
+
+        counts = [n for n, _ in all_layouts]
+        n_halos = sum(counts)
+        offset = sum(counts[: self.comm.rank])
+        layout = {}
+        for _, my_layout in all_layouts:
+            for key, value in my_layout.items():
+                layout.setdefault(key, value)
+
+        if self.comm.rank == 0:
+            extra_attrs = {"data_type": "halo_catalog", "num_halos": n_halos}
+            with quiet():
+                save_as_dataset(self.source_ds, filename, {}, extra_attrs=extra_attrs)
+        self.comm.barrier()
+
+        comm = self.comm.comm
+        with h5py.File(filename, mode="r+", driver="mpio", comm=comm) as fh:
+            # datasets must be created in the same order on all processors
+            for key in self.quantities:
+                if key not in layout:
+                    continue
+                dtype, shape, units = layout[key]
+                dataset = fh.create_dataset(
+                    key, shape=(n_halos,) + tuple(shape), dtype=dtype
+                )
+                dataset.attrs["units"] = units
+                if key not in data:
+                    continue
+                values = data[key]
+                if units and str(values.units) != units:
+                    values = values.to(units)
+                dataset[offset : offset + values.shape[0]] = np.asarray(values)
+
+    def _write_gathered(self, filename, data):
+        "Write the halos of all processors to one file from the root process."
+
+        comm = self.comm.comm
+        if self.comm.rank == 0:
+            writer = CatalogWriter(filename, self.source_ds)
+            writer.write(data)
+            for rank in range(1, self.comm.size):
+                writer.write(comm.recv(source=rank))
+            writer.close()
+        else:
+            comm.send(data, dest=0)
 
     def _save(self, ds=None, data=None, extra_attrs=None, field_types=None):
         "Save new halo catalog."
@@ -269,28 +1225,22 @@ class HaloCatalog(ParallelAnalysisInterface):
         else:
             self._source_ds = ds
 
-        data_dir = ensure_dir(self.output_dir)
-        filename = os.path.join(data_dir, f"{self.output_basename}.{self.comm.rank}.h5")
+        ensure_dir(self.output_dir)
+        filename = self._get_output_filename()
 
         if data is None:
             n_halos = len(self.catalog)
-            data = {}
             if n_halos > 0:
-                for key in self.quantities:
-                    if hasattr(self.catalog[0][key], "units"):
-                        registry = self.catalog[0][key].units.registry
-                        my_arr = functools.partial(unyt_array, registry=registry)
-                    else:
-                        my_arr = np.array
-
-                    data[key] = my_arr([halo[key] for halo in self.catalog])
+                data = self.catalog.to_dict(self.quantities)
+            else:
+                data = {}
         else:
             n_halos = data[self._id_field].size
 
         mylog.info("Saving %d halos: %s.", n_halos, filename)
 
         if field_types is None:
-            field_types = {key: "." for key in self.quantities}
+            field_types = dict.fromkeys(self.quantities, ".")
 
         if extra_attrs is None:
             extra_attrs = {}
@@ -302,7 +1252,23 @@ class HaloCatalog(ParallelAnalysisInterface):
                 ds, filename, data, field_types=field_types, extra_attrs=extra_attrs_d
             )
 
-    def create(self, save_halos=False, save_output=True, njobs="auto", dynamic=False):
+    def create(
+        self,
+        save_halos=False,
+        save_output=True,
+        njobs="auto",
+        dynamic=False,
+        batch=False,
+        checkpoint=None,
+        shared_memory=False,
+        order=None,
+        data_cache_size=256,
+        profile=False,
+        backend="mpi",
+        nprocs=None,
+        merge_output=False,
+        update=False,
+    ):
         r"""
         Create the halo catalog given the callbacks, quantities, and filters that
         have been provided.
@@ -315,12 +1281,19 @@ class HaloCatalog(ParallelAnalysisInterface):
         ----------
         save_halos : bool
             If True, a list of all Halo objects is retained under the "halo_list"
-            attribute.  If False, only the compiles quantities are saved under the
-            "catalog" attribute.
+            attribute.  If False, only the compiled quantities are saved under the
+            "catalog" attribute as a
+            :class:`~yt_astro_analysis.halo_analysis.halo_catalog.catalog_columns.CatalogColumns`.
             Default: False
         save_output : bool
             If True, save the final catalog to disk.
             Default: True
+        merge_output : bool
+            If True, the halos of all processors are saved to a single
+            catalog file instead of one file per processor.  The file is
+            written collectively if h5py was built with parallel HDF5 and
+            through the root process otherwise.
+            Default: False
         njobs : int
             The number of jobs over which to divide halo analysis. If set to "auto",
             use a task queue if total number of processors is an odd number and
@@ -331,6 +1304,73 @@ class HaloCatalog(ParallelAnalysisInterface):
             If True, parallelism is performed via a task queue. If njobs is set to
             "auto", behavior is controlled in the way described above.
             Default: False
+        batch : bool
+            If True, quantities taken from the halo dataset and vectorized
+            filters at the start of the pipeline are applied to all halos in
+            a chunk at once as array operations.  Only halos passing these
+            filters go on to the rest of the pipeline.
+            Default: False
+        checkpoint : int
+            If set, each process writes the halos it has completed to its
+            catalog file after every checkpoint halos have been processed.  If
+            the run is interrupted, calling create again with checkpoint set
+            resumes from the saved files, skipping halos already processed.
+            Default: None
+        shared_memory : bool
+            If True, halo data read by the root process is broadcast once to
+            each node into memory shared by all processes on that node,
+            instead of to each process individually.  This reduces the memory
+            used by the halo data when running many processes per node.
+            Requires MPI-3 shared memory support.
+            Default: False
+        order : str
+            The order in which halos are analyzed.  If None, halos are
+            analyzed in the order of the halo catalog.  If "spatial", halos
+            are sorted along a space-filling curve and each processor is
+            given a contiguous group of neighboring halos.  Data read from
+            data_ds is then kept in a cache so that neighboring halos
+            overlapping the same grids do not read them again.  If "cost",
+            the cost of analyzing each halo is estimated from its mass, or
+            its virial radius if no mass is available, and the most
+            expensive halos are analyzed first.  If halos are divided evenly
+            between processors, each receives halos of nearly equal total
+            cost.  The estimated and measured balance of work between
+            processors is reported at the end.
+            Default: None
+        data_cache_size : float
+            The maximum size in megabytes of the cache of data read from
+            data_ds on each processor when order is "spatial".
+            Default: 256
+        profile : bool
+            If True, record the number of calls, wall time, and increase in
+            peak memory of each callback, filter, and quantity, as well as
+            the number of halos passing each filter, summed over all
+            processors.  A summary is logged at the end of the run, saved to
+            "pipeline_profile.json" in the output directory, and kept in the
+            "pipeline_profile" attribute.
+            Default: False
+        backend : str
+            How halo analysis is run in parallel.  If "mpi", halos are divided
+            among MPI processes as set by njobs and dynamic.  If "process",
+            halos are handed out to a pool of local worker processes on a
+            single machine and the results are merged into one catalog.  This
+            does not require MPI and cannot be combined with it.
+            Default: "mpi"
+        nprocs : int
+            The number of worker processes for the "process" backend.  If
+            None, one per available core is used.
+            Default: None
+        update : bool
+            If True, halos_ds must be a catalog saved by a previous run and
+            only quantities missing from it are computed.  Quantities already
+            stored are read from halos_ds, and all other stored fields are
+            copied to the new catalog.  Callbacks are only performed if a
+            missing quantity is added after them, so callbacks that add
+            quantities themselves, such as those of the
+            calculate_virial_quantities recipe, are skipped.  Filters are
+            applied as usual.  The new catalog is written to the output
+            directory, leaving halos_ds unchanged.
+            Default: False
 
         See Also
         --------
@@ -338,9 +1378,56 @@ class HaloCatalog(ParallelAnalysisInterface):
 
         """
 
-        self._run(save_halos, save_output, njobs=njobs, dynamic=dynamic)
+        if update:
+            state = self._start_update()
+        try:
+            self._run(
+                save_halos,
+                save_output,
+                njobs=njobs,
+                dynamic=dynamic,
+                batch=batch,
+                checkpoint=checkpoint,
+                shared_memory=shared_memory,
+                order=order,
+                data_cache_size=data_cache_size,
+                profile=profile,
+                backend=backend,
+                nprocs=nprocs,
+                merge_output=merge_output,
+            )
+        finally:
+            if update:
+                self.pipeline._end_update(state)
 
-    def load(self, njobs="auto", dynamic=False):
+    def _start_update(self):
+        "Set up the pipeline to compute only quantities missing from halos_ds."
+
+        if self.halos_ds is None:
+            raise RuntimeError("Updating a catalog requires a halos_ds.")
+
+        field_type = self.halo_field_type
+        stored = [
+            field for ftype, field in self.halos_ds.field_list if ftype == field_type
+        ]
+        missing = [key for key in self.quantities if key not in stored]
+        mylog.info(
+            "Updating catalog with %d stored fields, computing %s.",
+            len(stored),
+            ", ".join(missing) if missing else "no new quantities",
+        )
+        return self.pipeline._start_update(stored, field_type)
+
+    def load(
+        self,
+        njobs="auto",
+        dynamic=False,
+        profile=False,
+        backend="mpi",
+        nprocs=None,
+        lazy=False,
+        cache_size=128,
+    ):
         r"""
         Load a previously created halo catalog.
 
@@ -361,14 +1448,149 @@ class HaloCatalog(ParallelAnalysisInterface):
             If True, parallelism is performed via a task queue. If njobs is set to
             "auto", behavior is controlled in the way described above.
             Default: False
+        profile : bool
+            If True, record timing and memory statistics for each callback,
+            filter, and quantity.  See create for details.
+            Default: False
+        backend : str
+            How halo analysis is run in parallel, either "mpi" or "process".
+            See create for details.
+            Default: "mpi"
+        nprocs : int
+            The number of worker processes for the "process" backend.  If
+            None, one per available core is used.
+            Default: None
+        lazy : bool
+            If True, only the leading quantities and filters that can be
+            applied to all halos at once are done now.  The halo_list
+            attribute is then a sequence whose halos are created, and have
+            the remaining callbacks, such as load_profiles, performed when
+            first accessed.  All filters must be vectorized and added before
+            any callbacks.  Each process loads every halo it accesses.
+            Default: False
+        cache_size : int
+            For lazy loading, the maximum number of halos kept in memory.
+            The least recently accessed halos are dropped first and loaded
+            again if accessed later.
+            Default: 128
 
         See Also
         --------
         create
 
+        Examples
+        --------
+
+        >>> hc = HaloCatalog(halos_ds=halos_ds, output_dir="halo_catalogs")
+        >>> hc.add_callback("load_profiles", output_dir="profiles")
+        >>> hc.load(lazy=True)
+        >>> halo = hc.halo_list[10]  # profiles are read here
+        >>> print(halo.profiles)
+
         """
 
-        self._run(True, False, njobs=njobs, dynamic=dynamic)
+        if lazy:
+            self.halo_list = self._load_lazy(cache_size)
+            return
+
+        self._run(
+            True,
+            False,
+            njobs=njobs,
+            dynamic=dynamic,
+            profile=profile,
+            backend=backend,
+            nprocs=nprocs,
+        )
+
+    def _load_lazy(self, cache_size):
+        "Apply vectorizable actions to all halos and defer the rest."
+
+        if self.halos_ds is None:
+            raise RuntimeError("Lazy loading requires a halos_ds.")
+
+        self.pipeline._preprocess()
+        self.pipeline.profile = None
+        self._lazy = True
+        # drop profiles read by an earlier run
+        self._profile_data = {}
+
+        n_halos = self.data_source[self.halo_field_type, self._id_field].size
+        halo_batch = HaloBatch(self, self.data_source, np.arange(n_halos))
+        start = self.pipeline._process_batch(halo_batch)
+        for action_type, _ in self.pipeline.actions[start:]:
+            if action_type == "filter":
+                raise RuntimeError(
+                    "Lazy loading requires all filters to be vectorized "
+                    "and added before any callbacks."
+                )
+
+        return LazyHaloList(
+            self,
+            halo_batch.indices,
+            halo_batch.quantities,
+            start,
+            cache_size=cache_size,
+        )
+
+    def enable_result_cache(self, directory=None, max_size=1024):
+        r"""
+        Keep the results of callbacks and quantities on disk so that they
+        are not computed again in later runs.
+
+        Results are stored by halo and by the datasets, the action, and its
+        arguments, as well as those of all callbacks and quantities before
+        it.  Running the pipeline again with different filters, or with
+        actions added at the end, then reuses all earlier results.  Only
+        quantities and callbacks registered with cacheable=True are
+        cached, and results that cannot be stored, such as data
+        containers, are computed as usual.  All other callbacks, including
+        those writing or reading files, are always performed.
+
+        Parameters
+        ----------
+        directory : str
+            The directory in which results are stored.  If None, a
+            "result_cache" directory within the output directory is used.
+            Default: None
+        max_size : float
+            The maximum size of the stored results in megabytes.  The least
+            recently used results are removed first.
+            Default: 1024
+
+        Examples
+        --------
+
+        >>> hc = HaloCatalog(data_ds=data_ds, halos_ds=halos_ds)
+        >>> hc.enable_result_cache()
+        >>> hc.add_recipe("calculate_virial_quantities", ["radius", "matter_mass"])
+        >>> hc.add_filter("quantity_value", "radius_200", ">", 100, "kpc")
+        >>> hc.create()
+
+        """
+
+        if directory is None:
+            directory = os.path.join(self.output_basedir, "result_cache")
+
+        identity = []
+        for name in ("halos_ds", "data_ds"):
+            ds = getattr(self, name)
+            if isinstance(ds, Dataset):
+                identity.append(
+                    (
+                        name,
+                        os.path.abspath(ds.parameter_filename),
+                        str(ds.unique_identifier),
+                    )
+                )
+
+        self.pipeline.result_cache = ResultCache(
+            directory,
+            max_size=max_size,
+            identity=repr(identity),
+            get_target_id=self._get_halo_id,
+            registries=_get_registries(self),
+        )
 
     def add_callback(self, callback, *args, **kwargs):
         r"""
@@ -506,3 +1728,172 @@ class HaloCatalog(ParallelAnalysisInterface):
         """
 
         self.pipeline.add_recipe(recipe, *args, **kwargs)
+
+
+# the halo catalog and whether halos are saved, shared with forked workers
+_pool_state = None
+# the index of this worker process within its pool
+_pool_worker = None
+# the number, iterator, and data of the chunk a worker is analyzing
+_pool_chunk = None
+
+
+def _start_pool(halo_catalog, nprocs, save_halos):
+    "Fork a pool of worker processes sharing the halo catalog."
+
+    global _pool_state
+
+    try:
+        context = multiprocessing.get_context("fork")
+    except ValueError as err:
+        raise RuntimeError(
+            "The process backend requires the fork start method."
+        ) from err
+
+    _pool_state = (halo_catalog, save_halos)
+    try:
+        return context.Pool(
+            nprocs,
+            initializer=_init_pool_worker,
+            initargs=(context.Value("i", 0),),
+        )
+    finally:
+        # the workers have their own copy
+        _pool_state = None
+
+
+def _init_pool_worker(counter):
+    "Give each worker process of a pool its own index."
+
+    global _pool_worker
+    with counter.get_lock():
+        _pool_worker = counter.value
+        counter.value += 1
+
+
+def _get_registries(halo_catalog):
+    registries = {}
+    for name in ("halos_ds", "data_ds"):
+        ds = getattr(halo_catalog, name)
+        if isinstance(ds, Dataset):
+            registries[name] = ds.unit_registry
+    return registries
+
+
+def _pack_quantities(halo_catalog, quantities):
+    """
+    Prepare halo quantities to be sent between processes.
+
+    Unit registries do not survive pickling intact, so values with units
+    from one of the datasets are sent as plain arrays with their units and
+    the name of the dataset.
+    """
+
+    registries = _get_registries(halo_catalog)
+    packed = {}
+    for key, value in quantities.items():
+        registry = getattr(getattr(value, "units", None), "registry", None)
+        for name, ds_registry in registries.items():
+            if registry is ds_registry:
+                value = (name, value.d, str(value.units))
+                break
+        else:
+            value = (None, value, None)
+        packed[key] = value
+    return packed
+
+
+def _unpack_quantities(halo_catalog, packed):
+    "Restore halo quantities packed by _pack_quantities."
+
+    registries = _get_registries(halo_catalog)
+    quantities = {}
+    for key, (name, value, units) in packed.items():
+        if name is not None:
+            value = unyt_array(value, units, registry=registries[name])
+            if value.ndim == 0:
+                value = value[()]
+        quantities[key] = value
+    return quantities
+
+
+def _can_pickle(value):
+    try:
+        pickle.dumps(value)
+    except Exception:
+        return False
+    return True
+
+
+def _get_halo_state(halo, save_halos):
+    """
+    Return the quantities and, if save_halos is True, the other attributes
+    of a halo, pickled to be sent between processes.
+    """
+
+    state = {"quantities": _pack_quantities(halo.halo_catalog, halo.quantities)}
+    if save_halos:
+        state["extra"] = dict(halo.extra)
+    try:
+        return pickle.dumps(state)
+    except Exception:
+        if not save_halos:
+            raise
+
+    # leave out the attributes that cannot be pickled
+    state["extra"] = {
+        key: value for key, value in halo.extra.items() if _can_pickle(value)
+    }
+    return pickle.dumps(state)
+
+
+def _get_pool_chunk(halo_catalog, chunk_id):
+    "Return a chunk of the halo catalog in a worker process."
+
+    global _pool_chunk
+
+    if _pool_chunk is not None and _pool_chunk[0] > chunk_id:
+        _pool_chunk[1].close()
+        _pool_chunk = None
+    if _pool_chunk is None:
+        _pool_chunk = (-1, halo_catalog.data_source.chunks([], "io"), None)
+
+    my_id, chunks, chunk = _pool_chunk
+    while my_id < chunk_id:
+        chunk = next(chunks)
+        my_id += 1
+    _pool_chunk = (my_id, chunks, chunk)
+    return chunk
+
+
+def _process_pool_target(task):
+    "Run the analysis pipeline on one halo in a worker process."
+
+    chunk_id, index, start, packed = task
+    halo_catalog, save_halos = _pool_state
+    pipeline = halo_catalog.pipeline
+    if pipeline.profile is not None:
+        pipeline.profile = PipelineProfile(pipeline.actions)
+
+    my_halo = Halo(halo_catalog, _get_pool_chunk(halo_catalog, chunk_id), index)
+    if packed is not None:
+        my_halo.quantities.update(_unpack_quantities(halo_catalog, packed))
+    start_time = time.perf_counter()
+    rval = pipeline._process_target(my_halo, start=start)
+    busy_time = time.perf_counter() - start_time
+
+    if hasattr(halo_catalog, "_checkpoint_writer"):
+        # the next checkpoint may include this halo
+        halo_catalog._flush_profile_bundles()
+
+    if rval:
+        state = _get_halo_state(my_halo, save_halos)
+    else:
+        state = None
+
+    if pipeline.profile is None:
+        stats = None
+    else:
+        stats = pipeline.profile._get_stats()
+
+    return rval, state, os.getpid(), busy_time, stats
@@ -5,11 +5,65 @@ HaloCatalog filters
 
 """
 
+import functools
+import itertools
+from operator import eq, ge, gt, le, lt, ne
+
 import numpy as np
+from unyt import unyt_quantity
 
 from yt.utilities.on_demand_imports import _scipy as scipy
 from yt_astro_analysis.halo_analysis.halo_catalog.analysis_operators import add_filter
 
+_comparison_operators = {"<": lt, "<=": le, "==": eq, "!=": ne, ">=": ge, ">": gt}
+
+
+class _Comparison:
+    r"""
+    A comparison of quantity values with a threshold.
+
+    The operator is resolved once and the threshold is converted once to
+    the units of the values compared, which can be a single value or an
+    array of values for many halos.  Only the threshold for the most
+    recent units is kept, so no dataset's unit registry outlives its use.
+    """
+
+    def __init__(self, operator, value, units):
+        if operator not in _comparison_operators:
+            raise RuntimeError(f"Unrecognized comparison operator: {operator}.")
+        self.operator = _comparison_operators[operator]
+        self.value = value
+        self.units = units
+        self._units = None
+        self._threshold = None
+
+    def __call__(self, values):
+        units = values.units
+        if self._units is None or units != self._units:
+            # code units are resolved with the registry of the values
+            self._threshold = unyt_quantity(
+                self.value, self.units, registry=units.registry
+            ).to_value(units)
+            self._units = units
+        return self.operator(values.d, self._threshold)
+
+
+# the number of distinct comparisons kept for reuse
+_comparison_cache_size = 128
+
+
+@functools.lru_cache(maxsize=_comparison_cache_size)
+def _cached_comparison(operator, value, units):
+    return _Comparison(operator, value, units)
+
+
+def _get_comparison(operator, value, units):
+    try:
+        return _cached_comparison(operator, value, units)
+    except TypeError:
+        # unhashable values are not cached
+        return _Comparison(operator, value, units)
+
 
 def quantity_value(halo, field, operator, value, units):
     r"""
@@ -22,7 +76,7 @@ def quantity_value(halo, field, operator, value, units):
     field : string
         The field used for the evaluation.
     operator : string
-        The comparison operator to be used ("<", "<=", "==", ">=", ">", etc.)
+        The comparison operator to be used ("<", "<=", "==", "!=", ">=", or ">").
     value : numneric
         The value to be compared against.
     units : string
@@ -33,11 +87,10 @@ def quantity_value(halo, field, operator, value, units):
     if field not in halo.quantities:
         raise RuntimeError(f"Halo object does not contain {field} quantity.")
 
-    h_value = halo.quantities[field].in_units(units).to_ndarray()
-    return eval(f"{h_value} {operator} {value}")
+    return _get_comparison(operator, value, units)(halo.quantities[field])
 
 
-add_filter("quantity_value", quantity_value)
+add_filter("quantity_value", quantity_value, vectorized=True)
 
 
 def not_subhalo(halo, field_type="halos"):
@@ -48,25 +101,28 @@ def not_subhalo(halo, field_type="halos"):
     and subhalos together.
     """
 
-    if not hasattr(halo.halo_catalog, "parent_dict"):
-        halo.halo_catalog.parent_dict = _create_parent_dict(
+    if not hasattr(halo.halo_catalog, "halo_parents"):
+        halo.halo_catalog.halo_parents = _create_halo_parents(
             halo.halo_catalog.data_source, ptype=field_type
         )
-    return (
-        halo.halo_catalog.parent_dict[int(halo.quantities["particle_identifier"])] == -1
-    )
+    ids, parents = halo.halo_catalog.halo_parents
+    halo_ids = np.asarray(halo.quantities["particle_identifier"]).astype(np.int64)
+    return parents[np.searchsorted(ids, halo_ids)] == -1
 
 
-add_filter("not_subhalo", not_subhalo)
+add_filter("not_subhalo", not_subhalo, vectorized=True)
 
 
-def _create_parent_dict(data_source, ptype="halos"):
+def _create_halo_parents(data_source, ptype="halos"):
     """
-    Create a dictionary of halo parents to allow for filtering of subhalos.
+    Create arrays of halo ids and their parents to allow for filtering of subhalos.
 
     For a pair of halos whose distance is smaller than the radius of at least
     one of the halos, the parent is defined as the halo with the larger radius.
     Parent halos (halos with no parents of their own) have parent index values of -1.
+    If a halo lies within the radius of more than one other halo, its parent is
+    assigned from the last of these in the data source.  Both arrays are sorted
+    by halo id.
     """
     pos = np.rollaxis(
         np.array(
@@ -79,16 +135,37 @@ def _create_parent_dict(data_source, ptype="halos"):
         1,
     )
     rad = data_source[ptype, "virial_radius"].in_units("Mpc").to_ndarray()
-    ids = data_source[ptype, "particle_identifier"].to_ndarray().astype("int")
-    parents = -1 * np.ones_like(ids, dtype="int")
+    ids = data_source[ptype, "particle_identifier"].to_ndarray().astype(np.int64)
+    parents = -1 * np.ones_like(ids)
     boxsize = data_source.ds.domain_width.in_units("Mpc")
     my_tree = scipy.spatial.cKDTree(pos, boxsize=boxsize)
 
-    for i in range(ids.size):
-        neighbors = np.array(my_tree.query_ball_point(pos[i], rad[i], p=2))
-        if neighbors.size > 1:
-            parents[neighbors] = ids[neighbors[np.argmax(rad[neighbors])]]
+    # all (halo, neighbor) pairs within the radius of each halo
+    neighbors = my_tree.query_ball_point(pos, rad, p=2, return_sorted=True)
+    counts = np.fromiter(map(len, neighbors), dtype=np.int64, count=ids.size)
+    hosts = np.repeat(np.arange(ids.size), counts)
+    members = np.fromiter(
+        itertools.chain.from_iterable(neighbors), dtype=np.int64, count=counts.sum()
+    )
+
+    # only halos with neighbors other than themselves assign parents
+    keep = counts[hosts] > 1
+    hosts = hosts[keep]
+    members = members[keep]
+
+    # the largest neighbor of each halo, taking the first in case of ties
+    order = np.lexsort((-rad[members], hosts))
+    first = np.ones(order.size, dtype=bool)
+    first[1:] = hosts[order][1:] != hosts[order][:-1]
+    largest = np.empty(ids.size, dtype=np.int64)
+    largest[hosts[order][first]] = members[order][first]
+
+    # the last halo containing each halo assigns its parent
+    host = np.full(ids.size, -1, dtype=np.int64)
+    np.maximum.at(host, members, hosts)
+    assigned = host >= 0
+    parents[assigned] = ids[largest[host[assigned]]]
 
     parents[ids == parents] = -1
-    parent_dict = dict(zip(ids, parents))
-    return parent_dict
+    order = np.argsort(ids)
+    return ids[order], parents[order]
@@ -5,16 +5,143 @@ Halo object.
 
 """
 
+from collections import OrderedDict
+from collections.abc import Sequence
+
 
 class Halo:
+    """
+    A single halo to which the actions of a pipeline are applied.
+
+    Core attributes are kept in slots.  Attributes added by callbacks, such
+    as data_object, are stored in the extra dictionary, which is only
+    created when the first one is set.
+    """
+
+    __slots__ = ("halo_catalog", "data_source", "index", "quantities", "_extra")
+
     def __init__(self, halo_catalog, data_source, index):
         self.halo_catalog = halo_catalog
         self.data_source = data_source
         self.index = index
         self.quantities = {}
+        self._extra = None
+
+    @property
+    def extra(self):
+        "The attributes added to the halo by callbacks."
+        if self._extra is None:
+            self._extra = {}
+        return self._extra
+
+    def __getattr__(self, name):
+        # only called for names that are not slots or for unset slots,
+        # such as _extra while unpickling
+        if name != "_extra":
+            extra = self._extra
+            if extra is not None and name in extra:
+                return extra[name]
+        raise AttributeError(f"'Halo' object has no attribute '{name}'")
+
+    def __setattr__(self, name, value):
+        if name in Halo.__slots__:
+            object.__setattr__(self, name, value)
+        else:
+            self.extra[name] = value
+
+    def __delattr__(self, name):
+        if name in Halo.__slots__:
+            object.__delattr__(self, name)
+        elif self._extra is not None and name in self._extra:
+            del self._extra[name]
+        else:
+            raise AttributeError(name)
 
     def _get_field_value(self, fieldname):
         return self.data_source[fieldname][self.index]
 
     def _set_field_value(self, fieldkey, fieldname):
         self.quantities[fieldkey] = self._get_field_value(fieldname)
+
+
+class HaloBatch:
+    """
+    A set of halos from a single data chunk.
+
+    This is used to apply vectorized quantities and filters to all
+    halos in a chunk at once.  The quantities dictionary holds arrays
+    with one entry per halo index.
+    """
+
+    def __init__(self, halo_catalog, data_source, indices):
+        self.halo_catalog = halo_catalog
+        self.data_source = data_source
+        self.indices = indices
+        self.quantities = {}
+
+    def _get_field_value(self, fieldname):
+        return self.data_source[fieldname][self.indices]
+
+    def _set_field_value(self, fieldkey, fieldname):
+        self.quantities[fieldkey] = self._get_field_value(fieldname)
+
+    def _apply_mask(self, mask):
+        self.indices = self.indices[mask]
+        for key, value in self.quantities.items():
+            self.quantities[key] = value[mask]
+
+    def _take(self, positions):
+        "Return a batch of the halos at the given positions in this batch."
+        batch = HaloBatch(self.halo_catalog, self.data_source, self.indices[positions])
+        batch.quantities = {
+            key: value[positions] for key, value in self.quantities.items()
+        }
+        return batch
+
+
+class LazyHaloList(Sequence):
+    """
+    A list of halos whose remaining analysis is done on first access.
+
+    Quantities already computed for all halos are given as arrays.  When a
+    halo is accessed, a Halo object is created with its quantities and the
+    remaining actions of the pipeline, such as loading profiles, are
+    performed.  The most recently accessed halos are kept in memory, up to
+    cache_size.
+    """
+
+    def __init__(self, halo_catalog, indices, quantities, start, cache_size=128):
+        self.halo_catalog = halo_catalog
+        self.indices = indices
+        self.quantities = quantities
+        self.start = start
+        self.cache_size = cache_size
+        self._halos = OrderedDict()
+
+    def __len__(self):
+        return self.indices.size
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[i] for i in range(*key.indices(len(self)))]
+
+        index = range(len(self))[key]
+        halo = self._halos.get(index)
+        if halo is not None:
+            self._halos.move_to_end(index)
+            return halo
+
+        halo_catalog = self.halo_catalog
+        halo = Halo(halo_catalog, halo_catalog.data_source, self.indices[index])
+        halo.quantities = {
+            key: values[index] for key, values in self.quantities.items()
+        }
+        try:
+            halo_catalog.pipeline._process_target(halo, start=self.start)
+        finally:
+            halo_catalog._release_sphere_cache()
+
+        self._halos[index] = halo
+        while len(self._halos) > self.cache_size:
+            self._halos.popitem(last=False)
+        return halo
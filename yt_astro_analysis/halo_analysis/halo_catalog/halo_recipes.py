@@ -21,7 +21,8 @@ def calculate_virial_quantities(
     r"""
     Calculate virial quantities with the following procedure:
     1. Create a sphere data container.
-    2. Create 1D radial profiles of overdensity and any requested fields.
+    2. Create 1D radial profiles of overdensity and any requested fields
+       in a single pass over the sphere.
     3. Call virial_quantities callback to interpolate profiles for value of critical overdensity.
     4. Delete profile and sphere objects from halo.
 
@@ -63,24 +64,25 @@ def calculate_virial_quantities(
     storage = "virial_quantities_profiles"
     pfields = [field for field in fields if field != "radius"]
 
-    pipeline.add_callback("sphere", factor=factor)
+    profiles = []
     if pfields:
-        pipeline.add_callback(
-            "profile",
-            ["radius"],
-            pfields,
-            weight_field=weight_field,
-            accumulation=accumulation,
-            storage=storage,
+        profiles.append(
+            {
+                "profile_fields": pfields,
+                "weight_field": weight_field,
+                "accumulation": accumulation,
+            }
         )
-    pipeline.add_callback(
-        "profile",
-        ["radius"],
-        [overdensity_field],
-        weight_field="cell_volume",
-        accumulation=True,
-        storage=storage,
+    profiles.append(
+        {
+            "profile_fields": [overdensity_field],
+            "weight_field": "cell_volume",
+            "accumulation": True,
+        }
     )
+
+    pipeline.add_callback("sphere", factor=factor)
+    pipeline.add_callback("multi_profile", ["radius"], profiles, storage=storage)
     pipeline.add_callback(
         "virial_quantities",
         fields,
@@ -0,0 +1,158 @@
+"""
+PipelineProfile class and member functions
+
+
+
+"""
+
+import json
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def _get_peak_memory():
+    # peak resident memory of this process in megabytes
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # reported in bytes on macOS and kilobytes elsewhere
+    if sys.platform == "darwin":
+        return peak / 2**20
+    return peak / 2**10
+
+
+class PipelineProfile:
+    r"""
+    Timing and memory statistics for each action of an AnalysisPipeline.
+
+    For each action, the number of calls, the total wall time, and the
+    largest increase in the peak memory of the process during a single
+    call are recorded.  For filters, the number of targets passing is
+    also recorded.
+
+    Parameters
+    ----------
+    actions : list
+        The actions of the pipeline.
+
+    """
+
+    def __init__(self, actions):
+        self.names = []
+        for action_type, action in actions:
+            if action_type == "quantity":
+                name = action[0]
+            else:
+                name = getattr(action.function, "__name__", str(action.function))
+            self.names.append((action_type, name))
+
+        n_actions = len(actions)
+        self.calls = [0] * n_actions
+        self.passed = [0] * n_actions
+        self.time = [0.0] * n_actions
+        self.memory = [0.0] * n_actions
+        self._start_time = None
+        self._start_memory = None
+
+    def start(self):
+        """
+        Start timing an action.
+        """
+
+        self._start_memory = _get_peak_memory()
+        self._start_time = time.perf_counter()
+
+    def stop(self, index, n_calls=1, n_passed=None):
+        """
+        Stop timing an action and record it as applied to n_calls targets,
+        of which n_passed passed if the action is a filter.
+        """
+
+        self.time[index] += time.perf_counter() - self._start_time
+        self.memory[index] = max(
+            self.memory[index], _get_peak_memory() - self._start_memory
+        )
+        self.calls[index] += n_calls
+        if n_passed is not None:
+            self.passed[index] += n_passed
+        self._start_time = None
+
+    def _get_stats(self):
+        return (self.calls, self.passed, self.time, self.memory)
+
+    def _add_stats(self, stats):
+        calls, passed, times, memory = stats
+        self.calls = [a + b for a, b in zip(self.calls, calls)]
+        self.passed = [a + b for a, b in zip(self.passed, passed)]
+        self.time = [a + b for a, b in zip(self.time, times)]
+        self.memory = [max(a, b) for a, b in zip(self.memory, memory)]
+
+    def combine(self, comm):
+        """
+        Sum statistics over all processors of a communicator.
+        """
+
+        all_stats = comm.par_combine_object(
+            [self._get_stats()], datatype="list", op="cat"
+        )
+        n_actions = len(self.names)
+        self.calls = [0] * n_actions
+        self.passed = [0] * n_actions
+        self.time = [0.0] * n_actions
+        self.memory = [0.0] * n_actions
+        for stats in all_stats:
+            self._add_stats(stats)
+
+    def to_dict(self):
+        """
+        Return the statistics as a list of dictionaries, one per action.
+        """
+
+        rows = []
+        for i, (action_type, name) in enumerate(self.names):
+            row = {
+                "action": name,
+                "type": action_type,
+                "calls": self.calls[i],
+                "time": self.time[i],
+                "peak_memory_increase": self.memory[i],
+            }
+            if action_type == "filter":
+                row["passed"] = self.passed[i]
+            rows.append(row)
+        return rows
+
+    def save(self, filename):
+        """
+        Write the statistics to a json file.
+        """
+
+        with open(filename, mode="w") as f:
+            json.dump({"actions": self.to_dict()}, f, indent=2)
+
+    def __str__(self):
+        header = (
+            f"{'Action':<32s} {'Type':<8s} {'Calls':>8s} {'Time (s)':>10s} "
+            f"{'ms/call':>9s} {'Passed':>8s} {'Memory (MB)':>12s}"
+        )
+        lines = [header, "-" * len(header)]
+        for row in self.to_dict():
+            if row["calls"] > 0:
+                per_call = f"{1000 * row['time'] / row['calls']:9.3f}"
+            else:
+                per_call = f"{'-':>9s}"
+            if "passed" in row:
+                passed = f"{row['passed']:8d}"
+            else:
+                passed = f"{'-':>8s}"
+            lines.append(
+                f"{row['action'][:32]:<32s} {row['type']:<8s} {row['calls']:8d} "
+                f"{row['time']:10.3f} {per_call} {passed} "
+                f"{row['peak_memory_increase']:12.1f}"
+            )
+        return "\n".join(lines)
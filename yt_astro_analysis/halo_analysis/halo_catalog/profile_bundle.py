@@ -0,0 +1,302 @@
+"""
+ProfileBundle class and member functions
+
+
+
+"""
+
+import os
+
+import numpy as np
+
+from yt.units.yt_array import YTArray
+from yt.utilities.on_demand_imports import _h5py as h5py
+
+_groups = ("profiles", "variance")
+
+
+class ProfileBundle:
+    r"""
+    Write the profiles of many halos to a single file.
+
+    The profiles of each field are stacked into a single dataset whose
+    first axis runs over halos, in the order given by the "ids" dataset.
+    All halos must have profiles of the same shape.  Profiles are held in
+    memory and written in blocks of buffer_size halos, and the file is
+    only flushed by flush and close.
+
+    Parameters
+    ----------
+    filename : str
+        The name of the file to be written.
+    mode : str
+        If "w", any existing file is overwritten.  If "a", profiles are
+        added to an existing file.
+        Default: "w"
+    buffer_size : int
+        The number of halos whose profiles are held before writing.
+        Default: 256
+
+    """
+
+    def __init__(self, filename, mode="w", buffer_size=256):
+        self.filename = filename
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._shapes = {}
+        if mode == "a" and os.path.exists(filename):
+            self.fh = h5py.File(filename, mode="a")
+            self.size = self.fh["ids"].size
+            for group in _groups:
+                for field, dataset in self.fh[group].items():
+                    self._shapes[group, field] = dataset.shape[1:]
+            return
+
+        self.fh = h5py.File(filename, mode="w")
+        self.fh.create_dataset(
+            "ids", shape=(0,), maxshape=(None,), dtype=np.int64, chunks=True
+        )
+        for group in _groups:
+            self.fh.create_group(group)
+        self.size = 0
+
+    def write(self, halo_id, profiles, variance=None):
+        """
+        Add the profiles, and optionally their variances, of one halo.
+        """
+
+        row = {}
+        for group, data in zip(_groups, (profiles, variance)):
+            if data is None:
+                data = {}
+            for field, values in data.items():
+                field = str(field)
+                # Don't write code units because we might not know those later.
+                if isinstance(values, YTArray):
+                    values = values.in_cgs()
+                    units = str(values.units)
+                else:
+                    units = ""
+                values = np.asarray(values)
+
+                shape = self._shapes.setdefault((group, field), values.shape)
+                if shape != values.shape:
+                    raise RuntimeError(
+                        f"Profile {field} of halo {halo_id} has shape "
+                        f"{values.shape}, but {shape} is required by "
+                        f"{self.filename}."
+                    )
+                row[group, field] = (values, units)
+
+        self._buffer.append((halo_id, row))
+        if len(self._buffer) >= self.buffer_size:
+            self._write_buffer()
+
+    def _write_buffer(self):
+        "Write the profiles held in memory to the file."
+
+        if not self._buffer:
+            return
+
+        start = self.size
+        self.size += len(self._buffer)
+        self.fh["ids"].resize(self.size, axis=0)
+        self.fh["ids"][start:] = [halo_id for halo_id, _ in self._buffer]
+
+        fields = {}
+        for _, row in self._buffer:
+            for key in row:
+                fields.setdefault(key, None)
+
+        for group, field in fields:
+            my_group = self.fh[group]
+            rows = [row.get((group, field)) for _, row in self._buffer]
+            first = next(row for row in rows if row is not None)
+            if field not in my_group:
+                values, units = first
+                dataset = my_group.create_dataset(
+                    field,
+                    shape=(start,) + values.shape,
+                    maxshape=(None,) + values.shape,
+                    dtype=values.dtype,
+                    chunks=True,
+                    fillvalue=0,
+                )
+                dataset.attrs["units"] = units
+            else:
+                dataset = my_group[field]
+
+            # halos without this field get the fill value
+            block = np.zeros((len(rows),) + dataset.shape[1:], dtype=dataset.dtype)
+            for i, my_row in enumerate(rows):
+                if my_row is not None:
+                    block[i] = my_row[0]
+            dataset.resize(self.size, axis=0)
+            dataset[start:] = block
+
+        # keep all fields aligned with the ids
+        for group in _groups:
+            for dataset in self.fh[group].values():
+                if dataset.shape[0] < self.size:
+                    dataset.resize(self.size, axis=0)
+
+        self._buffer = []
+
+    def keep(self, halo_ids):
+        """
+        Remove the profiles of all halos except those with the given ids.
+        """
+
+        self._write_buffer()
+        mask = np.isin(self.fh["ids"][()], halo_ids)
+        self.size = int(np.count_nonzero(mask))
+        datasets = [self.fh["ids"]]
+        for group in _groups:
+            datasets.extend(self.fh[group].values())
+        for dataset in datasets:
+            values = dataset[()][mask]
+            dataset.resize(self.size, axis=0)
+            if self.size > 0:
+                dataset[...] = values
+
+    def flush(self):
+        "Write all profiles held in memory and flush the file."
+
+        self._write_buffer()
+        self.fh.flush()
+
+    def close(self):
+        if self.fh:
+            self._write_buffer()
+            self.fh.close()
+
+
+def _index_ids(ids, filenames):
+    "Return the row of each halo id in the ids of all files, in order."
+
+    ids = np.concatenate(ids) if ids else np.empty(0, dtype=np.int64)
+    index = {halo_id: row for row, halo_id in enumerate(ids.tolist())}
+    if len(index) < ids.size:
+        unique_ids, counts = np.unique(ids, return_counts=True)
+        raise RuntimeError(
+            f"Profiles of halo {unique_ids[counts > 1][0]} found more than "
+            f"once in {', '.join(filenames)}."
+        )
+    return index
+
+
+def read_profile_bundles(filenames, fields=None, ds=None):
+    r"""
+    Read the profiles of all halos from a set of bundled profile files.
+
+    Parameters
+    ----------
+    filenames : list of str
+        The files written by ProfileBundle.
+    fields : list of str
+        The fields to be read.  If None, all fields are read.
+        Default: None
+    ds : dataset
+        The dataset whose unit registry is attached to the profiles.
+        Default: None
+
+    Returns
+    -------
+    index : dict
+        The row of each halo id in the profile arrays.
+    data : dict
+        For the "profiles" and "variance" groups, a dictionary of arrays of
+        each field with halos along the first axis.
+
+    """
+
+    ids = []
+    arrays = {group: {} for group in _groups}
+    units = {group: {} for group in _groups}
+    for filename in filenames:
+        with h5py.File(filename, mode="r") as fh:
+            my_ids = fh["ids"][()]
+            ids.append(my_ids)
+            for group in _groups:
+                my_group = fh[group]
+                if fields is None:
+                    my_fields = list(my_group.keys())
+                else:
+                    my_fields = [field for field in fields if field in my_group]
+                for field in my_fields:
+                    arrays[group].setdefault(field, []).append(my_group[field][()])
+                    units[group][field] = my_group[field].attrs["units"]
+
+    index = _index_ids(ids, filenames)
+
+    data = {}
+    for group in _groups:
+        data[group] = {}
+        for field, values in arrays[group].items():
+            if len(values) != len(filenames):
+                raise RuntimeError(f"{field} field not present in all profile files.")
+            values = np.concatenate(values)
+            my_units = units[group][field]
+            if ds is not None and my_units:
+                values = ds.arr(values, my_units)
+            data[group][field] = values
+
+    return index, data
+
+
+class ProfileBundleReader:
+    r"""
+    Read the profiles of one halo at a time from a set of bundled profile
+    files.
+
+    The ids of all halos are read once, when the reader is created.  After
+    that, only the rows of the requested halo are read from its file.
+
+    Parameters
+    ----------
+    filenames : list of str
+        The files written by ProfileBundle.
+    ds : dataset
+        The dataset whose unit registry is attached to the profiles.
+        Default: None
+
+    """
+
+    def __init__(self, filenames, ds=None):
+        self.filenames = filenames
+        self.ds = ds
+        ids = []
+        for filename in filenames:
+            with h5py.File(filename, mode="r") as fh:
+                ids.append(fh["ids"][()])
+        self.index = _index_ids(ids, filenames)
+        self._starts = np.cumsum([0] + [my_ids.size for my_ids in ids])
+
+    def read(self, halo_id, fields=None):
+        """
+        Return the profiles of a halo in the same form as the data returned
+        by read_profile_bundles, or None if it is not present.
+        """
+
+        row = self.index.get(halo_id)
+        if row is None:
+            return None
+        i = np.searchsorted(self._starts, row, side="right") - 1
+        row -= self._starts[i]
+
+        data = {}
+        with h5py.File(self.filenames[i], mode="r") as fh:
+            for group in _groups:
+                my_group = fh[group]
+                if fields is None:
+                    my_fields = list(my_group.keys())
+                else:
+                    my_fields = [field for field in fields if field in my_group]
+                data[group] = {}
+                for field in my_fields:
+                    values = my_group[field][row]
+                    my_units = my_group[field].attrs["units"]
+                    if self.ds is not None and my_units:
+                        values = self.ds.arr(values, my_units)
+                    data[group][field] = values
+        return data
@@ -0,0 +1,350 @@
+"""
+ResultCache class and member functions
+
+
+
+"""
+
+import hashlib
+import os
+import pickle
+import tempfile
+
+import numpy as np
+from unyt import unyt_array
+
+from yt.funcs import ensure_dir, mylog
+
+_suffix = ".pkl"
+_unpackable = object()
+
+
+class _CachedArray:
+    "An array with units from one of the registries of a ResultCache."
+
+    def __init__(self, name, value, units):
+        self.name = name
+        self.value = value
+        self.units = units
+
+
+def _equal(a, b):
+    # deep equality of two values packed by a ResultCache
+    if type(a) is not type(b):
+        return False
+    if isinstance(a, _CachedArray):
+        return a.name == b.name and a.units == b.units and _equal(a.value, b.value)
+    if isinstance(a, np.ndarray):
+        if isinstance(a, unyt_array) and a.units != b.units:
+            return False
+        a, b = np.asarray(a), np.asarray(b)
+        return (
+            a.shape == b.shape
+            and a.dtype == b.dtype
+            and np.array_equal(a, b, equal_nan=a.dtype.kind in "fc")
+        )
+    if isinstance(a, (list, tuple)):
+        return len(a) == len(b) and all(_equal(x, y) for x, y in zip(a, b))
+    if isinstance(a, dict):
+        return a.keys() == b.keys() and all(_equal(a[key], b[key]) for key in a)
+    return bool(a == b)
+
+
+def _describe_action(action_type, action):
+    # a description of an action and its arguments for cache keys
+    if action_type == "quantity":
+        key, quantity = action
+        if not callable(quantity):
+            return repr((action_type, key, quantity))
+        action = quantity
+    function = action.function
+    name = f"{getattr(function, '__module__', '')}.{function.__qualname__}"
+    kwargs = sorted(action.kwargs.items())
+    return repr((action_type, name, action.args, kwargs))
+
+
+class ResultCache:
+    r"""
+    An on-disk cache of the results of callbacks and quantities.
+
+    Each result is stored in its own file, named by a hash of the identity
+    of the datasets, the target, and the description of the action and all
+    callbacks and quantities before it in the pipeline.  Changing any of
+    these, such as the arguments of an earlier callback, gives a new key,
+    while filters do not affect the keys.  When the total size of the
+    files exceeds max_size, the least recently used are removed.
+
+    For callbacks, the attributes and quantities set, changed in place,
+    or removed on the target are stored.  Results containing anything
+    other than numbers, strings, arrays, and lists, tuples, or
+    dictionaries of these, such as data containers, are not cached.
+    Changes made in place to other objects, such as the field parameters
+    of a data container, cannot be detected, so only callbacks that make
+    none should be registered as cacheable.
+
+    Parameters
+    ----------
+    directory : str
+        The directory in which results are stored.
+    max_size : float
+        The maximum total size of the cached results in megabytes.
+        Default: 1024
+    identity : str
+        A string identifying the data from which results are computed.
+        Default: ""
+    get_target_id : callable
+        A function returning a unique identifier of a target.  If None,
+        the index attribute of the target is used.
+        Default: None
+    registries : dict
+        Unit registries, by name, to which cached arrays with units are
+        attached when loaded.
+        Default: None
+
+    """
+
+    def __init__(
+        self,
+        directory,
+        max_size=1024,
+        identity="",
+        get_target_id=None,
+        registries=None,
+    ):
+        self.directory = ensure_dir(directory)
+        self.max_size = max_size * 2**20
+        self.identity = identity
+        if get_target_id is None:
+            get_target_id = _get_index
+        self.get_target_id = get_target_id
+        if registries is None:
+            registries = {}
+        self.registries = registries
+        self.hits = 0
+        self.misses = 0
+        self._actions = None
+        self._action_keys = None
+
+        # sizes of existing files, from least to most recently used
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(_suffix):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+        files.sort()
+        self._files = {name: size for _, name, size in files}
+        self.size = sum(self._files.values())
+
+    def _get_action_keys(self, actions):
+        # keys chaining the descriptions of all callbacks and quantities
+        if actions is self._actions and len(actions) == len(self._action_keys):
+            return self._action_keys
+
+        keys = []
+        digest = hashlib.sha256(self.identity.encode())
+        for action_type, action in actions:
+            if action_type != "filter":
+                digest.update(_describe_action(action_type, action).encode())
+            keys.append(digest.copy())
+        self._actions = actions
+        self._action_keys = keys
+        return keys
+
+    def get_key(self, actions, index, target):
+        """
+        Return the key of the result of an action applied to a target.
+        """
+
+        digest = self._get_action_keys(actions)[index].copy()
+        digest.update(repr(self.get_target_id(target)).encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        Return a cached result, or None if there is none.
+        """
+
+        name = key + _suffix
+        if name not in self._files:
+            self.misses += 1
+            return None
+        filename = os.path.join(self.directory, name)
+        try:
+            with open(filename, mode="rb") as f:
+                result = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            # removed or being written by another process
+            self.misses += 1
+            return None
+        os.utime(filename)
+        # mark as most recently used
+        self._files[name] = self._files.pop(name)
+        self.hits += 1
+        return self._unpack(result)
+
+    def put(self, key, result):
+        """
+        Store a result, removing the least recently used if the cache is
+        full.  Returns False if the result cannot be cached.
+        """
+
+        try:
+            packed = self._pack(result)
+        except TypeError:
+            return False
+
+        name = key + _suffix
+        fd, tmpname = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, mode="wb") as f:
+            pickle.dump(packed, f, protocol=pickle.HIGHEST_PROTOCOL)
+        # replace atomically so other processes never read partial files
+        os.replace(tmpname, os.path.join(self.directory, name))
+
+        size = os.path.getsize(os.path.join(self.directory, name))
+        self.size += size - self._files.pop(name, 0)
+        self._files[name] = size
+        self._evict()
+        return True
+
+    def _evict(self):
+        while self.size > self.max_size and len(self._files) > 1:
+            name = next(iter(self._files))
+            self.size -= self._files.pop(name)
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        """
+        Remove all cached results.
+        """
+
+        for name in self._files:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+        self._files = {}
+        self.size = 0
+
+    def _pack(self, value):
+        if value is None or isinstance(value, (bool, int, float, str, np.generic)):
+            return value
+        if isinstance(value, unyt_array):
+            registry = value.units.registry
+            name = next(
+                (
+                    name
+                    for name, my_registry in self.registries.items()
+                    if registry is my_registry
+                ),
+                None,
+            )
+            if name is None:
+                # pickled with a copy of its own registry
+                return value.copy()
+            return _CachedArray(name, value.d.copy(), str(value.units))
+        if isinstance(value, np.ndarray):
+            if value.dtype.hasobject:
+                raise TypeError("Object arrays cannot be cached.")
+            return value.copy()
+        if isinstance(value, (list, tuple)):
+            return type(value)(self._pack(item) for item in value)
+        if isinstance(value, dict):
+            return {self._pack(key): self._pack(item) for key, item in value.items()}
+        raise TypeError(f"{type(value)} cannot be cached.")
+
+    def _unpack(self, value):
+        if isinstance(value, _CachedArray):
+            registry = self.registries.get(value.name)
+            array = unyt_array(value.value, value.units, registry=registry)
+            if array.ndim == 0:
+                array = array[()]
+            return array
+        if isinstance(value, (list, tuple)):
+            return type(value)(self._unpack(item) for item in value)
+        if isinstance(value, dict):
+            return {key: self._unpack(item) for key, item in value.items()}
+        return value
+
+    def _snapshot(self, values):
+        # each value with a packed copy, or _unpackable
+        snapshot = {}
+        for name, value in values.items():
+            try:
+                packed = self._pack(value)
+            except TypeError:
+                packed = _unpackable
+            snapshot[name] = (value, packed)
+        return snapshot
+
+    def _unchanged(self, value, old, packed):
+        # values read from catalog rows are new objects each time, so
+        # values that can be packed are compared by value
+        if packed is _unpackable:
+            return value is old
+        try:
+            return _equal(packed, self._pack(value))
+        except TypeError:
+            return False
+
+    def _get_changes(self, before, after):
+        changes = {}
+        for name, value in after.items():
+            if name in before and self._unchanged(value, *before[name]):
+                continue
+            changes[name] = value
+        return changes
+
+    def apply_quantity(self, key, target, quantity):
+        """
+        Return the value of a quantity for a target, computing and caching
+        it if it is not cached.
+        """
+
+        value = self.get(key)
+        if value is not None:
+            return value[0]
+        value = quantity(target)
+        self.put(key, (value,))
+        return value
+
+    def apply_callback(self, key, target, callback):
+        """
+        Perform a callback on a target, or restore the changes it made to
+        the target if they are cached.
+        """
+
+        changes = self.get(key)
+        if changes is not None:
+            attributes, removed, quantities, removed_quantities = changes
+            for name in removed:
+                if hasattr(target, name):
+                    delattr(target, name)
+            for name, value in attributes.items():
+                setattr(target, name, value)
+            for name in removed_quantities:
+                target.quantities.pop(name, None)
+            target.quantities.update(quantities)
+            return
+
+        # copies to find values changed in place, such as dictionaries,
+        # with the quantities compared one by one
+        before = self._snapshot(target.extra)
+        quantities_before = self._snapshot(target.quantities)
+        callback(target)
+
+        after = target.extra
+        attributes = self._get_changes(before, after)
+        removed = [name for name in before if name not in after]
+        quantities = self._get_changes(quantities_before, target.quantities)
+        removed_quantities = [
+            name for name in quantities_before if name not in target.quantities
+        ]
+        if not self.put(key, (attributes, removed, quantities, removed_quantities)):
+            mylog.debug("Results of %s cannot be cached.", callback.function)
+
+
+def _get_index(target):
+    return target.index
@@ -0,0 +1,113 @@
+"""
+Halo scheduling functions
+
+
+
+"""
+
+import heapq
+
+import numpy as np
+
+# bits per dimension of Morton keys, the most that fit in 64 bits
+_morton_bits = 21
+
+
+def _spread_bits(values):
+    # insert two zero bits between each of the lower 21 bits
+    values = values.astype(np.uint64) & np.uint64(0x1FFFFF)
+    values = (values | (values << np.uint64(32))) & np.uint64(0x1F00000000FFFF)
+    values = (values | (values << np.uint64(16))) & np.uint64(0x1F0000FF0000FF)
+    values = (values | (values << np.uint64(8))) & np.uint64(0x100F00F00F00F00F)
+    values = (values | (values << np.uint64(4))) & np.uint64(0x10C30C30C30C30C3)
+    values = (values | (values << np.uint64(2))) & np.uint64(0x1249249249249249)
+    return values
+
+
+def morton_keys(positions, left_edge, right_edge):
+    r"""
+    Return the Morton (Z-order) keys of an array of positions.
+
+    Parameters
+    ----------
+    positions : array
+        Positions with shape (N, 3).
+    left_edge, right_edge : array
+        The corners of the volume containing all positions, in the same
+        units as positions.
+
+    """
+
+    positions = np.asarray(positions, dtype=np.float64)
+    left_edge = np.asarray(left_edge, dtype=np.float64)
+    width = np.asarray(right_edge, dtype=np.float64) - left_edge
+
+    n_cells = 1 << _morton_bits
+    cells = np.floor((positions - left_edge) / width * n_cells)
+    cells = np.clip(cells, 0, n_cells - 1).astype(np.uint64)
+
+    keys = np.zeros(cells.shape[0], dtype=np.uint64)
+    for axis in range(3):
+        keys |= _spread_bits(cells[:, axis]) << np.uint64(axis)
+    return keys
+
+
+def distribute_blocks(blocks):
+    r"""
+    Interleave lists of work so that distributing the result round-robin
+    over len(blocks) jobs, as done by parallel_objects, gives each job one
+    block in its original order.  Shorter blocks are padded with None.
+    """
+
+    n_items = max((len(block) for block in blocks), default=0)
+    items = []
+    for i in range(n_items):
+        for block in blocks:
+            items.append(block[i] if i < len(block) else None)
+    return items
+
+
+def lpt_blocks(costs, n_blocks, loads=None):
+    r"""
+    Divide work into blocks of nearly equal total cost using the longest
+    processing time first rule.
+
+    Items are taken in order of decreasing cost and each is added to the
+    block with the lowest total cost so far.
+
+    Parameters
+    ----------
+    costs : array
+        The estimated cost of each item.
+    n_blocks : int
+        The number of blocks.
+    loads : array
+        The cost already assigned to each block.  If None, all blocks start
+        empty.
+        Default: None
+
+    Returns
+    -------
+    blocks : list of arrays
+        The indices of the items in each block, in order of decreasing cost.
+    loads : array
+        The total cost of each block, including any starting loads.
+
+    """
+
+    costs = np.asarray(costs, dtype=np.float64)
+    if loads is None:
+        loads = np.zeros(n_blocks)
+    heap = [(float(loads[i]), i) for i in range(n_blocks)]
+    heapq.heapify(heap)
+    blocks = [[] for i in range(n_blocks)]
+    for item in np.argsort(-costs, kind="stable"):
+        load, i = heapq.heappop(heap)
+        blocks[i].append(item)
+        heapq.heappush(heap, (load + costs[item], i))
+
+    blocks = [np.array(block, dtype=np.int64) for block in blocks]
+    loads = np.asarray(loads, dtype=np.float64) + [
+        costs[block].sum() for block in blocks
+    ]
+    return blocks, loads
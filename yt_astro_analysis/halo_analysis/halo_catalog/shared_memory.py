@@ -0,0 +1,120 @@
+"""
+SharedFieldData class and member functions
+
+
+
+"""
+
+import numpy as np
+from unyt import unyt_array
+
+# align each array in the shared buffer to a cache line
+_alignment = 64
+
+
+class SharedFieldData:
+    r"""
+    Broadcast field arrays into memory shared by the processes on each node.
+
+    The arrays are sent once to a single process on each node, which
+    writes them into a shared memory window.  All processes on the node
+    then receive views of that window instead of their own copies.  This
+    requires an MPI implementation supporting MPI-3 shared memory.
+
+    The views remain valid until free is called.
+
+    Parameters
+    ----------
+    comm : mpi4py communicator
+        The communicator of all processes taking part in the broadcast.
+
+    """
+
+    def __init__(self, comm):
+        from mpi4py import MPI
+
+        self.comm = comm
+        self.node_comm = comm.Split_type(MPI.COMM_TYPE_SHARED, key=comm.rank)
+        # only one process per node takes part in the broadcast between nodes
+        if self.node_comm.rank == 0:
+            color = 0
+        else:
+            color = MPI.UNDEFINED
+        self.leader_comm = comm.Split(color, key=comm.rank)
+        self._windows = []
+
+    def bcast(self, field_data):
+        """
+        Return a dictionary of shared views of the arrays in field_data
+        on the root process.
+        """
+
+        from mpi4py import MPI
+
+        if self.comm.rank == 0:
+            arrays = {
+                field: np.ascontiguousarray(values)
+                for field, values in field_data.items()
+            }
+            info = {
+                field: (
+                    values.shape,
+                    values.dtype.str,
+                    getattr(field_data[field], "units", None),
+                )
+                for field, values in arrays.items()
+            }
+        else:
+            info = None
+        info = self.comm.bcast(info, root=0)
+
+        offsets = {}
+        nbytes = 0
+        for field, (shape, dtype, _) in info.items():
+            offsets[field] = nbytes
+            size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            nbytes += -(-size // _alignment) * _alignment
+
+        if self.node_comm.rank == 0:
+            my_nbytes = nbytes
+        else:
+            my_nbytes = 0
+        window = MPI.Win.Allocate_shared(my_nbytes, 1, comm=self.node_comm)
+        self._windows.append(window)
+        buffer, _ = window.Shared_query(0)
+        buffer = np.frombuffer(buffer, dtype=np.uint8, count=nbytes)
+
+        views = {}
+        for field, (shape, dtype, units) in info.items():
+            view = np.ndarray(shape, dtype=dtype, buffer=buffer, offset=offsets[field])
+            if self.comm.rank == 0:
+                view[...] = arrays[field]
+            if units is not None:
+                view = unyt_array(view, units, registry=units.registry)
+            views[field] = view
+
+        if self.node_comm.rank == 0 and nbytes > 0:
+            self.leader_comm.Bcast(buffer, root=0)
+        self.node_comm.Barrier()
+        return views
+
+    def free(self):
+        """
+        Release all shared memory windows.
+        """
+
+        for window in self._windows:
+            window.Free()
+        self._windows = []
+
+    def close(self):
+        """
+        Release all shared memory windows and communicators.
+        """
+
+        from mpi4py import MPI
+
+        self.free()
+        if self.leader_comm != MPI.COMM_NULL:
+            self.leader_comm.Free()
+        self.node_comm.Free()
@@ -24,15 +24,57 @@
 
 static PyObject *_FOFerror;
 
+static PyArrayObject *
+convert_position_array(PyObject *opos, int axis)
+{
+    /* One axis of the positions as a float32 or float64 array, which is
+       only copied if it is neither.  If axis is -1, opos has one
+       dimension, and otherwise it is an (N, 3) array. */
+
+    PyArrayObject *pos, *column;
+    PyObject *key;
+    int ndim = axis < 0 ? 1 : 2;
+
+    pos = (PyArrayObject *) PyArray_FromAny(opos, NULL, ndim, ndim,
+                    NPY_ARRAY_ALIGNED, NULL);
+    if (pos == NULL) return NULL;
+    if ((PyArray_TYPE(pos) != NPY_FLOAT32) &&
+        (PyArray_TYPE(pos) != NPY_FLOAT64)) {
+        Py_SETREF(pos, (PyArrayObject *) PyArray_FromAny((PyObject *) pos,
+                    PyArray_DescrFromType(NPY_FLOAT64), ndim, ndim,
+                    NPY_ARRAY_ALIGNED, NULL));
+        if (pos == NULL) return NULL;
+    }
+    if (axis < 0) return pos;
+
+    if (PyArray_DIM(pos, 1) != 3) {
+        Py_DECREF(pos);
+        return NULL;
+    }
+    key = Py_BuildValue("(Ni)", PySlice_New(NULL, NULL, NULL), axis);
+    if (key == NULL) {
+        Py_DECREF(pos);
+        return NULL;
+    }
+    column = (PyArrayObject *) PyObject_GetItem((PyObject *) pos, key);
+    Py_DECREF(key);
+    Py_DECREF(pos);
+    return column;
+}
+
 static PyObject *
-Py_EnzoFOF(PyObject *obj, PyObject *args)
+Py_EnzoFOF(PyObject *obj, PyObject *args, PyObject *kwds)
 {
     PyObject    *oxpos, *oypos, *ozpos;
     PyArrayObject    *xpos, *ypos, *zpos;
+    PyArrayObject    *pos[3];
     float link = 0.2;
     float fPeriod[3] = {1.0, 1.0, 1.0};
+    double scale[3] = {1.0, 1.0, 1.0};
 	int nMembers = 8;
-    int i, num_particles;
+    int nthreads = 1;
+    int union_find = 1;
+    int i, j, num_particles, by_column;
 	KDFOF kd;
 	int nBucket;
 	float fEps;
@@ -40,40 +82,43 @@ Py_EnzoFOF(PyObject *obj, PyObject *args)
 	int sec,usec;
 	PyArrayObject *particle_group_id;
     PyObject *return_value;
+    static char *kwlist[] = {"xpos", "ypos", "zpos", "link", "period",
+                             "nmembers", "scale", "nthreads", "union", NULL};
 
     xpos=ypos=zpos=NULL;
 
-    if (!PyArg_ParseTuple(args, "OOO|f(fff)i",
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OOO|f(fff)i(ddd)ip", kwlist,
         &oxpos, &oypos, &ozpos, &link,
         &fPeriod[0], &fPeriod[1], &fPeriod[2],
-        &nMembers))
+        &nMembers, &scale[0], &scale[1], &scale[2], &nthreads,
+        &union_find))
     return PyErr_Format(_FOFerror,
             "EnzoFOF: Invalid parameters.");
 
-    /* First the regular source arrays */
+    /* The positions are either three arrays, or an (N, 3) array given as
+       xpos with ypos and zpos None.  They are read in place and divided
+       by scale as they are copied into the kd structure. */
+
+    by_column = (oypos == Py_None) && (ozpos == Py_None);
 
-    xpos    = (PyArrayObject *) PyArray_FromAny(oxpos,
-                    PyArray_DescrFromType(NPY_FLOAT64), 1, 1,
-                    NPY_ARRAY_INOUT_ARRAY | NPY_ARRAY_WRITEBACKIFCOPY, NULL);
+    xpos = convert_position_array(oxpos, by_column ? 0 : -1);
     if(!xpos){
     PyErr_Format(_FOFerror,
-             "EnzoFOF: xpos didn't work.");
+             "EnzoFOF: xpos must be one-dimensional, or (N, 3) if ypos and zpos are None.");
     goto _fail;
     }
     num_particles = PyArray_SIZE(xpos);
 
-    ypos    = (PyArrayObject *) PyArray_FromAny(oypos,
-                    PyArray_DescrFromType(NPY_FLOAT64), 1, 1,
-                    NPY_ARRAY_INOUT_ARRAY | NPY_ARRAY_WRITEBACKIFCOPY, NULL);
+    ypos = convert_position_array(by_column ? oxpos : oypos,
+                                  by_column ? 1 : -1);
     if((!ypos)||(PyArray_SIZE(ypos) != num_particles)) {
     PyErr_Format(_FOFerror,
              "EnzoFOF: xpos and ypos must be the same length.");
     goto _fail;
     }
 
-    zpos    = (PyArrayObject *) PyArray_FromAny(ozpos,
-                    PyArray_DescrFromType(NPY_FLOAT64), 1, 1,
-                    NPY_ARRAY_INOUT_ARRAY | NPY_ARRAY_WRITEBACKIFCOPY, NULL);
+    zpos = convert_position_array(by_column ? oxpos : ozpos,
+                                  by_column ? 2 : -1);
     if((!zpos)||(PyArray_SIZE(zpos) != num_particles)) {
     PyErr_Format(_FOFerror,
              "EnzoFOF: xpos and zpos must be the same length.");
@@ -100,16 +145,28 @@ Py_EnzoFOF(PyObject *obj, PyObject *args)
     kd->nActive = num_particles;
 	kd->p = (PARTICLEFOF *)malloc(kd->nActive*sizeof(PARTICLEFOF));
 	assert(kd->p != NULL);
-	for (i = 0; i < num_particles; i++) {
-	  kd->p[i].iOrder = i;
-	  kd->p[i].r[0] = (float)(*(npy_float64*) PyArray_GETPTR1(xpos, i));
-	  kd->p[i].r[1] = (float)(*(npy_float64*) PyArray_GETPTR1(ypos, i));
-	  kd->p[i].r[2] = (float)(*(npy_float64*) PyArray_GETPTR1(zpos, i));
+	pos[0] = xpos;
+	pos[1] = ypos;
+	pos[2] = zpos;
+	for (i = 0; i < num_particles; i++) kd->p[i].iOrder = i;
+	for (j = 0; j < 3; j++) {
+	  if (PyArray_TYPE(pos[j]) == NPY_FLOAT32) {
+	    for (i = 0; i < num_particles; i++)
+	      kd->p[i].r[j] = (float)
+	        (*(npy_float32*) PyArray_GETPTR1(pos[j], i) / scale[j]);
+	  } else {
+	    for (i = 0; i < num_particles; i++)
+	      kd->p[i].r[j] = (float)
+	        (*(npy_float64*) PyArray_GETPTR1(pos[j], i) / scale[j]);
+	  }
 	}
 
 	kdBuildTreeFoF(kd);
 	kdTimeFoF(kd,&sec,&usec);
-	nGroup = kdFoF(kd,fEps);
+	/* kdFoF, the original search, is kept for comparison and always
+	   runs on one thread */
+	if (union_find) nGroup = kdFoFUnion(kd,fEps,nthreads);
+	else nGroup = kdFoF(kd,fEps);
 	kdTimeFoF(kd,&sec,&usec);
 	if (bVerbose) printf("Number of initial groups:%d\n",nGroup);
 	nGroup = kdTooSmallFoF(kd,nMembers);
@@ -164,7 +221,7 @@ _fail:
 }
 
 static PyMethodDef _FOFMethods[] = {
-    {"RunFOF", Py_EnzoFOF, METH_VARARGS},
+    {"RunFOF", (PyCFunction) Py_EnzoFOF, METH_VARARGS | METH_KEYWORDS},
     {NULL, NULL} /* Sentinel */
 };
 
@@ -8,9 +8,27 @@
 #include <sys/time.h>
 #endif
 #include <assert.h>
+#ifdef _OPENMP
+#include <omp.h>
+#endif
 #include "kd.h"
 #include "tipsydefs.h"
 
+/*
+ ** Union-find with atomic updates, so that kdFoFUnion can link particles
+ ** from several threads at once.
+ */
+#if defined(_OPENMP) && defined(__GNUC__)
+#define FOF_THREADS
+#define UF_LOAD(p)	__atomic_load_n(&(p),__ATOMIC_RELAXED)
+#define UF_CAS(p,old,new)\
+	__atomic_compare_exchange_n(&(p),&(old),(new),0,\
+		__ATOMIC_RELAXED,__ATOMIC_RELAXED)
+#else
+#define UF_LOAD(p)	(p)
+#define UF_CAS(p,old,new)	((p) == (old) ? ((p) = (new), 1) : 0)
+#endif
+
 
 void kdTimeFoF(KDFOF kd,int *puSecond,int *puMicro)
 {
@@ -378,6 +396,213 @@ int kdFoF(KDFOF kd,float fEps)
 	}
 
 
+static int ufFind(int *pParent,int i)
+{
+	int p,gp;
+
+	while ((p = UF_LOAD(pParent[i])) != i) {
+		/*
+		 ** Halve the path as we go.
+		 */
+		gp = UF_LOAD(pParent[p]);
+		if (gp != p) UF_CAS(pParent[i],p,gp);
+		i = p;
+		}
+	return(i);
+	}
+
+
+static void ufUnion(int *pParent,int i,int j)
+{
+	int t;
+
+	while (1) {
+		i = ufFind(pParent,i);
+		j = ufFind(pParent,j);
+		if (i == j) return;
+		/*
+		 ** Always attach the larger root to the smaller, so the root of
+		 ** each group is its first particle.
+		 */
+		if (i > j) {
+			t = i;
+			i = j;
+			j = t;
+			}
+		t = j;
+		if (UF_CAS(pParent[j],t,i)) return;
+		}
+	}
+
+
+static int fofShifts(float fMin1,float fMax1,float fMin2,float fMax2,
+					 float fPeriod,float fEps2,float *fShift,float *fGap2)
+{
+	/*
+	 ** Find the periodic shifts of the first interval that bring it within
+	 ** the linking length of the second, and the smallest square gap.
+	 */
+	float fGap,fShiftTry[3];
+	int i,nShift;
+
+	fShiftTry[0] = 0.0;
+	fShiftTry[1] = fPeriod;
+	fShiftTry[2] = -fPeriod;
+	nShift = 0;
+	*fGap2 = fEps2;
+	for (i=0;i<3;++i) {
+		fGap = fMin2 - (fMax1 + fShiftTry[i]);
+		if (fMin1 + fShiftTry[i] - fMax2 > fGap)
+			fGap = fMin1 + fShiftTry[i] - fMax2;
+		if (fGap < 0.0) fGap = 0.0;
+		if (fGap*fGap <= fEps2) {
+			fShift[nShift++] = fShiftTry[i];
+			if (fGap*fGap < *fGap2) *fGap2 = fGap*fGap;
+			}
+		}
+	return(nShift);
+	}
+
+
+static void fofLinkBucket(KDFOF kd,int iBucket,float fEps2,int *pParent)
+{
+	/*
+	 ** Link the particles of a bucket to those of all buckets at or after
+	 ** it in the tree order.
+	 */
+	PARTICLEFOF *p;
+	KDNFOF *c;
+	int cp,pi,pj,pjStart,d,ix,iy,iz;
+	int nShift[3];
+	float fShift[3][3],fGap2[3];
+	float dx,dy,dz,sx,sy,sz,fMax,fMax2;
+
+	p = kd->p;
+	c = kd->kdNodes;
+	cp = ROOTFOF;
+	while (1) {
+		if (c[cp].pUpper < c[iBucket].pLower) goto NextCell;
+		for (d=0;d<3;++d) {
+			nShift[d] = fofShifts(c[iBucket].bnd.fMin[d],c[iBucket].bnd.fMax[d],
+								  c[cp].bnd.fMin[d],c[cp].bnd.fMax[d],
+								  kd->fPeriod[d],fEps2,fShift[d],&fGap2[d]);
+			if (nShift[d] == 0) goto NextCell;
+			}
+		if (fGap2[0] + fGap2[1] + fGap2[2] > fEps2) goto NextCell;
+		if (c[cp].iDim >= 0) {
+			cp = LOWERFOF(cp);
+			continue;
+			}
+		/*
+		 ** If all pairs are closer than the linking length, as in the
+		 ** ContainedCell case of kdFoF, link every particle to the first
+		 ** particle of the other bucket.
+		 */
+		fMax2 = 0.0;
+		for (d=0;d<3 && nShift[d]==1;++d) {
+			fMax = c[cp].bnd.fMax[d] - (c[iBucket].bnd.fMin[d] + fShift[d][0]);
+			if (c[iBucket].bnd.fMax[d] + fShift[d][0] - c[cp].bnd.fMin[d] > fMax)
+				fMax = c[iBucket].bnd.fMax[d] + fShift[d][0] - c[cp].bnd.fMin[d];
+			fMax2 += fMax*fMax;
+			}
+		if (d == 3 && fMax2 < fEps2) {
+			for (pi=c[iBucket].pLower;pi<=c[iBucket].pUpper;++pi)
+				ufUnion(pParent,pi,c[cp].pLower);
+			for (pj=c[cp].pLower;pj<=c[cp].pUpper;++pj)
+				ufUnion(pParent,pj,c[iBucket].pLower);
+			goto NextCell;
+			}
+		for (pi=c[iBucket].pLower;pi<=c[iBucket].pUpper;++pi) {
+			pjStart = c[cp].pLower;
+			if (pjStart <= pi) pjStart = pi+1;
+			for (ix=0;ix<nShift[0];++ix) {
+				sx = p[pi].r[0] + fShift[0][ix];
+				for (iy=0;iy<nShift[1];++iy) {
+					sy = p[pi].r[1] + fShift[1][iy];
+					for (iz=0;iz<nShift[2];++iz) {
+						sz = p[pi].r[2] + fShift[2][iz];
+						for (pj=pjStart;pj<=c[cp].pUpper;++pj) {
+							dx = sx - p[pj].r[0];
+							dy = sy - p[pj].r[1];
+							dz = sz - p[pj].r[2];
+							if (dx*dx + dy*dy + dz*dz < fEps2)
+								ufUnion(pParent,pi,pj);
+							}
+						}
+					}
+				}
+			}
+	NextCell:
+		SETNEXTFOF(cp);
+		if (cp == ROOTFOF) break;
+		}
+	}
+
+
+int kdFoFUnion(KDFOF kd,float fEps,int nThreads)
+{
+	/*
+	 ** The same groups as kdFoF, found by linking all pairs of particles
+	 ** closer than fEps with a union-find over the buckets of the tree,
+	 ** which can be divided among nThreads threads.  Groups are numbered
+	 ** in the order of their first particle in the tree, as in kdFoF.
+	 */
+	PARTICLEFOF *p;
+	KDNFOF *c;
+	int *pParent,*pBucket;
+	int i,cp,nBucket,iGroup;
+	float fEps2;
+
+	p = kd->p;
+	c = kd->kdNodes;
+	fEps2 = fEps*fEps;
+#ifndef FOF_THREADS
+	nThreads = 1;
+#endif
+	if (nThreads < 1) nThreads = 1;
+
+	pParent = (int *)malloc(kd->nActive*sizeof(int));
+	assert(pParent != NULL);
+	for (i=0;i<kd->nActive;++i) pParent[i] = i;
+	/*
+	 ** Make a list of the buckets.
+	 */
+	pBucket = (int *)malloc(kd->nActive*sizeof(int));
+	assert(pBucket != NULL);
+	nBucket = 0;
+	cp = ROOTFOF;
+	while (1) {
+		if (c[cp].iDim >= 0) {
+			cp = LOWERFOF(cp);
+			continue;
+			}
+		pBucket[nBucket++] = cp;
+		SETNEXTFOF(cp);
+		if (cp == ROOTFOF) break;
+		}
+
+#ifdef FOF_THREADS
+#pragma omp parallel for num_threads(nThreads) schedule(dynamic,16)
+#endif
+	for (i=0;i<nBucket;++i) fofLinkBucket(kd,pBucket[i],fEps2,pParent);
+
+	/*
+	 ** The root of each group is its first particle, so the groups are
+	 ** numbered as they are found.
+	 */
+	iGroup = 0;
+	for (i=0;i<kd->nActive;++i) {
+		cp = ufFind(pParent,i);
+		if (cp == i) p[i].iGroup = ++iGroup;
+		else p[i].iGroup = p[cp].iGroup;
+		}
+	free(pBucket);
+	free(pParent);
+	kd->nGroup = iGroup+1;
+	return(kd->nGroup-1);
+	}
+
+
 int kdTooSmallFoF(KDFOF kd,int nMembers)
 {
 	int *pnMembers,*pMap;
@@ -184,6 +184,7 @@ int kdInitFoF(KDFOF *,int,float *);
 void kdReadTipsyFoF(KDFOF,FILE *,int,int,int);
 void kdBuildTreeFoF(KDFOF);
 int kdFoF(KDFOF,float);
+int kdFoFUnion(KDFOF,float,int);
 int kdTooSmallFoF(KDFOF,int);
 void kdOrderFoF(KDFOF);
 void kdOutGroupFoF(KDFOF,char *);
@@ -13,6 +13,7 @@ halo finding
 # The full license is in the file COPYING.txt, distributed with this software.
 # -----------------------------------------------------------------------------
 
+import copy
 import gc
 
 import numpy as np
@@ -26,7 +27,10 @@ from yt.utilities.parallel_tools.parallel_analysis_interface import (
 from yt.utilities.physical_constants import mass_sun_cgs
 from yt.utilities.physical_ratios import TINY, rho_crit_g_cm3_h2
 from yt_astro_analysis.halo_analysis.halo_finding.fof.EnzoFOF import RunFOF
-from yt_astro_analysis.halo_analysis.halo_finding.hop.EnzoHop import RunHOP
+from yt_astro_analysis.halo_analysis.halo_finding.hop.EnzoHop import (
+    FindHOPGroups,
+    RegroupHOP,
+)
 
 
 class Halo:
@@ -597,18 +601,26 @@ class HaloList:
         self.particle_fields = {}
         for field in self._fields:
             tot_part = self._data_source[(self.ptype, field)].size
+            # avoid copying fields that already have the right type
             if field == "particle_index":
                 self.particle_fields[field] = self._data_source[(self.ptype, field)][
                     ii
-                ].astype("int64")
+                ].astype("int64", copy=False)
             else:
-                self.particle_fields[field] = self._data_source[(self.ptype, field)][
-                    ii
-                ].astype("float64")
+                values = self._data_source[(self.ptype, field)][ii]
+                # the finders read float32 and float64 positions directly
+                if values.dtype not in (np.float32, np.float64):
+                    values = values.astype("float64")
+                self.particle_fields[field] = values
             del self._data_source[(self.ptype, field)]
         self._base_indices = np.arange(tot_part)[ii]
         gc.collect()
 
+    def _position_scale(self):
+        # the finders divide the positions by the period in their own units
+        units = self.particle_fields["particle_position_x"].units
+        return tuple(self.period.to_value(units))
+
     def _parse_output(self):
         unique_ids = np.unique(self.tags)
         counts = np.bincount(self.tags + 1)
@@ -653,38 +665,82 @@ class HOPHaloList(HaloList):
     _halo_class = HOPHalo
     _fields = [f"particle_position_{ax}" for ax in "xyz"] + ["particle_mass"]
 
-    def __init__(self, data_source, threshold=160.0, ptype="all"):
+    def __init__(
+        self,
+        data_source,
+        threshold=160.0,
+        ptype="all",
+        nthreads=1,
+        ndens=64,
+        nhop=None,
+        nmerge=4,
+        nbucket=16,
+    ):
         self.threshold = threshold
+        self.nthreads = nthreads
+        self.ndens = ndens
+        self.nhop = ndens if nhop is None else nhop
+        self.nmerge = nmerge
+        self.nbucket = nbucket
         mylog.info("Initializing HOP")
         HaloList.__init__(self, data_source, ptype=ptype)
 
     def _run_finder(self):
-        self.densities, self.tags = RunHOP(
-            self.particle_fields["particle_position_x"] / self.period[0],
-            self.particle_fields["particle_position_y"] / self.period[1],
-            self.particle_fields["particle_position_z"] / self.period[2],
+        # positions are divided by the period in FindHOPGroups to avoid copies
+        self.densities, self._hop_groups = FindHOPGroups(
+            self.particle_fields["particle_position_x"],
+            self.particle_fields["particle_position_y"],
+            self.particle_fields["particle_position_z"],
             self.particle_fields["particle_mass"].in_units("Msun"),
-            self.threshold,
+            nthreads=self.nthreads,
+            scale=self._position_scale(),
+            ndens=self.ndens,
+            nhop=self.nhop,
+            nmerge=self.nmerge,
+            nbucket=self.nbucket,
         )
+        self._regroup()
+
+    def _regroup(self):
+        # only the merging of groups depends on the threshold
+        self.tags = RegroupHOP(self.densities, self._hop_groups, self.threshold)
         self.particle_fields["densities"] = self.densities
         self.particle_fields["tags"] = self.tags
 
+    def regroup(self, threshold):
+        """
+        Return a new halo list with a different density *threshold*,
+        reusing the particles, densities, and groups found before merging.
+        """
+        mylog.info("Regrouping HOP with threshold %s", threshold)
+        halo_list = copy.copy(self)
+        halo_list.threshold = threshold
+        halo_list.particle_fields = dict(self.particle_fields)
+        halo_list._groups = []
+        halo_list._max_dens = {}
+        halo_list._regroup()
+        halo_list._parse_output()
+        return halo_list
+
 
 class FOFHaloList(HaloList):
     _name = "FOF"
     _halo_class = FOFHalo
 
-    def __init__(self, data_source, link=0.2, redshift=-1, ptype="all"):
+    def __init__(self, data_source, link=0.2, redshift=-1, ptype="all", nthreads=1):
         self.link = link
+        self.nthreads = nthreads
         mylog.info("Initializing FOF")
         HaloList.__init__(self, data_source, redshift=redshift, ptype=ptype)
 
     def _run_finder(self):
         self.tags = RunFOF(
-            self.particle_fields["particle_position_x"] / self.period[0],
-            self.particle_fields["particle_position_y"] / self.period[1],
-            self.particle_fields["particle_position_z"] / self.period[2],
+            self.particle_fields["particle_position_x"],
+            self.particle_fields["particle_position_y"],
+            self.particle_fields["particle_position_z"],
             self.link,
+            scale=self._position_scale(),
+            nthreads=self.nthreads,
         )
         self.densities = np.ones(self.tags.size, dtype="float64") * -1
         self.particle_fields["densities"] = self.densities
@@ -793,6 +849,29 @@ class HOPHaloFinder(GenericHaloFinder, HOPHaloList):
     save_particles : bool
         If True, output member particles for each halo.
         Default: True.
+    nthreads : int
+        The number of OpenMP threads used to find the density and
+        densest neighbor of each particle. Halos are the same for any
+        number of threads, but particle densities may differ from those
+        found with one thread by floating point rounding. This has no
+        effect if yt_astro_analysis was built without OpenMP.
+        Default: 1.
+    ndens : int
+        The number of nearest neighbors used to find the density of each
+        particle. Fewer neighbors make HOP faster, but densities noisier.
+        Default: 64.
+    nhop : int
+        The number of nearest neighbors searched for the densest
+        neighbor of each particle. If None, this is the same as ndens.
+        Default: None.
+    nmerge : int
+        The number of nearest neighbors used to find the boundaries
+        between groups when they are merged. This must be less than
+        nhop - 1.
+        Default: 4.
+    nbucket : int
+        The largest number of particles in a leaf of the kd tree.
+        Default: 16.
 
     Examples
     --------
@@ -814,6 +893,11 @@ class HOPHaloFinder(GenericHaloFinder, HOPHaloList):
         padding=0.02,
         total_mass=None,
         save_particles=True,
+        nthreads=1,
+        ndens=64,
+        nhop=None,
+        nmerge=4,
+        nbucket=16,
     ):
         if subvolume is not None:
             ds_LE = np.array(subvolume.left_edge)
@@ -870,12 +954,51 @@ class HOPHaloFinder(GenericHaloFinder, HOPHaloList):
             sub_mass = self._data_source.quantities.total_quantity(
                 (self.ptype, "particle_mass")
             ).in_units("Msun")
+        self._threshold_adjustment = total_mass / sub_mass
         HOPHaloList.__init__(
-            self, self._data_source, threshold * total_mass / sub_mass, ptype=self.ptype
+            self,
+            self._data_source,
+            threshold * self._threshold_adjustment,
+            ptype=self.ptype,
+            nthreads=nthreads,
+            ndens=ndens,
+            nhop=nhop,
+            nmerge=nmerge,
+            nbucket=nbucket,
         )
-        self._parse_halolist(total_mass / sub_mass)
+        self._parse_halolist(self._threshold_adjustment)
         self._join_halolists()
 
+    def regroup(self, threshold):
+        r"""
+        Return a new halo finder with a different density threshold.
+
+        The particles, their densities, and the groups found before
+        merging do not depend on the threshold, so they are reused and
+        only the merging of groups is repeated. This makes running HOP
+        with many thresholds little more expensive than running it once.
+
+        Parameters
+        ----------
+        threshold : float
+            The density threshold used when building halos.
+
+        Examples
+        --------
+        >>> import yt
+        >>> from yt_astro_analysis.halo_analysis.halo_finding.halo_objects import (
+        ...     HOPHaloFinder,
+        ... )
+        >>> ds = yt.load('Enzo_64/RD0006/RedshiftOutput0006')
+        >>> halos = HOPHaloFinder(ds, threshold=80)
+        >>> sweep = [halos] + [halos.regroup(t) for t in (160, 320)]
+        >>> print([len(my_halos) for my_halos in sweep])
+        """
+        halo_list = HOPHaloList.regroup(self, threshold * self._threshold_adjustment)
+        halo_list._parse_halolist(self._threshold_adjustment)
+        halo_list._join_halolists()
+        return halo_list
+
 
 class FOFHaloFinder(GenericHaloFinder, FOFHaloList):
     r"""Friends-of-friends halo finder.
@@ -914,6 +1037,11 @@ class FOFHaloFinder(GenericHaloFinder, FOFHaloList):
     save_particles : bool
         If True, output member particles for each halo.
         Default: True.
+    nthreads : int
+        The number of OpenMP threads used to link particles. Halos are
+        the same for any number of threads. This has no effect if
+        yt_astro_analysis was built without OpenMP.
+        Default: 1.
 
     Examples
     --------
@@ -934,6 +1062,7 @@ class FOFHaloFinder(GenericHaloFinder, FOFHaloList):
         ptype="all",
         padding=0.02,
         save_particles=True,
+        nthreads=1,
     ):
         if subvolume is not None:
             ds_LE = np.array(subvolume.left_edge)
@@ -992,6 +1121,7 @@ class FOFHaloFinder(GenericHaloFinder, FOFHaloList):
             linking_length,
             redshift=self.redshift,
             ptype=self.ptype,
+            nthreads=nthreads,
         )
         self._parse_halolist(1.0)
         self._join_halolists()
@@ -14,6 +14,7 @@
 #include "Python.h"
 #include "structmember.h"
 #include <stdio.h>
+#include <string.h>
 #include <math.h>
 #include <signal.h>
 #include <ctype.h>
@@ -31,41 +32,104 @@ void PrepareKD(KD kd);
 int kdMedianJst(KD kd, int d, int l, int u);
 void kdUpPass(KD kd, int iCell);
 void initgrouplist(Grouplist *g);
-void hop_main(KD kd, HC *my_comm, float densthresh);
+void hop_main(KD kd, HC *my_comm, float densthresh, int nThreads,
+              int nDens, int nHop, int nMerge);
 void regroup_main(float dens_outer, HC *my_comm);
 static PyObject *_HOPerror;
 
+static PyArrayObject *
+convert_position_array(PyObject *opos, int axis, double scale)
+{
+    /* One axis of the positions, divided by scale, as a float64 array.
+       If axis is -1, opos has one dimension, and otherwise it is an
+       (N, 3) array.  Float64 positions with a scale of 1 are used in
+       place, and all others are copied once. */
+
+    PyArrayObject *pos, *column, *scaled;
+    PyObject *key;
+    npy_intp i, n;
+    npy_float64 *data;
+    int ndim = axis < 0 ? 1 : 2;
+
+    pos = (PyArrayObject *) PyArray_FromAny(opos, NULL, ndim, ndim,
+                    NPY_ARRAY_ALIGNED, NULL);
+    if (pos == NULL) return NULL;
+    if ((PyArray_TYPE(pos) != NPY_FLOAT32) &&
+        (PyArray_TYPE(pos) != NPY_FLOAT64)) {
+        Py_SETREF(pos, (PyArrayObject *) PyArray_FromAny((PyObject *) pos,
+                    PyArray_DescrFromType(NPY_FLOAT64), ndim, ndim,
+                    NPY_ARRAY_ALIGNED, NULL));
+        if (pos == NULL) return NULL;
+    }
+
+    if (axis < 0) column = pos;
+    else {
+        if (PyArray_DIM(pos, 1) != 3) {
+            Py_DECREF(pos);
+            return NULL;
+        }
+        key = Py_BuildValue("(Ni)", PySlice_New(NULL, NULL, NULL), axis);
+        if (key == NULL) {
+            Py_DECREF(pos);
+            return NULL;
+        }
+        column = (PyArrayObject *) PyObject_GetItem((PyObject *) pos, key);
+        Py_DECREF(key);
+        Py_DECREF(pos);
+        if (column == NULL) return NULL;
+    }
+
+    if ((PyArray_TYPE(column) == NPY_FLOAT64) && (scale == 1.0))
+        return column;
+
+    scaled = (PyArrayObject *) PyArray_SimpleNew(1, PyArray_DIMS(column),
+                    NPY_FLOAT64);
+    if (scaled == NULL) {
+        Py_DECREF(column);
+        return NULL;
+    }
+    n = PyArray_SIZE(column);
+    data = (npy_float64 *) PyArray_DATA(scaled);
+    if (PyArray_TYPE(column) == NPY_FLOAT32) {
+        for (i = 0; i < n; i++)
+            data[i] = *(npy_float32 *) PyArray_GETPTR1(column, i) / scale;
+    } else {
+        for (i = 0; i < n; i++)
+            data[i] = *(npy_float64 *) PyArray_GETPTR1(column, i) / scale;
+    }
+    Py_DECREF(column);
+    return scaled;
+}
+
 int convert_particle_arrays(
     PyObject *oxpos, PyObject *oypos, PyObject *ozpos, PyObject *omass,
     PyArrayObject **xpos, PyArrayObject **ypos, PyArrayObject **zpos,
-      PyArrayObject **mass)
+      PyArrayObject **mass, double *scale)
 {
-    int num_particles;
+    /* The positions are either three arrays, or an (N, 3) array given as
+       xpos with ypos and zpos None. */
 
-    /* First the regular source arrays */
+    int num_particles;
+    int by_column = (oypos == Py_None) && (ozpos == Py_None);
 
-    *xpos    = (PyArrayObject *) PyArray_FromAny(oxpos,
-                    PyArray_DescrFromType(NPY_FLOAT64), 1, 1,
-                    NPY_ARRAY_INOUT_ARRAY | NPY_ARRAY_WRITEBACKIFCOPY, NULL);
+    *xpos = convert_position_array(oxpos, by_column ? 0 : -1, scale[0]);
     if(!*xpos){
     PyErr_Format(_HOPerror,
-             "EnzoHop: xpos didn't work.");
+             "EnzoHop: xpos must be one-dimensional, or (N, 3) if ypos and zpos are None.");
     return -1;
     }
     num_particles = PyArray_SIZE(*xpos);
 
-    *ypos    = (PyArrayObject *) PyArray_FromAny(oypos,
-                    PyArray_DescrFromType(NPY_FLOAT64), 1, 1,
-                    NPY_ARRAY_INOUT_ARRAY | NPY_ARRAY_WRITEBACKIFCOPY, NULL);
+    *ypos = convert_position_array(by_column ? oxpos : oypos,
+                                  by_column ? 1 : -1, scale[1]);
     if((!*ypos)||(PyArray_SIZE(*ypos) != num_particles)) {
     PyErr_Format(_HOPerror,
              "EnzoHop: xpos and ypos must be the same length.");
     return -1;
     }
 
-    *zpos    = (PyArrayObject *) PyArray_FromAny(ozpos,
-                    PyArray_DescrFromType(NPY_FLOAT64), 1, 1,
-                    NPY_ARRAY_INOUT_ARRAY | NPY_ARRAY_WRITEBACKIFCOPY, NULL);
+    *zpos = convert_position_array(by_column ? oxpos : ozpos,
+                                  by_column ? 2 : -1, scale[2]);
     if((!*zpos)||(PyArray_SIZE(*zpos) != num_particles)) {
     PyErr_Format(_HOPerror,
              "EnzoHop: xpos and zpos must be the same length.");
@@ -74,7 +138,7 @@ int convert_particle_arrays(
 
     *mass    = (PyArrayObject *) PyArray_FromAny(omass,
                     PyArray_DescrFromType(NPY_FLOAT64), 1, 1,
-                    NPY_ARRAY_INOUT_ARRAY | NPY_ARRAY_WRITEBACKIFCOPY, NULL);
+                    NPY_ARRAY_CARRAY_RO, NULL);
     if((!*mass)||(PyArray_SIZE(*mass) != num_particles)) {
     PyErr_Format(_HOPerror,
              "EnzoHop: xpos and mass must be the same length.");
@@ -85,37 +149,68 @@ int convert_particle_arrays(
 
 }
 
+void set_particle_arrays(KD kd,
+    PyArrayObject *xpos, PyArrayObject *ypos, PyArrayObject *zpos,
+    PyArrayObject *mass, PyArrayObject *densities)
+{
+    int d;
+    PyArrayObject *pos[3] = {xpos, ypos, zpos};
+
+    for (d = 0; d < 3; d++) {
+        kd->np_pos[d] = (char *) PyArray_DATA(pos[d]);
+        kd->np_stride[d] = PyArray_STRIDE(pos[d], 0);
+    }
+    kd->np_masses = (npy_float64*) PyArray_DATA(mass);
+    kd->np_densities = (npy_float64*) PyArray_DATA(densities);
+}
 
-static PyObject *
-Py_EnzoHop(PyObject *obj, PyObject *args)
+
+static int
+run_hop(PyObject *oxpos, PyObject *oypos, PyObject *ozpos, PyObject *omass,
+        float normalize_to, int nthreads, double *scale,
+        int nDens, int nHop, int nMerge, int nBucket, float thresh,
+        HC *my_comm, PyArrayObject **particle_density)
 {
-    PyObject    *oxpos, *oypos, *ozpos,
-                *omass;
+    /* Find the densities and groups of the particles, leaving the groups
+       and their boundaries in my_comm for regroup_main.  Particles with
+       densities below thresh are not put in groups.  Returns the number
+       of particles, or -1 with an exception set. */
 
     PyArrayObject    *xpos, *ypos, *zpos,
                      *mass;
     npy_float64 totalmass = 0.0;
-    float normalize_to = 1.0;
-    float thresh = 160.0;
     int i, num_particles;
     KD kd;
-    int nBucket = 16;
-    PyArrayObject *particle_density;
-    HC my_comm;
-    PyArrayObject *particle_group_id;
-    PyObject *return_value;
 
     xpos=ypos=zpos=mass=NULL;
-
-    if (!PyArg_ParseTuple(args, "OOOO|ff",
-        &oxpos, &oypos, &ozpos, &omass, &thresh, &normalize_to))
-    return PyErr_Format(_HOPerror,
-            "EnzoHop: Invalid parameters.");
+    kd = NULL;
+    *particle_density = NULL;
+
+    /* nHop < 0 means the same as nDens, and merging needs more
+       neighbors for hopping than for merging (see hop_main). */
+    if (nHop < 0) nHop = nDens;
+    if ((nDens < 1) || (nMerge < 1) || (nBucket < 1)) {
+        PyErr_Format(_HOPerror,
+            "EnzoHop: ndens, nmerge and nbucket must be positive.");
+        return -1;
+    }
+    if (nMerge >= nHop - 1) {
+        PyErr_Format(_HOPerror,
+            "EnzoHop: nmerge (%d) must be less than nhop - 1 (%d).",
+            nMerge, nHop - 1);
+        return -1;
+    }
 
     num_particles = convert_particle_arrays(
             oxpos, oypos, ozpos, omass,
-            &xpos, &ypos, &zpos, &mass);
+            &xpos, &ypos, &zpos, &mass, scale);
     if (num_particles < 0) goto _fail;
+    if ((nDens >= num_particles) || (nHop >= num_particles)) {
+        PyErr_Format(_HOPerror,
+            "EnzoHop: ndens and nhop must be less than the number of "
+            "particles (%d).", num_particles);
+        goto _fail;
+    }
 
     for(i = 0; i < num_particles; i++)
         totalmass+=*(npy_float64*)PyArray_GETPTR1(mass,i);
@@ -128,61 +223,33 @@ Py_EnzoHop(PyObject *obj, PyObject *args)
   kd->p = malloc(sizeof(PARTICLE)*num_particles);
   if (kd->p == NULL) {
     fprintf(stderr, "failed allocating particles.\n");
+    PyErr_NoMemory();
     goto _fail;
   }
 
  	/* Copy positions into kd structure. */
-    particle_density = (PyArrayObject *)
+    *particle_density = (PyArrayObject *)
             PyArray_SimpleNewFromDescr(1, PyArray_DIMS(xpos),
                     PyArray_DescrFromType(NPY_FLOAT64));
 
-    fprintf(stdout, "Copying arrays for %d particles\n", num_particles);
-    kd->np_masses = (npy_float64*) PyArray_DATA(mass);
-    kd->np_pos[0] = (npy_float64*) PyArray_DATA(xpos);
-    kd->np_pos[1] = (npy_float64*) PyArray_DATA(ypos);
-    kd->np_pos[2] = (npy_float64*) PyArray_DATA(zpos);
-    kd->np_densities = (npy_float64*) PyArray_DATA(particle_density);
+    fprintf(stdout, "Reading arrays for %d particles\n", num_particles);
+    set_particle_arrays(kd, xpos, ypos, zpos, mass, *particle_density);
     kd->totalmass = totalmass;
 	for (i = 0; i < num_particles; i++) kd->p[i].np_index = i;
 
-    my_comm.s = newslice();
-    my_comm.gl = (Grouplist*)malloc(sizeof(Grouplist));
-    if(my_comm.gl == NULL) {
+    my_comm->s = newslice();
+    my_comm->gl = (Grouplist*)malloc(sizeof(Grouplist));
+    if(my_comm->gl == NULL) {
         fprintf(stderr, "failed allocating Grouplist\n");
+        PyErr_NoMemory();
         goto _fail;
     }
-    initgrouplist(my_comm.gl);
+    initgrouplist(my_comm->gl);
 
     fprintf(stderr, "Calling hop... %d %0.3e\n",num_particles,thresh);
-    hop_main(kd, &my_comm, thresh);
-
-    fprintf(stderr, "Calling regroup...\n");
-    regroup_main(thresh, &my_comm);
-
-    // Now we need to get the groupID, realID and the density.
-    // This will give us the index into the original array.
-    // Additionally, note that we don't really need to tie the index
-    // back to the ID in this code, as we can do that back in the python code.
-    // All we need to do is provide density and group information.
-
-    // Tags (as per writetagsf77) are in gl.s->ntag+1 and there are gl.s->numlist of them.
-    particle_group_id = (PyArrayObject *)
-            PyArray_SimpleNewFromDescr(1, PyArray_DIMS(xpos),
-                    PyArray_DescrFromType(NPY_INT32));
-
-    for (i = 0; i < num_particles; i++) {
-      // tag is in gl.s->ntag[i+1]
-      *(npy_int32*)(PyArray_GETPTR1(particle_group_id, i)) =
-            (npy_int32) my_comm.s->ntag[i+1];
-    }
+    hop_main(kd, my_comm, thresh, nthreads, nDens, nHop, nMerge);
 
 	kdFinish(kd);
-    free(my_comm.gl);
-    free_slice(my_comm.s);
-
-    PyArray_UpdateFlags(particle_density, NPY_ARRAY_OWNDATA | PyArray_FLAGS(particle_density));
-    PyArray_UpdateFlags(particle_group_id, NPY_ARRAY_OWNDATA | PyArray_FLAGS(particle_group_id));
-    return_value = Py_BuildValue("NN", particle_density, particle_group_id);
 
     Py_DECREF(xpos);
     Py_DECREF(ypos);
@@ -193,22 +260,309 @@ Py_EnzoHop(PyObject *obj, PyObject *args)
     if(kd->p!=NULL)free(kd->p);
     */
 
-    return return_value;
+    return num_particles;
 
 _fail:
     Py_XDECREF(xpos);
     Py_XDECREF(ypos);
     Py_XDECREF(zpos);
     Py_XDECREF(mass);
+    Py_XDECREF(*particle_density);
+    *particle_density = NULL;
 
-    if(kd->p!=NULL)free(kd->p);
+    if((kd!=NULL)&&(kd->p!=NULL))free(kd->p);
+
+    return -1;
+}
+
+static void
+free_hop_comm(HC *my_comm, int free_gdensity)
+{
+    /* The group densities are freed by regroup_main if it has run. */
+    if (free_gdensity) free_vector(my_comm->gdensity, 0, my_comm->ngroups-1);
+    free_vector(my_comm->g1vec, 0, my_comm->nb);
+    free_vector(my_comm->g2vec, 0, my_comm->nb);
+    free_vector(my_comm->fdensity, 0, my_comm->nb);
+    free(my_comm->gl);
+    free_slice(my_comm->s);
+}
 
-    return NULL;
+static PyArrayObject *
+get_group_tags(HC *my_comm, int num_particles)
+{
+    int i;
+    npy_intp dims[1] = {num_particles};
+    PyArrayObject *particle_group_id;
+
+    // Tags (as per writetagsf77) are in gl.s->ntag+1 and there are gl.s->numlist of them.
+    particle_group_id = (PyArrayObject *)
+            PyArray_SimpleNewFromDescr(1, dims,
+                    PyArray_DescrFromType(NPY_INT32));
+    if (particle_group_id == NULL) return NULL;
 
+    for (i = 0; i < num_particles; i++) {
+      // tag is in gl.s->ntag[i+1]
+      *(npy_int32*)(PyArray_GETPTR1(particle_group_id, i)) =
+            (npy_int32) my_comm->s->ntag[i+1];
+    }
+    return particle_group_id;
+}
+
+static PyObject *
+Py_EnzoHop(PyObject *obj, PyObject *args, PyObject *kwds)
+{
+    PyObject    *oxpos, *oypos, *ozpos,
+                *omass;
+
+    float normalize_to = 1.0;
+    float thresh = 160.0;
+    int nthreads = 1;
+    double scale[3] = {1.0, 1.0, 1.0};
+    int num_particles;
+    int nBucket = 16, nDens = 64, nHop = -1, nMerge = 4;
+    PyArrayObject *particle_density;
+    HC my_comm;
+    PyArrayObject *particle_group_id;
+
+    static char *kwlist[] = {"xpos", "ypos", "zpos", "mass",
+                             "thresh", "normalize_to", "nthreads", "scale",
+                             "ndens", "nhop", "nmerge", "nbucket", NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OOOO|ffi(ddd)iiii", kwlist,
+        &oxpos, &oypos, &ozpos, &omass, &thresh, &normalize_to, &nthreads,
+        &scale[0], &scale[1], &scale[2], &nDens, &nHop, &nMerge, &nBucket))
+    return PyErr_Format(_HOPerror,
+            "EnzoHop: Invalid parameters.");
+
+    num_particles = run_hop(oxpos, oypos, ozpos, omass,
+            normalize_to, nthreads, scale, nDens, nHop, nMerge, nBucket,
+            thresh, &my_comm, &particle_density);
+    if (num_particles < 0) return NULL;
+
+    fprintf(stderr, "Calling regroup...\n");
+    regroup_main(thresh, &my_comm);
+
+    // Now we need to get the groupID, realID and the density.
+    // This will give us the index into the original array.
+    // Additionally, note that we don't really need to tie the index
+    // back to the ID in this code, as we can do that back in the python code.
+    // All we need to do is provide density and group information.
+
+    particle_group_id = get_group_tags(&my_comm, num_particles);
+    free_hop_comm(&my_comm, 0);
+    if (particle_group_id == NULL) {
+        Py_DECREF(particle_density);
+        return NULL;
+    }
+
+    return Py_BuildValue("NN", particle_density, particle_group_id);
+}
+
+static PyObject *
+Py_FindHOPGroups(PyObject *obj, PyObject *args, PyObject *kwds)
+{
+    /* Everything RunHOP does before regroup_main, which is all that does
+       not depend on the density threshold.  Returns the densities and a
+       tuple of the group of each particle, the peak density of each
+       group, and the pairs of groups sharing a boundary with the density
+       of each boundary, to be given to RegroupHOP. */
+
+    PyObject    *oxpos, *oypos, *ozpos,
+                *omass;
+
+    float normalize_to = 1.0;
+    int nthreads = 1;
+    double scale[3] = {1.0, 1.0, 1.0};
+    int i, num_particles;
+    int nBucket = 16, nDens = 64, nHop = -1, nMerge = 4;
+    npy_intp dims[1];
+    PyArrayObject *particle_density;
+    HC my_comm;
+    PyArrayObject *hop_tags, *group_density,
+                  *group1, *group2, *boundary_density;
+
+    static char *kwlist[] = {"xpos", "ypos", "zpos", "mass",
+                             "normalize_to", "nthreads", "scale",
+                             "ndens", "nhop", "nmerge", "nbucket", NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OOOO|fi(ddd)iiii", kwlist,
+        &oxpos, &oypos, &ozpos, &omass, &normalize_to, &nthreads,
+        &scale[0], &scale[1], &scale[2], &nDens, &nHop, &nMerge, &nBucket))
+    return PyErr_Format(_HOPerror,
+            "EnzoHop: Invalid parameters.");
+
+    /* A threshold of zero leaves every particle in its group. */
+    num_particles = run_hop(oxpos, oypos, ozpos, omass,
+            normalize_to, nthreads, scale, nDens, nHop, nMerge, nBucket,
+            0.0, &my_comm, &particle_density);
+    if (num_particles < 0) return NULL;
+
+    hop_tags = get_group_tags(&my_comm, num_particles);
+    dims[0] = my_comm.ngroups;
+    group_density = (PyArrayObject *)
+            PyArray_SimpleNewFromDescr(1, dims,
+                    PyArray_DescrFromType(NPY_FLOAT32));
+    dims[0] = my_comm.nb;
+    group1 = (PyArrayObject *)
+            PyArray_SimpleNewFromDescr(1, dims,
+                    PyArray_DescrFromType(NPY_FLOAT32));
+    group2 = (PyArrayObject *)
+            PyArray_SimpleNewFromDescr(1, dims,
+                    PyArray_DescrFromType(NPY_FLOAT32));
+    boundary_density = (PyArrayObject *)
+            PyArray_SimpleNewFromDescr(1, dims,
+                    PyArray_DescrFromType(NPY_FLOAT32));
+
+    if ((hop_tags == NULL) || (group_density == NULL) || (group1 == NULL) ||
+        (group2 == NULL) || (boundary_density == NULL)) {
+        free_hop_comm(&my_comm, 1);
+        Py_DECREF(particle_density);
+        Py_XDECREF(hop_tags);
+        Py_XDECREF(group_density);
+        Py_XDECREF(group1);
+        Py_XDECREF(group2);
+        Py_XDECREF(boundary_density);
+        return NULL;
+    }
+
+    for (i = 0; i < my_comm.ngroups; i++)
+        *(npy_float32*)PyArray_GETPTR1(group_density, i) =
+                my_comm.gdensity[i];
+    for (i = 0; i < my_comm.nb; i++) {
+        *(npy_float32*)PyArray_GETPTR1(group1, i) = my_comm.g1vec[i];
+        *(npy_float32*)PyArray_GETPTR1(group2, i) = my_comm.g2vec[i];
+        *(npy_float32*)PyArray_GETPTR1(boundary_density, i) =
+                my_comm.fdensity[i];
+    }
+    free_hop_comm(&my_comm, 1);
+
+    return Py_BuildValue("N(NNNNN)", particle_density, hop_tags,
+            group_density, group1, group2, boundary_density);
+}
+
+static PyObject *
+Py_RegroupHOP(PyObject *obj, PyObject *args, PyObject *kwds)
+{
+    /* Merge the groups found by FindHOPGroups with a density threshold,
+       as RunHOP does, and return the group of each particle. */
+
+    PyObject    *odensity, *ogroups;
+    PyObject    *ohop_tags, *ogroup_density,
+                *ogroup1, *ogroup2, *oboundary_density;
+    PyArrayObject *density, *hop_tags, *group_density,
+                  *group1, *group2, *boundary_density;
+    PyArrayObject *particle_group_id = NULL;
+    float thresh = 160.0;
+    int i, num_particles, ngroups, nb;
+    npy_int32 *tags;
+    npy_float32 *g1, *g2;
+    npy_float64 *dens;
+    HC my_comm;
+
+    static char *kwlist[] = {"densities", "groups", "thresh", NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OO|f", kwlist,
+        &odensity, &ogroups, &thresh))
+    return PyErr_Format(_HOPerror,
+            "EnzoHop: Invalid parameters.");
+    if (!PyArg_ParseTuple(ogroups, "OOOOO", &ohop_tags, &ogroup_density,
+        &ogroup1, &ogroup2, &oboundary_density))
+    return PyErr_Format(_HOPerror,
+            "EnzoHop: groups must be as returned by FindHOPGroups.");
+
+    density = (PyArrayObject *) PyArray_FROMANY(odensity,
+            NPY_FLOAT64, 1, 1, NPY_ARRAY_CARRAY_RO);
+    hop_tags = (PyArrayObject *) PyArray_FROMANY(ohop_tags,
+            NPY_INT32, 1, 1, NPY_ARRAY_CARRAY_RO);
+    group_density = (PyArrayObject *) PyArray_FROMANY(ogroup_density,
+            NPY_FLOAT32, 1, 1, NPY_ARRAY_CARRAY_RO);
+    group1 = (PyArrayObject *) PyArray_FROMANY(ogroup1,
+            NPY_FLOAT32, 1, 1, NPY_ARRAY_CARRAY_RO);
+    group2 = (PyArrayObject *) PyArray_FROMANY(ogroup2,
+            NPY_FLOAT32, 1, 1, NPY_ARRAY_CARRAY_RO);
+    boundary_density = (PyArrayObject *) PyArray_FROMANY(oboundary_density,
+            NPY_FLOAT32, 1, 1, NPY_ARRAY_CARRAY_RO);
+    if ((density == NULL) || (hop_tags == NULL) || (group_density == NULL) ||
+        (group1 == NULL) || (group2 == NULL) || (boundary_density == NULL))
+        goto _finish;
+
+    num_particles = PyArray_SIZE(density);
+    ngroups = PyArray_SIZE(group_density);
+    nb = PyArray_SIZE(group1);
+    if ((PyArray_SIZE(hop_tags) != num_particles) ||
+        (PyArray_SIZE(group2) != nb) ||
+        (PyArray_SIZE(boundary_density) != nb)) goto _bad_groups;
+
+    /* Group numbers index the group arrays in regroup_main. */
+    tags = (npy_int32 *) PyArray_DATA(hop_tags);
+    g1 = (npy_float32 *) PyArray_DATA(group1);
+    g2 = (npy_float32 *) PyArray_DATA(group2);
+    for (i = 0; i < num_particles; i++)
+        if ((tags[i] < -1) || (tags[i] >= ngroups)) goto _bad_groups;
+    for (i = 0; i < nb; i++)
+        if ((g1[i] < 0) || (g1[i] >= ngroups) ||
+            (g2[i] < 0) || (g2[i] >= ngroups)) goto _bad_groups;
+
+    /* Rebuild what hop_main leaves for regroup_main, leaving out
+       particles below the threshold as binOutHop does. */
+    my_comm.gl = (Grouplist*)malloc(sizeof(Grouplist));
+    if(my_comm.gl == NULL) {
+        PyErr_NoMemory();
+        goto _finish;
+    }
+    initgrouplist(my_comm.gl);
+    my_comm.gl->npart = num_particles;
+    my_comm.gl->ngroups = ngroups;
+
+    my_comm.ngroups = ngroups;
+    my_comm.nb = nb;
+    my_comm.gdensity = vector(0, ngroups-1);
+    memcpy(my_comm.gdensity, PyArray_DATA(group_density),
+            ngroups*sizeof(float));
+    my_comm.g1vec = vector(0, nb);
+    memcpy(my_comm.g1vec, PyArray_DATA(group1), nb*sizeof(float));
+    my_comm.g2vec = vector(0, nb);
+    memcpy(my_comm.g2vec, PyArray_DATA(group2), nb*sizeof(float));
+    my_comm.fdensity = vector(0, nb);
+    memcpy(my_comm.fdensity, PyArray_DATA(boundary_density),
+            nb*sizeof(float));
+
+    my_comm.s = newslice();
+    my_comm.s->numlist = my_comm.s->numpart = num_particles;
+    my_comm.s->ntag = ivector(1, num_particles);
+    dens = (npy_float64 *) PyArray_DATA(density);
+    for (i = 0; i < num_particles; i++) {
+        if (dens[i] < thresh) my_comm.s->ntag[i+1] = -1;
+        else my_comm.s->ntag[i+1] = tags[i];
+    }
+
+    fprintf(stderr, "Calling regroup...\n");
+    regroup_main(thresh, &my_comm);
+
+    particle_group_id = get_group_tags(&my_comm, num_particles);
+    free_hop_comm(&my_comm, 0);
+    goto _finish;
+
+_bad_groups:
+    PyErr_Format(_HOPerror,
+        "EnzoHop: groups must be as returned by FindHOPGroups.");
+
+_finish:
+    Py_XDECREF(density);
+    Py_XDECREF(hop_tags);
+    Py_XDECREF(group_density);
+    Py_XDECREF(group1);
+    Py_XDECREF(group2);
+    Py_XDECREF(boundary_density);
+
+    return (PyObject *) particle_group_id;
 }
 
 static PyMethodDef _HOPMethods[] = {
-    {"RunHOP", Py_EnzoHop, METH_VARARGS},
+    {"RunHOP", (PyCFunction) Py_EnzoHop, METH_VARARGS | METH_KEYWORDS},
+    {"FindHOPGroups", (PyCFunction) Py_FindHOPGroups,
+            METH_VARARGS | METH_KEYWORDS},
+    {"RegroupHOP", (PyCFunction) Py_RegroupHOP, METH_VARARGS | METH_KEYWORDS},
     {NULL, NULL} /* Sentinel */
 };
 
@@ -239,6 +593,7 @@ kDTreeType_init(kDTreeType *self, PyObject *args, PyObject *kwds)
     PyObject    *oxpos, *oypos, *ozpos,
                 *omass;
     npy_float64 totalmass = 0.0;
+    double scale[3] = {1.0, 1.0, 1.0};
 
     self->xpos=self->ypos=self->zpos=self->mass=NULL;
 
@@ -252,7 +607,11 @@ kDTreeType_init(kDTreeType *self, PyObject *args, PyObject *kwds)
 
     self->num_particles = convert_particle_arrays(
             oxpos, oypos, ozpos, omass,
-            &self->xpos, &self->ypos, &self->zpos, &self->mass);
+            &self->xpos, &self->ypos, &self->zpos, &self->mass, scale);
+    if (self->num_particles < 0) {
+      self->kd->p = NULL;
+      goto _fail;
+    }
 
     self->kd->nActive = self->num_particles;
     self->kd->p = malloc(sizeof(PARTICLE)*self->num_particles);
@@ -274,11 +633,8 @@ kDTreeType_init(kDTreeType *self, PyObject *args, PyObject *kwds)
     totalmass /= normalize_to;
 
 
-    self->kd->np_masses = (npy_float64 *)PyArray_DATA(self->mass);
-    self->kd->np_pos[0] = (npy_float64 *)PyArray_DATA(self->xpos);
-    self->kd->np_pos[1] = (npy_float64 *)PyArray_DATA(self->ypos);
-    self->kd->np_pos[2] = (npy_float64 *)PyArray_DATA(self->zpos);
-    self->kd->np_densities = (npy_float64 *)PyArray_DATA(self->densities);
+    set_particle_arrays(self->kd, self->xpos, self->ypos, self->zpos,
+                        self->mass, self->densities);
     self->kd->totalmass = totalmass;
 
     PrepareKD(self->kd);
@@ -293,6 +649,7 @@ kDTreeType_init(kDTreeType *self, PyObject *args, PyObject *kwds)
         Py_XDECREF(self->mass);
 
         if(self->kd->p!=NULL)free(self->kd->p);
+        self->kd->p = NULL;
 
         return -1;
 }
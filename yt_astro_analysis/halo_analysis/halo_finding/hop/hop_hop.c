@@ -42,6 +42,7 @@ int ReadSimulationFile(KD, FILE *);
 void smDensityTH(SMX smx,int pi,int nSmooth,int *pList,float *fList);
 
 void smHop(SMX smx,int pi,int nSmooth,int *pList,float *fList);
+void FindMutualHops(SMX smx);
 void FindGroups(SMX smx);
 void SortGroups(SMX smx);
 
@@ -54,19 +55,20 @@ void binOutHop(SMX smx, HC *my_comm, float densthresh);
 void outGroupMerge(SMX smx, HC *my_comm);
 
 /* void main(int argc,char **argv) */
-void hop_main(KD kd, HC *my_comm, float densthresh)
+void hop_main(KD kd, HC *my_comm, float densthresh, int nThreads,
+		int nDens, int nHop, int nMerge)
 {
   /*	KD kd; */
 	SMX smx;
 	int nSmooth,j;
 	char achFile[80];
 	float fPeriod[3];
-	int bDensity,bGroup,bSym,bMerge,nDens,nHop,nMerge,bTopHat;
+	int bDensity,bGroup,bSym,bMerge,bTopHat;
 	float fDensThresh;
 
-	nSmooth = 64;
-	nDens = 64;
-	nHop = -1;
+	/* nDens, nHop and nMerge are given by the caller.  The original
+	defaults were nDens = 64, nHop = -1 (the same as nDens) and
+	nMerge = 4. */
 /*    fDensThresh = 3.0; */
     fDensThresh = -1.0;
 	bDensity = 3;
@@ -77,7 +79,10 @@ void hop_main(KD kd, HC *my_comm, float densthresh)
 	strcpy(achFile,"output_hop");
 /*	for (j=0;j<3;++j) fPeriod[j] = HUGE; */
 	for (j=0;j<3;++j) fPeriod[j] = 1.0;
-	nMerge = 4;
+#ifndef _OPENMP
+	nThreads = 1;	/* Built without OpenMP */
+#endif
+	if (nThreads < 1) nThreads = 1;
 
 
 	if (nHop<0) nHop=nDens;
@@ -107,6 +112,7 @@ void hop_main(KD kd, HC *my_comm, float densthresh)
 	smx->nMerge = nMerge;
 	smx->nGroups = 0;
 	smx->fDensThresh = fDensThresh;
+	smx->nThreads = nThreads;
 
 	INFORM("Building Tree...\n");
 	kdBuildTree(kd);
@@ -114,12 +120,21 @@ void hop_main(KD kd, HC *my_comm, float densthresh)
 	if (bDensity) {
 	    INFORM("Finding Densities...\n");
 	    if (bTopHat) smSmooth(smx,smDensityTH);
-	    else if (bSym) smSmooth(smx,smDensitySym);
+	    else if (bSym) {
+		if (nThreads > 1) smDensitySymParallel(smx);
+		else smSmooth(smx,smDensitySym);
+	    }
 	    else smSmooth(smx,smDensity);
 	}  /* Else, we've read them */
 	if (bGroup) {
 	     INFORM("Finding Densest Neighbors...\n");
-	     if (bDensity && nHop<nSmooth) smReSmooth(smx,smHop);
+	     if (bDensity && nHop<nSmooth) {
+		if (nThreads > 1) {
+		    smReSmoothParallel(smx,smHop);
+		    FindMutualHops(smx);
+		}
+		else smReSmooth(smx,smHop);
+	     }
 	     else {
 		if (nHop>=nSmooth) {
 		    nSmooth = nHop+1;
@@ -227,8 +242,10 @@ sorting below */
 
     /* check to see if the particle we link to doesn't link back
        to ourselves, pi. If it does, connect this particle (pi) to itself.
-       This can only happen if pList[max] < pi*/
-    if (pList[max] < pi) {
+       This can only happen if pList[max] < pi.  With more than one
+       thread, pList[max] may not be done yet, so FindMutualHops()
+       does this afterward. */
+    if (smx->nThreads == 1 && pList[max] < pi) {
         if (smx->kd->p[pList[max]].iHop == -1-pi) {
             smx->kd->p[pi].iHop = -1-pi;
         }
@@ -245,6 +262,26 @@ sorting below */
 
 /* ----------------------------------------------------------------- */
 
+void FindMutualHops(SMX smx)
+/* Connect each particle to itself if the particle it hops to hops back
+to it, as smHop() does when run with one thread.  A particle that has
+already been connected to itself never hops to a later particle, so
+the result is the same as if it were done in smHop(). */
+{
+    int j, target;
+    PARTICLE *p;
+
+    for (j=0, p=smx->kd->p;j<smx->kd->nActive;j++,p++) {
+	if (p->iHop >= 0) continue;
+	target = -1-p->iHop;
+	if (target < j && smx->kd->p[target].iHop == -1-j)
+	    p->iHop = -1-j;
+    }
+    return;
+}
+
+/* ----------------------------------------------------------------- */
+
 void FindGroups(SMX smx)
 /* Number the maxima. Trace each particle uphill to a maximum. */
 /* The local maxima were stored as in iHop as -1-ID (negative numbers);
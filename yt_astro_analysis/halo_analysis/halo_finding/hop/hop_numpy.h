@@ -5,7 +5,8 @@
 #define NP_DENS(kd, in) \
     kd->np_densities[kd->p[in].np_index]
 #define NP_POS(kd, in, dim) \
-    kd->np_pos[dim][kd->p[in].np_index]
+    (*(npy_float64 *)(kd->np_pos[dim] + \
+        kd->p[in].np_index*kd->np_stride[dim]))
 #define NP_MASS(kd, in) \
     (kd->np_masses[kd->p[in].np_index]/kd->totalmass)
 
@@ -19,7 +19,11 @@ the case of equal mass particles. */
 #define _USE_MATH_DEFINES
 #endif
 #include <math.h>
+#include <string.h>
 #include <assert.h>
+#ifdef _OPENMP
+#include <omp.h>
+#endif
 #include "smooth.h"
 #include "kd.h"
 #include "hop_numpy.h"
@@ -31,6 +35,10 @@ the case of equal mass particles. */
 
 #define IMARK 1		/* All particles are marked to be included */
 
+/* The number of particles whose neighbors are found before their
+densities are added up by smDensitySymParallel() */
+#define SM_BLOCK 16384
+
 int smInit(SMX *psmx,KD kd,int nSmooth,float *fPeriod)
 {
 	SMX smx;
@@ -60,6 +68,7 @@ int smInit(SMX *psmx,KD kd,int nSmooth,float *fPeriod)
 	 ** Set for Periodic Boundary Conditions.
 	 */
 	for (j=0;j<3;++j) smx->fPeriod[j] = fPeriod[j];
+	smx->nThreads = 1;
 	/*
 	 ** Initialize arrays for calculated quantities.--DJE
 	 */
@@ -383,6 +392,225 @@ void smReSmooth(SMX smx,void (*fncSmooth)(SMX,int,int,int *,float *))
  	}
 
 
+SMX smCopy(SMX smx)
+/* Make a copy of a smoothing context for use by one thread.  The copy
+has its own priority queue, marks, and neighbor lists, but shares the
+tree and the results for each particle. */
+{
+	SMX copy;
+	int PQ_j;
+	int pj;
+
+	copy = (SMX)malloc(sizeof(struct smContext));
+	assert(copy != NULL);
+	*copy = *smx;
+	copy->pq = (PQ *)malloc(smx->nSmooth*sizeof(PQ));
+	assert(copy->pq != NULL);
+	PQ_INIT(copy->pq,smx->nSmooth);
+	copy->iMark = (char *)calloc(smx->kd->nActive,sizeof(char));
+	assert(copy->iMark != NULL);
+	for (pj=0;pj<smx->nSmooth;++pj) {
+		copy->iMark[pj] = 1;
+		copy->pq[pj].p = pj;
+		}
+	copy->fList = (float *)malloc(smx->nListSize*sizeof(float));
+	assert(copy->fList != NULL);
+	copy->pList = (int *)malloc(smx->nListSize*sizeof(int));
+	assert(copy->pList != NULL);
+	return(copy);
+	}
+
+
+void smFreeCopy(SMX copy)
+{
+	free(copy->pq);
+	free(copy->iMark);
+	free(copy->fList);
+	free(copy->pList);
+	free(copy);
+	}
+
+
+int smNeighbors(SMX smx,int pi)
+/* Find the nSmooth-1 nearest neighbors of particle pi, including pi
+itself, and put them in pList and their square distances in fList.  The
+square radius of the ball is put in pfBall2[pi].  Unlike smSmooth(), the
+search starts from the bucket of pi rather than from the neighbors of
+the previous particle, so the result does not depend on the order in
+which particles are done. */
+{
+	KDN *c;
+	PQ *pq,*pqLast;
+	PQ *PQ_t,*PQ_lt;
+	int PQ_j,PQ_i;
+	int cell,pj,nCnt,nSmooth;
+	float dx,dy,dz,x,y,z;
+	float temp_ri[3];
+
+	c = smx->kd->kdNodes;
+	nSmooth = smx->nSmooth;
+	pqLast = &smx->pq[nSmooth-1];
+	x = NP_POS(smx->kd, pi, 0);
+	y = NP_POS(smx->kd, pi, 1);
+	z = NP_POS(smx->kd, pi, 2);
+	cell = ROOT;
+	while (cell < smx->kd->nSplit) {
+		if (NP_POS(smx->kd, pi, c[cell].iDim) < c[cell].fSplit)
+			cell = LOWER(cell);
+		else
+			cell = UPPER(cell);
+		}
+	/*
+	 ** Load the priority queue from the bucket, as in smSmooth().
+	 */
+	smx->pqHead = NULL;
+	for (pq=smx->pq;pq<=pqLast;++pq) smx->iMark[pq->p] = 0;
+	pj = c[cell].pLower;
+	if (pj > smx->kd->nActive - nSmooth)
+		pj = smx->kd->nActive - nSmooth;
+	for (pq=smx->pq;pq<=pqLast;++pq) {
+		smx->iMark[pj] = 1;
+		dx = x - NP_POS(smx->kd, pj, 0);
+		dy = y - NP_POS(smx->kd, pj, 1);
+		dz = z - NP_POS(smx->kd, pj, 2);
+		pq->fKey = dx*dx + dy*dy + dz*dz;
+		pq->p = pj++;
+		pq->ax = 0.0;
+		pq->ay = 0.0;
+		pq->az = 0.0;
+		}
+	PQ_BUILD(smx->pq,nSmooth,smx->pqHead);
+	temp_ri[0] = x;
+	temp_ri[1] = y;
+	temp_ri[2] = z;
+	smBallSearch(smx,smx->pqHead->fKey,temp_ri);
+	smx->pfBall2[pi] = smx->pqHead->fKey;
+	nCnt = 0;
+	for (pq=smx->pq;pq<=pqLast;++pq) {
+		if (pq == smx->pqHead) continue;
+		smx->pList[nCnt] = pq->p;
+		smx->fList[nCnt++] = pq->fKey;
+		}
+	return(nCnt);
+	}
+
+
+void smDensitySymParallel(SMX smx)
+/* The densities of smSmooth(smx,smDensitySym), with the neighbors of
+each particle found by smx->nThreads threads.  The kernel weights of a
+block of particles are found in parallel, then added to the densities in
+particle order.  The neighbors of each particle do not depend on which
+thread finds them, so the densities are exactly the same for any number
+of threads.  They differ from those of smSmooth() only in the order in
+which they are added up. */
+{
+	SMX *smxThread;
+	int *pBlock,*nBlock;
+	float *fBlock;
+	int t,pi,pj,i,k,nCnt,nSmooth,nThreads,iStart,iEnd;
+	float fNorm,ih2,r2,rs;
+
+	nThreads = smx->nThreads;
+	nSmooth = smx->nSmooth;
+	smxThread = (SMX *)malloc(nThreads*sizeof(SMX));
+	assert(smxThread != NULL);
+	for (t=0;t<nThreads;++t) smxThread[t] = smCopy(smx);
+	pBlock = (int *)malloc((size_t)SM_BLOCK*nSmooth*sizeof(int));
+	assert(pBlock != NULL);
+	fBlock = (float *)malloc((size_t)SM_BLOCK*nSmooth*sizeof(float));
+	assert(fBlock != NULL);
+	nBlock = (int *)malloc(SM_BLOCK*sizeof(int));
+	assert(nBlock != NULL);
+
+	for (iStart=0;iStart<smx->kd->nActive;iStart+=SM_BLOCK) {
+		iEnd = iStart+SM_BLOCK;
+		if (iEnd > smx->kd->nActive) iEnd = smx->kd->nActive;
+#ifdef _OPENMP
+#pragma omp parallel for num_threads(nThreads) schedule(dynamic,64) private(t,k,i,nCnt,ih2,fNorm,r2,rs)
+#endif
+		for (pi=iStart;pi<iEnd;++pi) {
+#ifdef _OPENMP
+			t = omp_get_thread_num();
+#else
+			t = 0;
+#endif
+			k = pi-iStart;
+			nCnt = smNeighbors(smxThread[t],pi);
+			nBlock[k] = nCnt;
+			memcpy(&pBlock[(size_t)k*nSmooth],smxThread[t]->pList,
+			       nCnt*sizeof(int));
+			/* The weights of smDensitySym() */
+			ih2 = 4.0/smx->pfBall2[pi];
+			fNorm = 0.5*M_1_PI*sqrt(ih2)*ih2;
+			for (i=0;i<nCnt;++i) {
+				r2 = smxThread[t]->fList[i]*ih2;
+				rs = 2.0 - sqrt(r2);
+				if (r2 < 1.0) rs = (1.0 - 0.75*rs*r2);
+				else rs = 0.25*rs*rs*rs;
+				rs *= fNorm;
+				fBlock[(size_t)k*nSmooth+i] = rs;
+				}
+			}
+		for (pi=iStart;pi<iEnd;++pi) {
+			k = pi-iStart;
+			for (i=0;i<nBlock[k];++i) {
+				pj = pBlock[(size_t)k*nSmooth+i];
+				rs = fBlock[(size_t)k*nSmooth+i];
+#ifdef DIFFERENT_MASSES
+				NP_DENS(smx->kd, pi) += rs*NP_MASS(smx->kd, pj);
+				NP_DENS(smx->kd, pj) += rs*NP_MASS(smx->kd, pi);
+#else
+				smx->kd->p[pi].fDensity += rs*smx->kd->fMass;
+				smx->kd->p[pj].fDensity += rs*smx->kd->fMass;
+#endif
+				}
+			}
+		}
+
+	for (t=0;t<nThreads;++t) smFreeCopy(smxThread[t]);
+	free(smxThread);
+	free(pBlock);
+	free(fBlock);
+	free(nBlock);
+	}
+
+
+void smReSmoothParallel(SMX smx,void (*fncSmooth)(SMX,int,int,int *,float *))
+/* The same as smReSmooth(), with the particles divided among
+smx->nThreads threads.  fncSmooth must only change the results of
+particle pi. */
+{
+	SMX *smxThread;
+	int t,pi,nSmooth,nThreads;
+	float temp_ri[3];
+
+	nThreads = smx->nThreads;
+	smxThread = (SMX *)malloc(nThreads*sizeof(SMX));
+	assert(smxThread != NULL);
+	for (t=0;t<nThreads;++t) smxThread[t] = smCopy(smx);
+
+#ifdef _OPENMP
+#pragma omp parallel for num_threads(nThreads) schedule(dynamic,256) private(t,nSmooth,temp_ri)
+#endif
+	for (pi=0;pi<smx->kd->nActive;++pi) {
+#ifdef _OPENMP
+		t = omp_get_thread_num();
+#else
+		t = 0;
+#endif
+		temp_ri[0] = NP_POS(smx->kd, pi, 0);
+		temp_ri[1] = NP_POS(smx->kd, pi, 1);
+		temp_ri[2] = NP_POS(smx->kd, pi, 2);
+		nSmooth = smBallGather(smxThread[t],smx->pfBall2[pi],temp_ri);
+		(*fncSmooth)(smxThread[t],pi,nSmooth,smxThread[t]->pList,
+			     smxThread[t]->fList);
+		}
+
+	for (t=0;t<nThreads;++t) smFreeCopy(smxThread[t]);
+	free(smxThread);
+	}
+
+
 void smDensity(SMX smx,int pi,int nSmooth,int *pList,float *fList)
 {
 	float ih2,r2,rs,fDensity;
@@ -92,7 +92,8 @@ typedef struct kdContext {
 	int uSecond;
 	int uMicro;
     npy_float64 *np_densities;
-    npy_float64 *np_pos[3];
+    char *np_pos[3];	/* Positions, read in place from numpy arrays */
+    npy_intp np_stride[3];	/* with these strides in bytes */
     npy_float64 *np_masses;
     float totalmass;
 	} * KD;
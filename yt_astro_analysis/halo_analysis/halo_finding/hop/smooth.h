@@ -62,6 +62,7 @@ typedef struct smContext {
 	int nHashLength;	/* The length of the hash table */
 	Boundary *hash;		/* The hash table for boundaries */
 	float fDensThresh;	/* Density Threshold for group finding */
+	int nThreads;		/* The # of threads for finding neighbors */
 	} * SMX;
 
 
@@ -118,6 +119,11 @@ void smBallSearch(SMX,float,float *);
 int  smBallGather(SMX,float,float *);
 void smSmooth(SMX,void (*)(SMX,int,int,int *,float *));
 void smReSmooth(SMX,void (*)(SMX,int,int,int *,float *));
+SMX smCopy(SMX);
+void smFreeCopy(SMX);
+int smNeighbors(SMX,int);
+void smDensitySymParallel(SMX);
+void smReSmoothParallel(SMX,void (*)(SMX,int,int,int *,float *));
 void smDensity(SMX,int,int,int *,float *);
 void smDensitySym(SMX,int,int,int *,float *);
 void smMeanVel(SMX,int,int,int *,float *);
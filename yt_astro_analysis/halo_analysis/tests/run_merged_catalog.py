@@ -0,0 +1,33 @@
+import os
+import sys
+
+from mpi4py import MPI
+
+import yt
+from yt_astro_analysis.halo_analysis import HaloCatalog, add_filter
+
+yt.enable_parallelism()
+
+data_dir = sys.argv[1]
+comm = MPI.Comm.Get_parent()
+
+
+def _not_on_rank(halo, rank):
+    return halo.halo_catalog.comm.rank != rank
+
+
+add_filter("not_on_rank", _not_on_rank)
+
+os.chdir(data_dir)
+halos_ds = yt.load("fake_halos.0.h5")
+for output_dir, merge_output in (("ranks", False), ("merged", True)):
+    hc = HaloCatalog(halos_ds=halos_ds, output_dir=output_dir)
+    hc.add_filter("quantity_value", "particle_mass", ">", 1e12, "Msun")
+    # leave one processor without halos
+    hc.add_filter("not_on_rank", 1)
+    # a static division of halos among processors, the same for both runs
+    hc.create(njobs=-1, merge_output=merge_output)
+
+# let the parent know the catalogs are written
+comm.Barrier()
+comm.Disconnect()
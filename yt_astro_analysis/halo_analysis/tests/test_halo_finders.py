@@ -3,10 +3,29 @@ import shutil
 import sys
 import tempfile
 
+import numpy as np
+from numpy.testing import (
+    assert_allclose,
+    assert_array_equal,
+    assert_equal,
+    assert_raises,
+)
+
 from yt.frontends.halo_catalog.data_structures import YTHaloCatalogDataset
 from yt.frontends.rockstar.data_structures import RockstarDataset
-from yt.loaders import load
+from yt.loaders import load, load_particles
 from yt.utilities.answer_testing.framework import FieldValuesTest, requires_ds
+from yt_astro_analysis.halo_analysis.halo_finding.fof.EnzoFOF import RunFOF
+from yt_astro_analysis.halo_analysis.halo_finding.halo_objects import (
+    FOFHaloFinder,
+    HOPHaloFinder,
+)
+from yt_astro_analysis.halo_analysis.halo_finding.hop.EnzoHop import (
+    FindHOPGroups,
+    RegroupHOP,
+    RunHOP,
+    error,
+)
 
 _fields = (
     ("halos", "particle_position_x"),
@@ -59,3 +78,200 @@ def test_halo_finders_single():
 
     os.chdir(curdir)
     shutil.rmtree(tmpdir)
+
+
+def _clustered_particles(n_particles, n_clusters=10, seed=0):
+    # gaussian clumps on a uniform background in the unit box
+    rng = np.random.default_rng(seed)
+    centers = rng.random((n_clusters, 3))
+    n_clumped = n_particles // 2
+    clump = rng.integers(0, n_clusters, n_clumped)
+    pos = centers[clump] + 0.01 * rng.normal(size=(n_clumped, 3))
+    pos = np.concatenate([pos, rng.random((n_particles - n_clumped, 3))]) % 1
+    return pos, np.ones(n_particles)
+
+
+def test_hop_threads():
+    pos, mass = _clustered_particles(20000)
+    results = []
+    for nthreads in (1, 2, 4):
+        results.append(RunHOP(*pos.T.copy(), mass.copy(), 160.0, nthreads=nthreads))
+
+    dens1, tags1 = results[0]
+    assert tags1.max() > 0
+    # threads change only the order of the density sums of the serial code
+    dens2, tags2 = results[1]
+    assert_allclose(dens2, dens1, rtol=1e-4)
+    assert_array_equal(tags2, tags1)
+    # and the densities do not depend on the number of threads
+    for dens, tags in results[2:]:
+        assert_array_equal(dens, dens2)
+        assert_array_equal(tags, tags2)
+
+
+def test_hop_parameters():
+    pos, mass = _clustered_particles(20000)
+    args = (*pos.T.copy(), mass, 160.0)
+    dens, tags = RunHOP(*args)
+
+    # the defaults
+    my_dens, my_tags = RunHOP(*args, ndens=64, nhop=64, nmerge=4, nbucket=16)
+    assert_array_equal(my_dens, dens)
+    assert_array_equal(my_tags, tags)
+
+    # the bucket size changes only the order of the density sums
+    my_dens, my_tags = RunHOP(*args, nbucket=64)
+    assert_allclose(my_dens, dens, rtol=1e-4)
+    assert_array_equal(my_tags, tags)
+
+    my_dens, my_tags = RunHOP(*args, ndens=16)
+    assert my_tags.max() > 0
+
+    assert_raises(error, RunHOP, *args, nmerge=63)
+    assert_raises(error, RunHOP, *args, nbucket=0)
+    # more neighbors than particles
+    assert_raises(error, RunHOP, *pos[:64].T.copy(), mass[:64], 160.0)
+
+
+def test_hop_regroup():
+    pos, mass = _clustered_particles(20000)
+    dens, groups = FindHOPGroups(pos, None, None, mass)
+    for threshold in (80.0, 160.0, 320.0):
+        my_dens, tags = RunHOP(pos, None, None, mass, threshold)
+        assert_array_equal(dens, my_dens)
+        assert_array_equal(RegroupHOP(dens, groups, threshold), tags)
+
+    bad_groups = (groups[0][:-1],) + groups[1:]
+    assert_raises(error, RegroupHOP, dens, bad_groups, 160.0)
+
+    data = {("io", f"particle_position_{ax}"): pos[:, i] for i, ax in enumerate("xyz")}
+    data["io", "particle_mass"] = mass
+    ds = load_particles(data, bbox=np.array([[0.0, 1.0]] * 3))
+    halos = HOPHaloFinder(ds, threshold=80.0, ptype="io")
+    for threshold in (160.0, 320.0):
+        my_halos = halos.regroup(threshold)
+        new_halos = HOPHaloFinder(ds, threshold=threshold, ptype="io")
+        assert len(my_halos) > 0
+        assert_equal(len(my_halos), len(new_halos))
+        for my_halo, new_halo in zip(my_halos, new_halos):
+            assert_array_equal(my_halo.indices, new_halo.indices)
+
+
+def test_finder_inputs():
+    pos, mass = _clustered_particles(20000)
+    link = 0.2 * pos.shape[0] ** (-1 / 3)
+    dens, tags = RunHOP(*pos.T.copy(), mass, 160.0)
+    fof_tags = RunFOF(*pos.T.copy(), link)
+
+    # an (N, 3) array and strided columns are read in place
+    for args in [(pos, None, None), (pos[:, 0], pos[:, 1], pos[:, 2])]:
+        my_dens, my_tags = RunHOP(*args, mass, 160.0)
+        assert_array_equal(my_dens, dens)
+        assert_array_equal(my_tags, tags)
+        assert_array_equal(RunFOF(*args, link), fof_tags)
+
+    # dividing by scale is the same as normalizing beforehand
+    scale = (2.0, 3.0, 5.0)
+    scaled = pos * scale
+    normed = scaled / scale
+    my_dens, my_tags = RunHOP(scaled, None, None, mass, 160.0, scale=scale)
+    assert_array_equal(my_dens, RunHOP(*normed.T.copy(), mass, 160.0)[0])
+    assert_array_equal(
+        RunFOF(scaled, None, None, link, scale=scale),
+        RunFOF(*normed.T.copy(), link),
+    )
+
+    # float32 positions are the same as their float64 conversion
+    pos32 = pos.astype(np.float32)
+    pos64 = pos32.astype(np.float64)
+    assert_array_equal(
+        RunHOP(pos32, None, None, mass, 160.0)[0],
+        RunHOP(pos64, None, None, mass, 160.0)[0],
+    )
+    assert_array_equal(RunFOF(pos32, None, None, link), RunFOF(pos64, None, None, link))
+
+
+def test_finder_position_units():
+    pos, mass = _clustered_particles(20000)
+    data = {("io", f"particle_position_{ax}"): pos[:, i] for i, ax in enumerate("xyz")}
+    data["io", "particle_mass"] = mass
+    ds = load_particles(data, length_unit=(1.0, "Mpc"), bbox=np.array([[0.0, 1.0]] * 3))
+    for finder in (HOPHaloFinder, FOFHaloFinder):
+        halos = finder(ds, ptype="io")
+        fields = halos.particle_fields
+        dens, tags = fields["densities"].copy(), fields["tags"].copy()
+        assert tags.max() > 0
+
+        # positions are divided by the period in their own units
+        for ax in "xyz":
+            field = f"particle_position_{ax}"
+            fields[field] = fields[field].to("cm")
+        halos._run_finder()
+        assert_allclose(halos.densities, dens, rtol=1e-4)
+        assert_equal(_same_groups(halos.tags, tags), True)
+
+        # float32 positions are read without conversion
+        for ax in "xyz":
+            field = f"particle_position_{ax}"
+            fields[field] = fields[field].to("code_length").astype(np.float32)
+        halos._run_finder()
+        assert_equal(_same_groups(halos.tags, tags), True)
+
+
+def _brute_force_fof(pos, link, n_members=8):
+    # link all pairs closer than link in the periodic unit box
+    n_particles = pos.shape[0]
+    parent = np.arange(n_particles)
+
+    def find(i):
+        while parent[i] != i:
+            i = parent[i]
+        return i
+
+    for i in range(n_particles):
+        diff = np.abs(pos[i + 1 :] - pos[i])
+        diff = np.minimum(diff, 1 - diff)
+        for j in np.nonzero((diff**2).sum(axis=1) < link**2)[0] + i + 1:
+            ri, rj = find(i), find(j)
+            parent[max(ri, rj)] = min(ri, rj)
+
+    roots = np.array([find(i) for i in range(n_particles)])
+    _, roots, counts = np.unique(roots, return_inverse=True, return_counts=True)
+    roots[counts[roots] < n_members] = -1
+    return roots
+
+
+def _same_groups(tags1, tags2):
+    # the same groups, possibly numbered differently
+    pairs = np.unique(np.stack([tags1, tags2]), axis=1)
+    return (
+        pairs.shape[1] == np.unique(tags1).size == np.unique(tags2).size
+        and ((pairs[0] == -1) == (pairs[1] == -1)).all()
+    )
+
+
+def test_fof_threads():
+    pos, _ = _clustered_particles(2000)
+    link = 0.5 * pos.shape[0] ** (-1 / 3)
+    tags = RunFOF(pos, None, None, link)
+    assert tags.max() > 0
+    assert_equal(_same_groups(tags, _brute_force_fof(pos, link)), True)
+    for nthreads in (2, 4):
+        assert_array_equal(RunFOF(pos, None, None, link, nthreads=nthreads), tags)
+
+
+def test_fof_union():
+    pos, _ = _clustered_particles(20000)
+    # move a clump to the corner so it is split by the periodic boundaries
+    pos = (pos - pos[0] + 0.001) % 1
+    mean_separation = pos.shape[0] ** (-1 / 3)
+    for factor in (0.2, 0.5, 1.0):
+        link = factor * mean_separation
+        tags = RunFOF(pos, None, None, link, union=False)
+        assert tags.max() > 0
+        wrapped = np.intersect1d(tags[pos[:, 0] < link], tags[pos[:, 0] > 1 - link])
+        assert (wrapped >= 0).any()
+        for nthreads in (1, 4):
+            union_tags = RunFOF(pos, None, None, link, nthreads=nthreads)
+            assert_equal(_same_groups(union_tags, tags), True)
+            assert_array_equal(union_tags, tags)
@@ -0,0 +1,1106 @@
+"""
+HaloCatalog pipeline tests
+
+
+
+"""
+
+# -----------------------------------------------------------------------------
+# Copyright (c) yt Development Team. All rights reserved.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# -----------------------------------------------------------------------------
+
+import glob
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+from numpy.testing import (
+    assert_allclose,
+    assert_array_equal,
+    assert_equal,
+    assert_raises,
+)
+
+from yt.frontends.stream.io import IOHandlerStream
+from yt.loaders import load
+from yt.testing import (
+    assert_allclose_units,
+    fake_particle_ds,
+    fake_random_ds,
+    requires_module,
+)
+from yt.utilities.io_handler import BaseIOHandler
+from yt.utilities.on_demand_imports import _h5py as h5py
+from yt_astro_analysis.halo_analysis import HaloCatalog, add_callback, add_quantity
+from yt_astro_analysis.halo_analysis.halo_catalog.catalog_columns import (
+    CatalogColumns,
+    CatalogRow,
+)
+from yt_astro_analysis.halo_analysis.halo_catalog.data_cache import DataChunkCache
+from yt_astro_analysis.halo_analysis.halo_catalog.halo_filters import (
+    _cached_comparison,
+    _comparison_cache_size,
+    _get_comparison,
+    quantity_value,
+)
+from yt_astro_analysis.halo_analysis.halo_catalog.halo_object import HaloBatch
+from yt_astro_analysis.halo_analysis.halo_catalog.pipeline_profile import (
+    PipelineProfile,
+)
+from yt_astro_analysis.halo_analysis.halo_catalog.profile_bundle import (
+    ProfileBundle,
+    ProfileBundleReader,
+    read_profile_bundles,
+)
+from yt_astro_analysis.halo_analysis.halo_catalog.result_cache import ResultCache
+from yt_astro_analysis.halo_analysis.halo_catalog.scheduling import (
+    distribute_blocks,
+    lpt_blocks,
+    morton_keys,
+)
+from yt_astro_analysis.halo_analysis.halo_catalog.shared_memory import (
+    SharedFieldData,
+)
+from yt_astro_analysis.utilities.testing import TempDirTest, fake_halo_catalog
+
+
+def _mass_squared(halo):
+    return halo.quantities["particle_mass"] ** 2
+
+
+add_quantity("mass_squared", _mass_squared)
+
+
+def _mass_cubed(halo):
+    return halo.quantities["particle_mass"] ** 3
+
+
+add_quantity("mass_cubed", _mass_cubed)
+
+
+class _Interrupt(Exception):
+    pass
+
+
+def _interrupt(halo, counter, limit):
+    counter.append(halo.quantities["particle_identifier"])
+    if len(counter) > limit:
+        raise _Interrupt
+
+
+add_callback("interrupt", _interrupt)
+
+
+def _store_double_mass(halo):
+    halo.double_mass = 2 * halo.quantities["particle_mass"]
+
+
+add_callback("store_double_mass", _store_double_mass)
+
+
+def _store_quantities_type(halo):
+    halo.quantities_type = type(halo.quantities)
+
+
+add_callback("store_quantities_type", _store_quantities_type)
+
+
+def _store_fake_profiles(halo):
+    halo_id = int(halo.quantities["particle_identifier"])
+    ds = halo.halo_catalog.halos_ds
+    halo.profiles = {
+        "radius": ds.arr(np.arange(1, 5) * (halo_id + 1), "kpc"),
+        "used": np.arange(4) < halo_id % 5,
+    }
+    halo.profiles_variance = {"radius": ds.arr(np.full(4, halo_id), "kpc**2")}
+
+
+add_callback("store_fake_profiles", _store_fake_profiles)
+
+_cached_calls = []
+
+
+def _add_fake_profile(halo, field):
+    # adds to the profiles of a halo in place, as the profile callback does
+    _cached_calls.append(field)
+    halo_id = int(halo.quantities["particle_identifier"])
+    profiles = halo.extra.setdefault("profiles", {})
+    profiles[field] = np.full(4, halo_id + len(field))
+
+
+add_callback("add_fake_profile", _add_fake_profile, cacheable=True)
+
+
+class _FakeDataCache:
+    def __init__(self, cleared):
+        self.cleared = cleared
+
+    def clear(self):
+        self.cleared.append(True)
+
+
+class _FakeSphere:
+    def __init__(self, cleared):
+        self.data_cache = _FakeDataCache(cleared)
+
+
+def _fake_sphere(halo, cleared):
+    halo.data_object = _FakeSphere(cleared)
+
+
+add_callback("fake_sphere", _fake_sphere)
+
+
+def _sphere_density(halo):
+    if halo.data_object is None:
+        return 0.0
+    return halo.data_object["gas", "density"].sum().d
+
+
+add_quantity("sphere_density", _sphere_density)
+
+
+class _GridIOHandler(IOHandlerStream):
+    "Read stream data one grid at a time through io_iter, like on-disk grids."
+
+    _read_fluid_selection = BaseIOHandler._read_fluid_selection
+    reads = 0
+
+    def io_iter(self, chunks, fields):
+        for chunk in chunks:
+            for obj in chunk.objs:
+                for field in fields:
+                    self.reads += 1
+                    yield field, obj, self._read_data_set(obj, field)
+
+
+def _load_catalog(hc):
+    fn = os.path.join(hc.output_dir, f"{hc.output_basename}.0.h5")
+    ad = load(fn).all_data()
+    order = np.argsort(ad["halos", "particle_identifier"])
+    return {
+        field: ad["halos", field][order]
+        for field in ("particle_identifier", "particle_mass", "mass_squared")
+    }
+
+
+def _read_catalog_file(filename):
+    with h5py.File(filename, mode="r") as fh:
+        n_halos = int(fh.attrs["num_halos"])
+        data = {
+            field: (dataset[()], dataset.attrs["units"])
+            for field, dataset in fh.items()
+        }
+    return n_halos, data
+
+
+class HaloPipelineTest(TempDirTest):
+    def make_catalog(self, output_dir):
+        hc = HaloCatalog(halos_ds=self.halos_ds, output_dir=output_dir)
+        hc.add_filter("quantity_value", "particle_mass", ">", 1e12, "Msun")
+        hc.add_quantity("mass_squared")
+        return hc
+
+    def setUp(self):
+        super().setUp()
+        self.halos_ds = fake_halo_catalog()
+
+    def test_batch(self):
+        hc = self.make_catalog("serial")
+        hc.create()
+        serial = _load_catalog(hc)
+
+        hc = self.make_catalog("batch")
+        hc.create(batch=True)
+        batch = _load_catalog(hc)
+
+        masses = self.halos_ds.r["halos", "particle_mass"].to("Msun")
+        assert_equal(serial["particle_mass"].size, (masses > 1e12).sum())
+        for field in serial:
+            assert_array_equal(serial[field], batch[field])
+
+    def test_batch_columns(self):
+        hc = HaloCatalog(halos_ds=self.halos_ds, output_dir="serial")
+        hc.add_filter("quantity_value", "particle_mass", ">", 1e12, "Msun")
+        hc.create()
+        serial = hc.catalog.to_dict()
+        assert len(hc.catalog) > 0
+
+        # with only vectorized actions, halos are added by chunk
+        def _get_halo(*args):
+            raise AssertionError("Halos were analyzed one at a time.")
+
+        for output_dir, kwargs in [("batch", {}), ("checkpoint", {"checkpoint": 4})]:
+            hc = HaloCatalog(halos_ds=self.halos_ds, output_dir=output_dir)
+            hc.add_filter("quantity_value", "particle_mass", ">", 1e12, "Msun")
+            hc._get_halo = _get_halo
+            hc.create(batch=True, **kwargs)
+            batch = hc.catalog.to_dict()
+            assert_equal(batch.keys(), serial.keys())
+            for field in serial:
+                assert_array_equal(serial[field], batch[field])
+
+    def test_save_halos(self):
+        hc = self.make_catalog("save_halos")
+        hc.add_callback("store_quantities_type")
+        hc.add_callback("store_double_mass")
+        hc.create(save_halos=True)
+
+        assert_equal(len(hc.halo_list), len(hc.catalog))
+        for i, halo in enumerate(hc.halo_list):
+            # quantities are written to the catalog as they are computed
+            assert halo.quantities_type is CatalogRow
+            assert isinstance(halo.quantities, CatalogRow)
+            for key, value in halo.quantities.items():
+                assert_allclose_units(value, hc.catalog[i][key])
+
+            # attributes added by callbacks are kept apart from the slots
+            assert not hasattr(halo, "__dict__")
+            assert_equal(set(halo.extra), {"quantities_type", "double_mass"})
+            assert_allclose_units(
+                halo.double_mass, 2 * halo.quantities["particle_mass"]
+            )
+            del halo.double_mass
+            assert not hasattr(halo, "double_mass")
+            with self.assertRaises(AttributeError):
+                del halo.double_mass
+
+    def test_iterate(self):
+        hc = self.make_catalog("serial")
+        hc.create()
+        serial = _load_catalog(hc)
+
+        hc = self.make_catalog("iterate")
+        ids = [
+            quantities["particle_identifier"]
+            for quantities in hc.iterate(
+                quantities_only=True, save_output=True, flush_size=7
+            )
+        ]
+        assert_array_equal(ids, serial["particle_identifier"])
+        assert not hasattr(hc, "catalog")
+        iterate = _load_catalog(hc)
+        for field in serial:
+            assert_array_equal(serial[field], iterate[field])
+
+        # halos finished before stopping are saved
+        hc = self.make_catalog("stop")
+        for i, _ in enumerate(hc.iterate(save_output=True, flush_size=7)):
+            if i == 9:
+                break
+        stop = _load_catalog(hc)
+        for field in serial:
+            assert_array_equal(serial[field][:10], stop[field])
+
+    def test_update(self):
+        hc = self.make_catalog("original")
+        hc.create()
+        original = _load_catalog(hc)
+        halos_ds = load(os.path.join(hc.output_dir, f"{hc.output_basename}.0.h5"))
+
+        # mass_squared is carried over and the callback is not needed
+        counter = []
+        hc = HaloCatalog(halos_ds=halos_ds, output_dir="update")
+        hc.add_filter("quantity_value", "particle_mass", ">", 1e13, "Msun")
+        hc.add_quantity("mass_cubed")
+        hc.add_callback("interrupt", counter, np.inf)
+        hc.create(update=True)
+
+        assert_equal(counter, [])
+        assert_equal(hc.quantities[-1], "mass_cubed")
+        update = _load_catalog(hc)
+        select = original["particle_mass"].to("Msun") > 1e13
+        for field in original:
+            assert_array_equal(original[field][select], update[field])
+        fn = os.path.join(hc.output_dir, f"{hc.output_basename}.0.h5")
+        ad = load(fn).all_data()
+        assert_allclose_units(
+            ad["halos", "mass_cubed"], ad["halos", "particle_mass"] ** 3
+        )
+
+    def test_result_cache(self):
+        counts = []
+        uncached_counts = []
+        for threshold in (1e12, 1e13):
+            del _cached_calls[:]
+            counter = []
+            hc = HaloCatalog(halos_ds=self.halos_ds, output_dir=f"cache_{threshold}")
+            hc.enable_result_cache("result_cache")
+            hc.add_callback("interrupt", counter, np.inf)
+            hc.add_callback("add_fake_profile", "density")
+            hc.add_callback("add_fake_profile", "velocity_x")
+            hc.add_quantity("mass_squared")
+            hc.add_filter("quantity_value", "particle_mass", ">", threshold, "Msun")
+            hc.create(save_halos=True)
+            counts.append(len(_cached_calls))
+            uncached_counts.append(len(counter))
+
+            for halo in hc.halo_list:
+                halo_id = int(halo.quantities["particle_identifier"])
+                # the second callback changed the profiles in place
+                assert_equal(sorted(halo.profiles), ["density", "velocity_x"])
+                assert_array_equal(halo.profiles["density"], np.full(4, halo_id + 7))
+                assert_allclose_units(
+                    halo.quantities["mass_squared"],
+                    halo.quantities["particle_mass"] ** 2,
+                )
+
+        # all results were computed in the first run, and callbacks not
+        # registered as cacheable are always performed
+        n_halos = self.halos_ds.index.total_particles
+        assert_equal(counts, [2 * n_halos, 0])
+        assert_equal(uncached_counts, [n_halos, n_halos])
+
+        # the data cache of a deleted sphere is cleared on every run
+        for _ in range(2):
+            cleared = []
+            hc = HaloCatalog(halos_ds=self.halos_ds, output_dir="cache_delete")
+            hc.enable_result_cache("result_cache")
+            hc.add_callback("fake_sphere", cleared)
+            hc.add_callback("delete_attribute", "data_object")
+            hc.create(save_halos=True)
+            assert_equal(len(cleared), n_halos)
+            assert not any(hasattr(halo, "data_object") for halo in hc.halo_list)
+
+    def test_order(self):
+        hc = self.make_catalog("serial")
+        hc.create()
+        serial = _load_catalog(hc)
+
+        for order in ("spatial", "cost"):
+            hc = self.make_catalog(order)
+            hc.create(order=order)
+            ordered = _load_catalog(hc)
+
+            for field in serial:
+                assert_array_equal(serial[field], ordered[field])
+
+    def test_process_backend(self):
+        hc = self.make_catalog("serial")
+        hc.create()
+        serial = _load_catalog(hc)
+
+        hc = self.make_catalog("process")
+        hc.create(backend="process", nprocs=2)
+        process = _load_catalog(hc)
+        for field in serial:
+            assert_allclose_units(serial[field], process[field])
+
+        hc = self.make_catalog("process")
+        hc.add_callback("store_double_mass")
+        hc.load(backend="process", nprocs=2)
+        assert_equal(len(hc.halo_list), serial["particle_mass"].size)
+        for halo in hc.halo_list:
+            assert_allclose_units(
+                halo.double_mass, 2 * halo.quantities["particle_mass"]
+            )
+
+        # one pool of workers analyzes the halos of all chunks
+        fake_halo_catalog(filename="chunked_halos.1.h5", seed=1)
+        self.halos_ds = fake_halo_catalog(filename="chunked_halos.0.h5")
+        hc = self.make_catalog("chunked_serial")
+        hc.create()
+        serial = hc.catalog.to_dict()
+
+        hc = self.make_catalog("chunked_process")
+        hc.add_callback("store_double_mass")
+        hc.create(save_halos=True, batch=True, backend="process", nprocs=2)
+        assert len(hc._busy_time) <= 2
+        process = hc.catalog.to_dict()
+        for field in serial:
+            assert_allclose_units(serial[field], process[field])
+        for halo in hc.halo_list:
+            assert_allclose_units(
+                halo.double_mass, 2 * halo.quantities["particle_mass"]
+            )
+
+    def test_sphere_cache(self):
+        data_ds = fake_random_ds(16, nprocs=8)
+        io = data_ds.index.io = _GridIOHandler(data_ds)
+
+        def make_catalog(cache):
+            hc = HaloCatalog(
+                halos_ds=self.halos_ds, data_ds=data_ds, output_dir="sphere"
+            )
+            hc.add_filter("quantity_value", "particle_mass", ">", 1e12, "Msun")
+            hc.add_callback("sphere", factor=4, cache=cache)
+            hc.add_quantity("sphere_density")
+            return hc
+
+        hc = make_catalog(False)
+        uncached = [
+            quantities["sphere_density"]
+            for quantities in hc.iterate(quantities_only=True)
+        ]
+        uncached_reads = io.reads
+
+        io.reads = 0
+        hc = make_catalog(True)
+        cached = [
+            quantities["sphere_density"]
+            for quantities in hc.iterate(quantities_only=True)
+        ]
+        assert_array_equal(cached, uncached)
+        assert 0 < io.reads < uncached_reads
+        assert "io_iter" not in vars(io)
+
+        # the cache is removed when a run fails
+        hc = make_catalog(True)
+        hc.add_callback("interrupt", [], 3)
+        with self.assertRaises(_Interrupt):
+            hc.create(save_halos=True, save_output=False)
+        assert "io_iter" not in vars(io)
+
+        # and after each lazily loaded halo
+        hc = make_catalog(True)
+        hc.load(lazy=True)
+        assert_equal(len(hc.halo_list), len(uncached))
+        lazy = [halo.quantities["sphere_density"] for halo in hc.halo_list[:3]]
+        assert_array_equal(lazy, uncached[:3])
+        assert "io_iter" not in vars(io)
+
+    def test_merge_output_serial(self):
+        hc = self.make_catalog("serial")
+        hc.create()
+        serial = _load_catalog(hc)
+
+        hc = self.make_catalog("merged")
+        hc.create(merge_output=True)
+        merged = _load_catalog(hc)
+        for field in serial:
+            assert_array_equal(serial[field], merged[field])
+
+    @requires_module("mpi4py")
+    def test_merge_output(self):
+        from mpi4py import MPI
+
+        filename = os.path.join(os.path.dirname(__file__), "run_merged_catalog.py")
+        comm = MPI.COMM_SELF.Spawn(
+            sys.executable, args=[filename, self.tmpdir], maxprocs=3
+        )
+        comm.Barrier()
+        comm.Disconnect()
+
+        prefix = os.path.join("ranks", "fake_halos", "fake_halos")
+        ranks = [_read_catalog_file(f"{prefix}.{rank}.h5") for rank in range(3)]
+        # the second processor has no halos
+        assert_equal([n_halos for n_halos, _ in ranks][1], 0)
+        assert ranks[0][0] > 0 and ranks[2][0] > 0
+
+        # only the merged file is left
+        prefix = os.path.join("merged", "fake_halos", "fake_halos")
+        assert_equal(glob.glob(f"{prefix}.*.h5"), [f"{prefix}.0.h5"])
+        n_halos, merged = _read_catalog_file(f"{prefix}.0.h5")
+        assert_equal(n_halos, ranks[0][0] + ranks[2][0])
+        assert_equal(sorted(merged), sorted(ranks[0][1]))
+
+        # halos are in the order of the processors that found them
+        for field, (values, units) in merged.items():
+            for _, data in ranks[::2]:
+                assert_equal(data[field][1], units)
+            assert_array_equal(
+                values, np.concatenate([data[field][0] for _, data in ranks[::2]])
+            )
+
+        ad = load(f"{prefix}.0.h5").all_data()
+        values, units = merged["particle_mass"]
+        assert_allclose_units(
+            ad["halos", "particle_mass"], ad.ds.arr(values, units).to("Msun")
+        )
+
+    def test_profile(self):
+        hc = self.make_catalog("profile")
+        hc.create(profile=True)
+        n_halos = _load_catalog(hc)["particle_mass"].size
+
+        fn = os.path.join(hc.output_dir, "pipeline_profile.json")
+        with open(fn) as f:
+            actions = {row["action"]: row for row in json.load(f)["actions"]}
+        assert_equal(actions["quantity_value"]["calls"], 100)
+        assert_equal(actions["quantity_value"]["passed"], n_halos)
+        assert_equal(actions["mass_squared"]["calls"], n_halos)
+        assert actions["mass_squared"]["time"] > 0
+
+        # the batch stops before mass_squared without leaving a timer running
+        hc = self.make_catalog("profile_batch")
+        pipeline = hc.pipeline
+        pipeline.profile = PipelineProfile(pipeline.actions)
+        batch = HaloBatch(hc, hc.data_source, np.arange(100))
+        n_batch = len(pipeline.actions) - 1
+        assert_equal(pipeline._process_batch(batch), n_batch)
+        assert pipeline.profile._start_time is None
+        assert_equal(pipeline.profile.calls, [100] * n_batch + [0])
+
+    def test_profile_bundle(self):
+        hc = self.make_catalog("bundle")
+        hc.add_callback("store_fake_profiles")
+        hc.add_callback("save_profiles", bundle=True)
+        hc.create()
+        assert os.path.exists(os.path.join(hc.output_dir, "profiles.0.h5"))
+
+        hc = self.make_catalog("bundle")
+        hc.add_callback("load_profiles", bundle=True)
+        hc.load()
+        assert len(hc.halo_list) > 0
+        for halo in hc.halo_list:
+            halo_id = int(halo.quantities["particle_identifier"])
+            assert_allclose_units(
+                halo.profiles["radius"],
+                self.halos_ds.arr(np.arange(1, 5) * (halo_id + 1), "kpc"),
+            )
+            assert_array_equal(halo.profiles["used"], np.arange(4) < halo_id % 5)
+            assert_allclose_units(
+                halo.profiles_variance["radius"],
+                self.halos_ds.arr(np.full(4, halo_id), "kpc**2"),
+            )
+
+    def check_bundled_profiles(self, output_dir):
+        hc = self.make_catalog(output_dir)
+        hc.add_callback("load_profiles", bundle=True)
+        hc.load()
+        assert len(hc.halo_list) > 0
+        for halo in hc.halo_list:
+            halo_id = int(halo.quantities["particle_identifier"])
+            assert_allclose_units(
+                halo.profiles["radius"],
+                self.halos_ds.arr(np.arange(1, 5) * (halo_id + 1), "kpc"),
+            )
+
+    def test_profile_bundle_rerun(self):
+        hc = self.make_catalog("rerun")
+        hc.add_callback("store_fake_profiles")
+        hc.add_callback("save_profiles", bundle=True)
+        hc.create()
+        prefix = os.path.join(hc.output_dir, "profiles")
+        shutil.copy(f"{prefix}.0.h5", f"{prefix}.0.99.h5")
+
+        # the same halo in two files is an error
+        hc = self.make_catalog("rerun")
+        hc.add_callback("load_profiles", bundle=True)
+        with self.assertRaises(RuntimeError):
+            hc.load()
+
+        # files from earlier runs are removed
+        hc = self.make_catalog("rerun")
+        hc.add_callback("store_fake_profiles")
+        hc.add_callback("save_profiles", bundle=True)
+        hc.create(backend="process", nprocs=2)
+        filenames = sorted(glob.glob(f"{prefix}.*.h5"))
+        assert f"{prefix}.0.h5" not in filenames
+        assert f"{prefix}.0.99.h5" not in filenames
+        assert set(filenames) <= {f"{prefix}.0.0.h5", f"{prefix}.0.1.h5"}
+        self.check_bundled_profiles("rerun")
+
+    def test_lazy_load(self):
+        hc = self.make_catalog("lazy")
+        hc.add_callback("store_fake_profiles")
+        hc.add_callback("save_profiles", bundle=True)
+        hc.create()
+        n_halos = _load_catalog(hc)["particle_mass"].size
+
+        counter = []
+        hc = self.make_catalog("lazy")
+        hc.add_callback("load_profiles", bundle=True)
+        hc.add_callback("interrupt", counter, np.inf)
+        hc.load(lazy=True, cache_size=2)
+        assert_equal(len(hc.halo_list), n_halos)
+        assert_equal(len(counter), 0)
+
+        for halo in hc.halo_list[:3]:
+            halo_id = int(halo.quantities["particle_identifier"])
+            assert halo.quantities["particle_mass"] > self.halos_ds.quan(1e12, "Msun")
+            assert_allclose_units(
+                halo.profiles["radius"],
+                self.halos_ds.arr(np.arange(1, 5) * (halo_id + 1), "kpc"),
+            )
+            assert_allclose_units(
+                halo.profiles_variance["radius"],
+                self.halos_ds.arr(np.full(4, halo_id), "kpc**2"),
+            )
+        assert_equal(len(counter), 3)
+        # profiles are read by halo instead of all at once
+        for data in hc._profile_data.values():
+            assert isinstance(data, ProfileBundleReader)
+
+        # the last two halos are cached and the first is loaded again
+        hc.halo_list[2]
+        hc.halo_list[1]
+        assert_equal(len(counter), 3)
+        hc.halo_list[0]
+        assert_equal(len(counter), 4)
+
+    def test_not_subhalo(self):
+        halos_ds = fake_halo_catalog(n_halos=300, filename="subhalos.0.h5")
+        ad = halos_ds.all_data()
+        pos = np.array(
+            [ad["halos", f"particle_position_{ax}"].to("Mpc").d for ax in "xyz"]
+        ).T
+        rad = ad["halos", "virial_radius"].to("Mpc").d
+        ids = ad["halos", "particle_identifier"].d.astype(np.int64)
+        width = halos_ds.domain_width.to("Mpc").d
+
+        # the largest halo around each halo is the parent of all within it
+        parents = np.full(ids.size, -1)
+        for i in range(ids.size):
+            dist = np.abs(pos - pos[i])
+            dist = np.sqrt((np.minimum(dist, width - dist) ** 2).sum(axis=1))
+            neighbors = np.where(dist <= rad[i])[0]
+            if neighbors.size > 1:
+                parents[neighbors] = ids[neighbors[np.argmax(rad[neighbors])]]
+        parents[parents == ids] = -1
+        assert 0 < (parents != -1).sum() < ids.size
+
+        for batch in (False, True):
+            hc = HaloCatalog(halos_ds=halos_ds, output_dir=f"subhalos_{batch}")
+            hc.add_filter("not_subhalo")
+            hc.create(batch=batch)
+            assert_array_equal(hc.halo_parents[0], np.sort(ids))
+            assert_array_equal(hc.halo_parents[1], parents[np.argsort(ids)])
+
+            fn = os.path.join(hc.output_dir, f"{hc.output_basename}.0.h5")
+            hc_ids = load(fn).r["halos", "particle_identifier"].d
+            assert_array_equal(np.sort(hc_ids), np.sort(ids[parents == -1]))
+
+        # the deprecated dictionary of parents
+        with self.assertWarns(DeprecationWarning):
+            parent_dict = hc.parent_dict
+        assert parent_dict == dict(zip(ids.tolist(), parents.tolist()))
+        hc = HaloCatalog(halos_ds=halos_ds)
+        with self.assertWarns(DeprecationWarning):
+            hc.parent_dict = parent_dict
+        assert_array_equal(hc.halo_parents[0], np.sort(ids))
+        assert_array_equal(hc.halo_parents[1], parents[np.argsort(ids)])
+
+    def test_multi_profile(self):
+        data_ds = fake_random_ds(16)
+        groups = [
+            {"profile_fields": [("gas", "density")], "weight_field": ("gas", "mass")},
+            {
+                "profile_fields": [("gas", "velocity_x")],
+                "weight_field": ("index", "cell_volume"),
+                "accumulation": True,
+            },
+            # binned together with the first
+            {
+                "profile_fields": [("gas", "velocity_y")],
+                "weight_field": ("gas", "mass"),
+            },
+        ]
+
+        halo_lists = []
+        for multi in (False, True):
+            hc = HaloCatalog(
+                halos_ds=self.halos_ds, data_ds=data_ds, output_dir=f"multi_{multi}"
+            )
+            hc.add_filter("quantity_value", "particle_mass", ">", 1e13, "Msun")
+            hc.add_callback("sphere", factor=5)
+            if multi:
+                hc.add_callback("multi_profile", [("index", "radius")], groups)
+            else:
+                for group in groups:
+                    hc.add_callback("profile", [("index", "radius")], **group)
+            hc.create(save_halos=True)
+            halo_lists.append(hc.halo_list)
+
+        profiled = [halo for halo in halo_lists[0] if hasattr(halo, "profiles")]
+        assert len(profiled) > 0
+        for single, multi in zip(*halo_lists):
+            assert_equal(hasattr(single, "profiles"), hasattr(multi, "profiles"))
+            if not hasattr(single, "profiles"):
+                continue
+            for storage in ("profiles", "profiles_variance"):
+                single_profiles = getattr(single, storage)
+                multi_profiles = getattr(multi, storage)
+                assert_equal(set(single_profiles), set(multi_profiles))
+                for field in single_profiles:
+                    assert_array_equal(single_profiles[field], multi_profiles[field])
+
+    def test_iterative_center_of_mass(self):
+        data_ds = fake_random_ds(32, particles=1000)
+        centers = []
+        for in_memory, particle_type in (
+            (False, "nbody"),
+            (True, "nbody"),
+            (False, "io"),
+            (True, "io"),
+        ):
+            hc = HaloCatalog(
+                halos_ds=self.halos_ds,
+                data_ds=data_ds,
+                output_dir=f"center_{in_memory}_{particle_type}",
+            )
+            hc.add_filter("quantity_value", "virial_radius", ">", 0.04, "code_length")
+            hc.add_callback(
+                "iterative_center_of_mass",
+                outer_radius=3,
+                inner_ratio=0.9,
+                in_memory=in_memory,
+                particle_type=particle_type,
+            )
+            hc.create()
+            centers.append(
+                np.array(
+                    [
+                        hc.catalog[f"particle_position_{ax}"].to("code_length").d
+                        for ax in "xyz"
+                    ]
+                ).T
+            )
+
+        # spheres crossing the domain boundary are only wrapped in memory
+        ids = hc.catalog["particle_identifier"].d.astype(np.int64)
+        ad = self.halos_ds.all_data()
+        start = np.array(
+            [ad["halos", f"particle_position_{ax}"].to("code_length").d for ax in "xyz"]
+        ).T[ids]
+        radius = 3 * ad["halos", "virial_radius"].to("code_length").d[ids, None]
+        interior = ((start > radius) & (start < 1 - radius)).all(axis=1)
+        assert interior.sum() > 0
+        assert_allclose(centers[0][interior], centers[1][interior], rtol=1e-12)
+        # all particles of these data are of type io
+        assert_array_equal(centers[2], centers[0])
+        assert_array_equal(centers[3], centers[1])
+
+        # particles of another type are not found
+        hc = HaloCatalog(
+            halos_ds=self.halos_ds,
+            data_ds=fake_particle_ds(),
+            output_dir="center_missing",
+        )
+        hc.add_callback("iterative_center_of_mass", in_memory=True, particle_type="DM")
+        with self.assertRaises(RuntimeError):
+            hc.create(save_output=False)
+
+    def test_checkpoint(self):
+        hc = self.make_catalog("serial")
+        hc.create()
+        serial = _load_catalog(hc)
+
+        counter = []
+        hc = self.make_catalog("checkpoint")
+        hc.add_callback("interrupt", counter, 10)
+        with self.assertRaises(_Interrupt):
+            hc.create(checkpoint=4)
+
+        # only halos processed since the last checkpoint are redone
+        counter.clear()
+        hc = self.make_catalog("checkpoint")
+        hc.add_callback("interrupt", counter, np.inf)
+        hc.create(checkpoint=4)
+        assert len(counter) < serial["particle_mass"].size
+
+        checkpoint = _load_catalog(hc)
+        for field in serial:
+            assert_array_equal(serial[field], checkpoint[field])
+
+    def test_checkpoint_profile_bundle(self):
+        counter = []
+        hc = self.make_catalog("checkpoint")
+        hc.add_callback("store_fake_profiles")
+        hc.add_callback("save_profiles", bundle=True)
+        hc.add_callback("interrupt", counter, 10)
+        with self.assertRaises(_Interrupt):
+            hc.create(checkpoint=4)
+
+        # profiles of halos redone after the restart are not duplicated
+        hc = self.make_catalog("checkpoint")
+        hc.add_callback("store_fake_profiles")
+        hc.add_callback("save_profiles", bundle=True)
+        hc.create(checkpoint=4)
+        self.check_bundled_profiles("checkpoint")
+
+
+def test_catalog_columns():
+    ds = fake_random_ds(16)
+    catalog = CatalogColumns(capacity=2)
+    for i in range(5):
+        catalog.append(
+            {
+                "particle_identifier": i,
+                "particle_mass": ds.quan(i, "Msun"),
+                "virial_radius": ds.quan(i, "kpc"),
+            }
+        )
+
+    assert_equal(len(catalog), 5)
+    assert_array_equal(catalog["particle_identifier"], np.arange(5))
+    assert_equal(str(catalog["particle_mass"].units), "g")
+    assert_allclose_units(catalog["virial_radius"], ds.arr(np.arange(5), "kpc"))
+    assert_allclose_units(catalog[-1]["particle_mass"], ds.quan(4, "Msun"))
+
+    # rows are filled in place and only added by add_row
+    row = catalog.new_row()
+    row["particle_identifier"] = 5
+    row["virial_radius"] = ds.quan(5, "kpc")
+    assert_equal(len(catalog), 5)
+    assert_equal(set(row), {"particle_identifier", "virial_radius"})
+    assert catalog.new_row()._index == row._index
+    catalog.add_row(row)
+    assert_equal(len(catalog), 6)
+    assert_allclose_units(row["virial_radius"], ds.quan(5, "kpc"))
+    assert_array_equal(catalog["particle_mass"][5].d, np.nan)
+    assert_raises(RuntimeError, catalog.add_row, row)
+
+    row = catalog.new_row()
+    for key, value in catalog[4].items():
+        row[key] = value
+    catalog.add_row(row)
+    other = catalog.new_row()
+    other.update(row)
+    catalog.add_row(other)
+    assert other._keys is row._keys
+    row["particle_mass"] = ds.quan(1, "Msun")
+    del row["virial_radius"]
+    assert_equal(set(row), {"particle_identifier", "particle_mass"})
+    assert_allclose_units(catalog[6]["particle_mass"], ds.quan(1, "Msun"))
+    assert_array_equal(catalog["virial_radius"][6].d, np.nan)
+
+    # quantities missing from a row are filled, not left over from earlier rows
+    catalog.clear()
+    assert_equal(len(catalog), 0)
+    catalog.append({"particle_identifier": 7, "particle_mass": ds.quan(7, "Msun")})
+    catalog.append({"particle_identifier": 8, "virial_radius": ds.quan(8, "Mpc")})
+    catalog.extend({"particle_identifier": np.array([9, 10])})
+    assert_array_equal(catalog["particle_identifier"], [7, 8, 9, 10])
+    assert_array_equal(
+        catalog["particle_mass"].to("Msun").d, [7, np.nan, np.nan, np.nan]
+    )
+    assert_allclose_units(catalog["virial_radius"][1], ds.quan(8, "Mpc"))
+    assert_array_equal(catalog["virial_radius"].d[[0, 2, 3]], np.full(3, np.nan))
+
+    # only floating point quantities can be missing
+    assert_raises(RuntimeError, catalog.append, {"particle_mass": ds.quan(1, "Msun")})
+    assert_raises(RuntimeError, catalog.extend, {"particle_mass": ds.arr([1], "Msun")})
+    assert_raises(RuntimeError, catalog.append, {"halo_flag": True})
+    assert_equal(len(catalog), 4)
+    assert "halo_flag" not in catalog
+    row = catalog.new_row()
+    row["particle_identifier"] = 11
+    assert_raises(RuntimeError, row.__delitem__, "particle_identifier")
+
+
+def test_profile_bundle_buffer():
+    ds = fake_random_ds(16)
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "profiles.0.h5")
+        bundle = ProfileBundle(filename, buffer_size=2)
+        for halo_id in range(5):
+            profiles = {"radius": ds.arr(np.arange(3.0) + halo_id, "cm")}
+            if halo_id % 2:
+                profiles["used"] = np.arange(3) < halo_id
+            bundle.write(halo_id, profiles)
+        with assert_raises(RuntimeError):
+            bundle.write(5, {"radius": np.arange(4.0)})
+        bundle.close()
+
+        bundle = ProfileBundle(filename, mode="a")
+        bundle.write(6, {"radius": ds.arr(np.arange(3.0) + 6, "cm")})
+        bundle.keep([0, 2, 3, 6])
+        bundle.close()
+
+        index, data = read_profile_bundles([filename], ds=ds)
+        assert_equal(sorted(index), [0, 2, 3, 6])
+        profiles = data["profiles"]
+        for halo_id, row in index.items():
+            assert_allclose_units(
+                profiles["radius"][row], ds.arr(np.arange(3.0) + halo_id, "cm")
+            )
+            assert_array_equal(
+                profiles["used"][row], halo_id % 2 and np.arange(3) < halo_id
+            )
+
+        other = os.path.join(directory, "profiles.1.h5")
+        bundle = ProfileBundle(other)
+        bundle.write(10, {"radius": ds.arr(np.arange(3.0) + 10, "cm")})
+        bundle.close()
+
+        reader = ProfileBundleReader([filename, other], ds=ds)
+        assert reader.read(1) is None
+        assert_allclose_units(
+            reader.read(10)["profiles"]["radius"], ds.arr(np.arange(3.0) + 10, "cm")
+        )
+        for halo_id, row in index.items():
+            halo_data = reader.read(halo_id)
+            assert_equal(sorted(halo_data["profiles"]), ["radius", "used"])
+            assert_allclose_units(
+                halo_data["profiles"]["radius"], profiles["radius"][row]
+            )
+            assert_array_equal(halo_data["profiles"]["used"], profiles["used"][row])
+            assert_equal(halo_data["variance"], {})
+
+
+def test_result_cache():
+    ds = fake_random_ds(16)
+    with tempfile.TemporaryDirectory() as directory:
+        cache = ResultCache(directory, max_size=0.01)
+        value = {"radius": ds.arr(np.arange(100.0), "code_length")}
+        for key in "abcd":
+            assert cache.put(key, value)
+        assert cache.size <= cache.max_size
+        assert_equal(cache.get("a"), None)
+        assert_allclose_units(cache.get("d")["radius"], value["radius"])
+        assert not cache.put("e", ds.all_data())
+
+        cache = ResultCache(directory, max_size=0.01)
+        assert_equal(len(os.listdir(directory)), len(cache._files))
+        cache.clear()
+        assert_equal(os.listdir(directory), [])
+
+
+def test_quantity_value():
+    ds = fake_random_ds(16)
+    masses = ds.arr([1e11, 1e12, 1e13], "Msun").to("g")
+
+    class Target:
+        quantities = {"particle_mass": masses}
+
+    for operator, expected in [
+        ("<", [True, False, False]),
+        ("<=", [True, True, False]),
+        ("==", [False, True, False]),
+        ("!=", [True, False, True]),
+        (">=", [False, True, True]),
+        (">", [False, False, True]),
+    ]:
+        target = Target()
+        assert_array_equal(
+            quantity_value(target, "particle_mass", operator, 1e12, "Msun"), expected
+        )
+        for mass, value in zip(masses, expected):
+            target.quantities = {"particle_mass": mass}
+            assert_equal(
+                quantity_value(target, "particle_mass", operator, 1e12, "Msun"), value
+            )
+
+    target.quantities = {"virial_radius": ds.arr([0.1, 0.3], "code_length").to("cm")}
+    assert_array_equal(
+        quantity_value(target, "virial_radius", ">", 0.2, "code_length"), [False, True]
+    )
+
+    # comparisons are reused, but only a bounded number of them are kept
+    _cached_comparison.cache_clear()
+    for value in range(2 * _comparison_cache_size):
+        quantity_value(target, "virial_radius", ">", value, "code_length")
+    assert_equal(_cached_comparison.cache_info().currsize, _comparison_cache_size)
+    assert _get_comparison(">", 0.2, "Mpc") is _get_comparison(">", 0.2, "Mpc")
+    assert_array_equal(
+        quantity_value(target, "virial_radius", ">", np.array(0.2), "code_length"),
+        [False, True],
+    )
+
+
+def test_morton_keys():
+    corners = np.array([[x, y, z] for z in (0, 1) for y in (0, 1) for x in (0, 1)])
+    keys = morton_keys(0.25 + 0.5 * corners, np.zeros(3), np.ones(3))
+    assert_array_equal(np.argsort(keys), np.arange(8))
+
+    blocks = distribute_blocks([[1, 2, 3], [4]])
+    assert_equal(blocks, [1, 4, 2, None, 3, None])
+    assert_equal(blocks[1::2], [4, None, None])
+
+
+def test_lpt_blocks():
+    costs = np.array([2.0, 7.0, 3.0, 5.0, 4.0, 3.0])
+    blocks, loads = lpt_blocks(costs, 2)
+    assert_equal([block.tolist() for block in blocks], [[1, 2, 0], [3, 4, 5]])
+    assert_array_equal(loads, [12, 12])
+
+    blocks, loads = lpt_blocks([1.0], 2, loads=[12.0, 11.0])
+    assert_equal([block.tolist() for block in blocks], [[], [0]])
+    assert_array_equal(loads, [12, 12])
+
+
+def test_data_chunk_cache():
+    class GridIO:
+        "Io handler reading one array per grid and field."
+
+        reads = 0
+
+        def io_iter(self, chunks, fields):
+            for chunk in chunks:
+                for obj in chunk.objs:
+                    for field in fields:
+                        self.reads += 1
+                        yield field, obj, np.full(8, obj.id, dtype=np.float64)
+
+    class Chunk:
+        def __init__(self, objs):
+            self.objs = objs
+
+    class Grid:
+        def __init__(self, id):
+            self.id = id
+
+    class Index:
+        io = GridIO()
+
+    class Dataset:
+        index = Index()
+
+    grids = [Grid(i) for i in range(4)]
+    io = Dataset.index.io
+
+    # room for three arrays of 64 bytes
+    cache = DataChunkCache(Dataset(), 192)
+    cache.install()
+    data = list(io.io_iter([Chunk(grids[:2])], ["density"]))
+    assert_equal([obj.id for _, obj, _ in data], [0, 1])
+    assert_equal(io.reads, 2)
+
+    data = list(io.io_iter([Chunk(grids[1:3])], ["density"]))
+    assert_equal([values[0] for _, _, values in data], [1, 2])
+    assert_equal(io.reads, 3)
+    assert_equal((cache.hits, cache.misses), (1, 3))
+
+    # grid 0 was least recently used
+    list(io.io_iter([Chunk(grids[3:])], ["density"]))
+    list(io.io_iter([Chunk(grids[:1])], ["density"]))
+    assert_equal(io.reads, 5)
+
+    cache.uninstall()
+    list(io.io_iter([Chunk(grids[3:])], ["density"]))
+    assert_equal(io.reads, 6)
+    assert_equal(cache.size, 0)
+
+    # a cleared inner cache falls back on the outer one
+    outer = DataChunkCache(Dataset(), 192)
+    outer.install()
+    inner = DataChunkCache(Dataset(), 192)
+    inner.install()
+    list(io.io_iter([Chunk(grids[:1])], ["density"]))
+    inner.clear()
+    list(io.io_iter([Chunk(grids[:1])], ["density"]))
+    assert_equal(io.reads, 7)
+    assert_equal((inner.misses, outer.hits), (2, 1))
+
+    inner.uninstall()
+    assert_equal(io.io_iter, outer.io_iter)
+    outer.uninstall()
+    assert "io_iter" not in vars(io)
+
+
+@requires_module("mpi4py")
+def test_shared_field_data():
+    from mpi4py import MPI
+
+    ds = fake_random_ds(16)
+    field_data = {
+        ("halos", "particle_mass"): ds.arr(np.arange(5.0), "Msun"),
+        ("halos", "particle_identifier"): np.arange(5),
+    }
+    shared = SharedFieldData(MPI.COMM_WORLD)
+    views = shared.bcast(field_data)
+    for field, values in field_data.items():
+        assert_array_equal(views[field], values)
+    assert_equal(
+        views["halos", "particle_mass"].units,
+        field_data["halos", "particle_mass"].units,
+    )
+    shared.close()
@@ -18,9 +18,13 @@ import shutil
 import tempfile
 from unittest import TestCase
 
+import numpy as np
+
 from yt.config import ytcfg
 from yt.data_objects.time_series import SimulationTimeSeries
-from yt.loaders import load_simulation
+from yt.frontends.ytdata.utilities import save_as_dataset
+from yt.loaders import load, load_simulation
+from yt.testing import fake_random_ds
 from yt.utilities.answer_testing.framework import AnswerTestingTest
 
 
@@ -40,6 +44,36 @@ class TempDirTest(TestCase):
         shutil.rmtree(self.tmpdir)
 
 
+def fake_halo_catalog(n_halos=100, filename="fake_halos.0.h5", seed=0x4D3D3D3):
+    """
+    Write a halo catalog with randomly placed halos and load it.
+
+    Halo masses are log-uniform between 1e11 and 1e14 Msun.  The
+    catalog is written to the current directory.
+    """
+
+    ds = fake_random_ds(16, particles=16)
+    rng = np.random.default_rng(seed)
+
+    data = {
+        "particle_identifier": ds.arr(np.arange(n_halos), ""),
+        "particle_mass": ds.arr(10 ** rng.uniform(11, 14, n_halos), "Msun"),
+        "virial_radius": ds.arr(rng.uniform(0.01, 0.05, n_halos), "code_length"),
+    }
+    for ax in "xyz":
+        data[f"particle_position_{ax}"] = ds.arr(rng.random(n_halos), "code_length")
+        data[f"particle_velocity_{ax}"] = ds.arr(rng.normal(size=n_halos), "km/s")
+
+    save_as_dataset(
+        ds,
+        filename,
+        data,
+        field_types=dict.fromkeys(data, "."),
+        extra_attrs={"data_type": "halo_catalog", "num_halos": n_halos},
+    )
+    return load(filename)
+
+
 def requires_sim(sim_fn, sim_type, file_check=False):
     from functools import wraps
 